@@ -1,10 +1,23 @@
-import zipfile
+import json
 import sys
 import os
 import shutil
+import time
+from detectioncache import DetectionCache
 from gui.gui import AppGUI
-from predict import runDetection
+from imagesource import (VALID_EXTENSIONS, DirectoryImageSource,
+                         ZipImageSource)
+from instrumentation import Metrics
+from jobcontrol import PRIORITY_BULK, JobCancelled, JobControl
+from journal import RunJournal, journalPath
+from memorybudget import MemoryBudget
+from predict import (releaseModels, runDetection, setModelBackend,
+                     warmUpModel)
+from recount import RAW_CONF, Recounter, ThresholdPredictions
+from resultstore import rawResultsPath
+from sharding import runShardedDetection
 from boundingbox import addPredictionAnnotations
+from watch import watchFolder
 
 from PyQt6.QtCore import (QObject, QRunnable,
                           QThreadPool,
@@ -18,16 +31,53 @@ class App():
     def __init__(self):
         self.working_dir = os.path.join(
             os.path.dirname(__file__), ".YOLOEggDetection")
-        self.valid_extensions = [".jpg", ".jpeg", ".png"]
+        self.valid_extensions = VALID_EXTENSIONS
         self.images_dir = os.path.join(self.working_dir, 'test_images')
+        # Kept outside the working directory so results survive new uploads
+        self.detection_cache = DetectionCache(os.path.join(
+            os.path.dirname(__file__), ".YOLOEggDetectionCache"))
         self.images_loaded = False
         self.images_loaded_count = 0
+        self.image_source = None
         self.available_models = ["SGD", "Adam-W", "Adam"]
         self.selected_model_idx = 0
+        self.detection_batch_size = 8
+        self.annotation_workers = os.cpu_count() or 1
+        # Split detection across processes, each with its own model
+        self.detection_processes = int(
+            os.environ.get("FROGGLE_DETECTION_PROCESSES") or 1)
+        # Use a shared inference server (see server.py) if one is configured
+        self.inference_server_url = os.environ.get(
+            "FROGGLE_INFERENCE_SERVER") or None
+        # Write a Chrome trace of each run's stage timings if configured
+        self.trace_dir = os.environ.get("FROGGLE_TRACE_DIR") or None
+        # Cap on the memory a run holds at once, see memorybudget.py
+        memory_budget_mb = os.environ.get("FROGGLE_MEMORY_BUDGET_MB")
+        self.memory_budget_mb = (
+            float(memory_budget_mb) if memory_budget_mb else None)
+        self.budget = None
+        # Thresholds the table and carousel are counted at; the raw
+        # detections of the last run count them again when they change
+        self.conf = 0.25
+        self.iou_threshold = 0.5
+        self.recounter = None
+        self.written_thresholds = None
+        self.metrics = None
+        self.journal = None
+        self.active_worker = None
+        self.detected_count = 0
         self.threadpool = QThreadPool()
         print("Multithreading supported. Max available threads = {}".format(
             self.threadpool.maxThreadCount()))
         self.gui = AppGUI(self)
+        if self.inference_server_url is None:
+            # e.g. "onnx-int8" to run exported models, see MODEL_BACKENDS
+            backend = os.environ.get("FROGGLE_MODEL_BACKEND")
+            if backend:
+                setModelBackend(backend)
+            # Sharded runs load the model in their worker processes
+            if self.detection_processes == 1:
+                warmUpModel()
 
     def getAvailableModels(self):
         '''
@@ -57,6 +107,12 @@ class App():
         '''
         return self.working_dir
 
+    def getImageSource(self):
+        '''
+        Returns the source of the uploaded images, if any
+        '''
+        return self.image_source
+
     def getValidExtensions(self):
         '''
         Returns all image extensions supported by the application
@@ -65,40 +121,52 @@ class App():
 
     def extractZipFile(self, zip_path):
         '''
-        Extract the zip at the given path, and store the contents
-        in the "working directory"
+        Load the images in the zip at the given path. Images are read
+        straight from the archive when detection runs; only the results
+        are stored in the "working directory".
+        Results of an interrupted run on the same zip file are kept, so
+        the next run picks up where it left off
         '''
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            totalFiles = len(zip_ref.namelist())
+        if self.image_source is not None:
+            self.image_source.close()
+            self.image_source = None
+        self.closeRecounter()
+        self.gui.showImageExtractionProgress(0)
+        self.metrics = Metrics() if self.trace_dir else None
+        if self.metrics is not None:
+            with self.metrics.stage("zip_index"):
+                image_source = ZipImageSource(zip_path, self.valid_extensions)
+        else:
+            image_source = ZipImageSource(zip_path, self.valid_extensions)
+        zip_stat = os.stat(zip_path)
+        source_info = dict(path=os.path.abspath(zip_path),
+                           size=zip_stat.st_size, mtime=zip_stat.st_mtime)
+        source_info_path = os.path.join(self.working_dir, 'source.json')
+        previous_info = None
+        if os.path.isfile(source_info_path):
+            with open(source_info_path) as f:
+                previous_info = json.load(f)
+        if not (previous_info == source_info and
+                os.path.isfile(journalPath(self.images_dir))):
             if os.path.exists(self.working_dir):
                 shutil.rmtree(self.working_dir)
             os.makedirs(self.images_dir, exist_ok=True)
-            validImageCount = 0
-            for member in zip_ref.namelist():
-                self.gui.showImageExtractionProgress(
-                    validImageCount // totalFiles)
-                filename = os.path.basename(member)
-                _, file_extension = os.path.splitext(filename)
-                # Skip directories and unwanted files
-                if (not filename or filename.startswith('._')
-                        or member.startswith('__MACOSX/')
-                        or file_extension not in self.valid_extensions):
-                    continue
-
-                source = zip_ref.open(member)
-                target = open(os.path.join(self.images_dir, filename), "wb")
-                with source, target:
-                    shutil.copyfileobj(source, target)
-                    validImageCount += 1
-            self.gui.showImageExtractionProgress(100)
-            self.images_loaded = validImageCount > 0
-            self.images_loaded_count = validImageCount
-            self.gui.toggleRunModelButton(enable=validImageCount > 0)
+            with open(source_info_path, 'w') as f:
+                json.dump(source_info, f)
+        validImageCount = len(image_source)
+        self.gui.showImageExtractionProgress(100)
+        self.image_source = image_source
+        self.images_loaded = validImageCount > 0
+        self.images_loaded_count = validImageCount
+        self.gui.toggleRunModelButton(enable=validImageCount > 0)
 
     def runDetectionModel(self):
         '''
         Run object detection model if images have been loaded properly,
-        and add the results to the UI
+        and add the results to the UI.
+        Each finished image is added to the UI right away; its boxes are
+        drawn over the original image when it is shown, so no annotated
+        images are written unless they are exported
         '''
         if not self.images_loaded:
             self.gui.showImagesNotLoadedError()
@@ -106,32 +174,220 @@ class App():
             self.gui.setModelLoading(True)
             self.gui.toggleRunModelButton(enable=False)
             self.gui.toggleUploadButton(enable=False)
+            self.gui.resetPredictions()
+            # The run rewrites the raw detections
+            self.closeRecounter()
+            if self.trace_dir and self.metrics is None:
+                self.metrics = Metrics()
+            self.journal = RunJournal(journalPath(self.images_dir))
+            self.detected_count = 0
+            # Keep raw detections for the threshold sliders
+            detect, detect_kwargs = runDetection, dict(raw_conf=RAW_CONF)
+            if self.detection_processes > 1:
+                detect = runShardedDetection
+                detect_kwargs = dict(processes=self.detection_processes)
             detectionWorker = Worker(
-                runDetection,
+                detect,
                 self.images_dir,
-                model=self.available_models[self.selected_model_idx])
+                model=self.available_models[self.selected_model_idx],
+                batch_size=self.detection_batch_size,
+                in_memory=True,
+                conf=self.conf,
+                iou_threshold=self.iou_threshold,
+                source=self.image_source,
+                cache=self.detection_cache,
+                server_url=self.inference_server_url,
+                metrics=self.metrics,
+                journal=self.journal,
+                budget=self.newMemoryBudget(),
+                partial_result_kwarg="result_callback",
+                control_kwarg="control",
+                **detect_kwargs)
             detectionWorker.signals.result.connect(self.onDetectionDone)
             detectionWorker.signals.err.connect(self.onWorkerError)
+            detectionWorker.signals.cancelled.connect(
+                self.onDetectionCancelled)
             detectionWorker.signals.progress.connect(self.onDetectionProgress)
-            self.threadpool.start(detectionWorker)
+            detectionWorker.signals.partial_result.connect(
+                self.onImageDetected)
+            self.startJob(detectionWorker)
 
-    def annotateImagesWithPredictions(self):
+    def watchFolder(self, directory):
         '''
-        Annotate uploaded images with predicted classifications
+        Watch a folder and detect the images saved into it as they
+        arrive, until the job is cancelled. Counts are added to the table
+        as images are done and appended to the counts files in the
+        folder (see watch.py); the carousel keeps the most recent images
+        '''
+        if self.active_worker is not None:
+            return
+        if self.image_source is not None:
+            self.image_source.close()
+        self.closeRecounter()
+        self.image_source = DirectoryImageSource(
+            directory, self.valid_extensions)
+        # Detection and export work on uploaded zip files
+        self.images_loaded = False
+        self.images_loaded_count = 0
+        self.detected_count = 0
+        self.gui.toggleRunModelButton(enable=False)
+        self.gui.toggleUploadButton(enable=False)
+        self.gui.resetPredictions(
+            carousel_limit=AppGUI.WATCH_CAROUSEL_SIZE)
+        self.gui.showWatchStatus(directory, 0)
+        watchWorker = Worker(
+            watchFolder,
+            directory,
+            model=self.available_models[self.selected_model_idx],
+            formats=("txt", "csv"),
+            batch_size=self.detection_batch_size,
+            in_memory=True,
+            cache=self.detection_cache,
+            server_url=self.inference_server_url,
+            conf=self.conf,
+            iou_threshold=self.iou_threshold,
+            budget=self.newMemoryBudget(),
+            partial_result_kwarg="result_callback",
+            control_kwarg="control")
+        watchWorker.signals.result.connect(self.onWatchStopped)
+        watchWorker.signals.err.connect(self.onWorkerError)
+        watchWorker.signals.cancelled.connect(self.onWatchStopped)
+        watchWorker.signals.progress.connect(
+            lambda count: self.gui.showWatchStatus(directory, count))
+        watchWorker.signals.partial_result.connect(self.onImageDetected)
+        self.startJob(watchWorker)
+
+    def annotateImagesWithPredictions(self, output_dir=None):
+        '''
+        Annotate uploaded images with predicted classifications, at full
+        resolution. Annotated images are saved in `output_dir` if given,
+        e.g. to export them, instead of next to the predictions
         '''
         if not self.images_loaded:
             self.gui.showImagesNotLoadedError()
-        else:
+        elif self.active_worker is None:
+            self.writeRecount()
             annotationWorker = Worker(
-                addPredictionAnnotations, self.images_dir)
+                addPredictionAnnotations, self.images_dir,
+                workers=self.annotation_workers,
+                source=self.image_source,
+                output_dir=output_dir,
+                budget=self.newMemoryBudget(),
+                control_kwarg="control")
             self.gui.toggleRunModelButton(enable=False)
             self.gui.toggleUploadButton(enable=False)
             annotationWorker.signals.result.connect(self.onAnnotationDone)
             annotationWorker.signals.err.connect(self.onWorkerError)
+            annotationWorker.signals.cancelled.connect(
+                self.onAnnotationCancelled)
             annotationWorker.signals.progress.connect(
                 self.onAnnotationProgress)
             self.gui.showAnnotationProgress(0)
-            self.threadpool.start(annotationWorker)
+            self.startJob(annotationWorker)
+
+    def openRecounter(self):
+        '''
+        Open the raw detections of the last run, if it kept them, and
+        show the threshold sliders. Runs split across processes don't keep
+        them, so the sliders are shown disabled after those
+        '''
+        self.closeRecounter()
+        raw_path = rawResultsPath(self.images_dir)
+        if os.path.isfile(raw_path):
+            self.recounter = Recounter(raw_path)
+            self.written_thresholds = (self.conf, self.iou_threshold)
+            self.gui.showThresholdSliders(self.conf, self.iou_threshold)
+        elif self.detection_processes > 1:
+            self.gui.showThresholdSliders(
+                self.conf, self.iou_threshold, enabled=False)
+
+    def closeRecounter(self):
+        '''
+        Close the raw detections of the last run and hide the threshold
+        sliders
+        '''
+        if self.recounter is not None:
+            self.recounter.close()
+            self.recounter = None
+        self.gui.showThresholdSliders(
+            self.conf, self.iou_threshold, visible=False)
+
+    def recount(self, conf, iou_threshold):
+        '''
+        Count the images of the last run again at the given thresholds,
+        from its raw detections, and show the new counts in the table and
+        carousel. Takes milliseconds, so it can follow the sliders
+        '''
+        self.conf = conf
+        self.iou_threshold = iou_threshold
+        if self.recounter is None or self.active_worker is not None:
+            return
+        self.gui.addPredictionsTable(
+            data=self.recounter.countLines(conf, iou_threshold))
+        self.gui.setCarouselDetections(ThresholdPredictions(
+            self.recounter, self.image_source.names(), conf, iou_threshold))
+
+    def writeRecount(self):
+        '''
+        Write the results of the last run at the current thresholds, if
+        the sliders moved since they were written, e.g. before annotating
+        '''
+        thresholds = (self.conf, self.iou_threshold)
+        if self.recounter is not None and \
+                self.written_thresholds != thresholds:
+            self.recounter.write(self.images_dir, *thresholds)
+            self.written_thresholds = thresholds
+
+    def newMemoryBudget(self):
+        '''
+        Returns the memory budget for the next job if one is configured
+        '''
+        self.budget = None
+        if self.memory_budget_mb:
+            self.budget = MemoryBudget(self.memory_budget_mb)
+        return self.budget
+
+    def startJob(self, worker):
+        '''
+        Run a worker on the threadpool at its priority, as the job the
+        pause and cancel buttons apply to
+        '''
+        self.active_worker = worker
+        self.gui.showJobControls(True)
+        self.threadpool.start(worker, worker.priority)
+
+    def cancelJob(self):
+        '''
+        Ask the running job to stop at its next checkpoint
+        '''
+        if self.active_worker is not None:
+            self.active_worker.control.cancel()
+
+    def togglePauseJob(self):
+        '''
+        Pause the running job at its next checkpoint, or resume it
+        '''
+        if self.active_worker is None:
+            return
+        control = self.active_worker.control
+        if control.paused:
+            control.resume()
+        else:
+            control.pause()
+        self.gui.setJobPaused(control.paused)
+
+    def onJobFinished(self):
+        '''
+        Restore the UI once the running job has ended, however it ended
+        '''
+        self.active_worker = None
+        if self.budget is not None:
+            print("Memory budget: {}".format(self.budget.report()))
+            self.budget = None
+        self.gui.showJobControls(False)
+        self.gui.setModelLoading(False)
+        self.gui.toggleRunModelButton(enable=self.images_loaded)
+        self.gui.toggleUploadButton(enable=True)
 
     def onDetectionProgress(self, numImageProcessed):
         '''
@@ -144,43 +400,103 @@ class App():
         '''
         Handler to receive annotation progress signals
         '''
-        if numImageProcessed == 1:
-            self.gui.initPredictionImages(self.getWorkingDirectory())
-            self.gui.setModelLoading(False)
         progress = int(numImageProcessed*100/self.images_loaded_count)
-        self.gui.updateAnnotatedImageCount(numImageProcessed)
-        self.gui.showAnnotationProgress(progress)
+        self.gui.showAnnotationProgress(progress, numImageProcessed)
 
     def onAnnotationDone(self):
         '''
         Handler to run when all images are annotated
         with model predictions
         '''
+        self.onJobFinished()
         self.gui.showAnnotationProgress(100)
-        self.gui.toggleRunModelButton(enable=True)
-        self.gui.toggleUploadButton(enable=True)
+
+    def onImageDetected(self, partial_result):
+        '''
+        Handler to run when the detections of a single image are done.
+        Adds its counts to the table and the image to the carousel
+        '''
+        filename, prediction, pred = partial_result
+        self.gui.appendPrediction(prediction)
+        self.gui.addDetection(filename, pred)
+        self.detected_count += 1
+        if self.detected_count == 1:
+            self.gui.setModelLoading(False)
 
     def onDetectionDone(self, predictions):
         '''
-        Handler to run when detection model is done
-        and process results appropriately
+        Handler to run when the detection model is done and process
+        results appropriately
         '''
         self.gui.addPredictionsTable(data=predictions)
-        self.annotateImagesWithPredictions()
         self.gui.showDetectionProgress(100)
+        self.onJobFinished()
+        self.openRecounter()
+        self.detection_cache.flushStats()
+        print("Detection cache: {}".format(self.detection_cache.stats()))
+        if self.journal is not None:
+            self.journal.remove()
+            self.journal = None
+        if self.metrics is not None:
+            self.exportTrace()
+
+    def onDetectionCancelled(self):
+        '''
+        Handler to run when a detection run has been cancelled. Frees the
+        model; images finished so far stay in the journal, so running
+        again on the same images resumes
+        '''
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.metrics = None
+        releaseModels()
+        self.onJobFinished()
+
+    def onWatchStopped(self, *_):
+        '''
+        Handler to run when a folder watch has been stopped
+        '''
+        self.detection_cache.flushStats()
+        self.onJobFinished()
+
+    def onAnnotationCancelled(self):
+        '''
+        Handler to run when annotating images has been cancelled
+        '''
+        self.onJobFinished()
+
+    def exportTrace(self):
+        '''
+        Write the stage timings of the last run to the trace directory,
+        and start recording the next run afresh
+        '''
+        os.makedirs(self.trace_dir, exist_ok=True)
+        trace_path = os.path.join(
+            self.trace_dir, time.strftime("run-%Y%m%d-%H%M%S.json"))
+        self.metrics.exportChromeTrace(trace_path)
+        print("Stage timings written to {}".format(trace_path))
+        self.metrics = None
 
     def onWorkerError(self, err):
         '''
         Handler to run if detection model errors out
         '''
         print('ERROR: something went wrong while running detection model', err)
+        self.onJobFinished()
+        if self.journal is not None:
+            # Keep the journal, so the next run resumes
+            self.journal.close()
+            self.journal = None
 
 
 class WorkerSignal(QObject):
 
     progress = pyqtSignal(int)
+    partial_result = pyqtSignal(object)
     result = pyqtSignal(object)
     err = pyqtSignal(object)
+    cancelled = pyqtSignal()
 
 
 class Worker(QRunnable):
@@ -191,24 +507,44 @@ class Worker(QRunnable):
                 Supplied args and kwargs will be passed to the fn.
     :param args: Arguments to pass to the callback fn
     :param kwargs: Keywords to pass to the callback fn
+    :param partial_result_kwarg: Name of a keyword argument of fn that
+                takes a callback for intermediate results. Its arguments
+                are emitted as a tuple on the partial_result signal
+    :param control_kwarg: Name of a keyword argument of fn that takes a
+                JobControl, making the job pausable and cancellable
+                through `control`. Emits the cancelled signal if the job
+                stops because it was cancelled
+    :param priority: Threadpool priority of the job
 
     '''
 
-    def __init__(self, fn, *args, **kwargs):
+    def __init__(self, fn, *args, partial_result_kwarg=None,
+                 control_kwarg=None, priority=PRIORITY_BULK, **kwargs):
         super().__init__()
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        self.priority = priority
+        self.control = JobControl()
         self.signals = WorkerSignal()
         self.kwargs["progress_callback"] = self.onProgressCallback
+        if partial_result_kwarg:
+            self.kwargs[partial_result_kwarg] = self.onPartialResult
+        if control_kwarg:
+            self.kwargs[control_kwarg] = self.control
 
     def onProgressCallback(self, *args, **kwargs):
         self.signals.progress.emit(*args, **kwargs)
 
+    def onPartialResult(self, *args):
+        self.signals.partial_result.emit(args)
+
     @ pyqtSlot()
     def run(self):
         try:
             res = self.fn(*self.args, **self.kwargs)
+        except JobCancelled:
+            self.signals.cancelled.emit()
         except Exception as e:
             self.signals.err.emit(e)
         else:
@@ -0,0 +1,161 @@
+'''
+Benchmark of the inference backends (see predict.MODEL_BACKENDS) against
+the PyTorch weights: detection throughput, and how well the counts of
+each backend agree with the PyTorch counts on the same images.
+
+Usage:
+    python -m benchmarks.backends [IMAGES] [--model sgd]
+                                  [--backends onnx onnx-int8 openvino]
+                                  [--output backends.json]
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generatePlates
+from imagesource import VALID_EXTENSIONS, DirectoryImageSource, ZipImageSource
+from predict import (DEFAULT_BACKEND, DEFAULT_MODEL, MODEL_BACKENDS,
+                     ModelRegistry, exportModel, runDetection)
+
+
+def _detectCounts(workdir: str, detection_model, source,
+                  batch_size: int) -> tuple[float, dict]:
+    '''
+    Run detection on every image of `source`. Returns the wall time and
+    the (unfertilized, fertilized) counts of every image
+    '''
+    counts = {os.path.splitext(filename)[0]: (0, 0)
+              for filename in source.names()}
+
+    def onResult(filename, prediction, pred):
+        _, unfertilized, fertilized = prediction.split(' ')
+        counts[os.path.splitext(filename)[0]] = (
+            int(unfertilized), int(fertilized))
+
+    start = time.perf_counter()
+    runDetection(workdir, model=detection_model, source=source,
+                 batch_size=batch_size, in_memory=True,
+                 result_callback=onResult)
+    return time.perf_counter() - start, counts
+
+
+def countAgreement(counts: dict, baseline: dict) -> dict:
+    '''
+    Compare per image counts against the baseline counts of the same
+    images
+    '''
+    names = sorted(baseline)
+    values = np.array([counts[name] for name in names], dtype=float)
+    expected = np.array([baseline[name] for name in names], dtype=float)
+    difference = np.abs(values - expected)
+    total = expected.sum()
+    return dict(
+        exact_images=float(np.mean(np.all(difference == 0, axis=1))),
+        mean_abs_difference=dict(
+            unfertilized=float(difference[:, 0].mean()),
+            fertilized=float(difference[:, 1].mean())),
+        total_change=float(values.sum() / total - 1) if total else 0.0)
+
+
+def runBackends(workdir: str, source, model: str = DEFAULT_MODEL,
+                backends=MODEL_BACKENDS, batch_size: int = 8,
+                repeat: int = 1, calibration_data=None) -> dict:
+    '''
+    Time detection with each backend and compare its counts to those of
+    the PyTorch weights. Exports that don't exist yet are created first
+    (and timed separately). Returns the machine readable report
+    '''
+    backends = [DEFAULT_BACKEND] + [
+        backend for backend in backends if backend != DEFAULT_BACKEND]
+    images = len(source)
+    results = {}
+    baseline = None
+    for backend in backends:
+        result = dict()
+        if backend != DEFAULT_BACKEND:
+            start = time.perf_counter()
+            exportModel(model, backend, calibration_data)
+            result["export_seconds"] = time.perf_counter() - start
+        registry = ModelRegistry()
+        registry.setBackend(backend)
+        start = time.perf_counter()
+        detection_model = registry.get(model)
+        result["load_seconds"] = time.perf_counter() - start
+        # Warm up, so one time initialization isn't counted
+        first = source.names()[:1]
+        detection_model.predict(source=[source.loadArray(first[0])],
+                                save=False, verbose=False)
+        seconds = float("inf")
+        for _ in range(max(1, repeat)):
+            run_seconds, counts = _detectCounts(
+                workdir, detection_model, source, batch_size)
+            seconds = min(seconds, run_seconds)
+        result.update(seconds=seconds, items=images,
+                      items_per_second=images / seconds if seconds
+                      else float("inf"))
+        if baseline is None:
+            baseline = counts
+        else:
+            result["speedup"] = results[DEFAULT_BACKEND]["seconds"] / seconds
+            result["agreement"] = countAgreement(counts, baseline)
+        results[backend] = result
+
+    return dict(
+        meta=dict(
+            images=images, model=model, batch_size=batch_size,
+            repeat=repeat, python=platform.python_version(),
+            numpy=np.__version__, platform=platform.platform(),
+            cpu_count=os.cpu_count()),
+        backends=results)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0])
+    parser.add_argument("images", nargs="?",
+                        help="Folder or zip file of images to run on. "
+                             "Synthetic plates are used if not given, which "
+                             "only makes the timings meaningful")
+    parser.add_argument("--images-count", type=int, default=20,
+                        help="Number of synthetic plates")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--backends", nargs="+", choices=MODEL_BACKENDS,
+                        default=[backend for backend in MODEL_BACKENDS
+                                 if backend != DEFAULT_BACKEND])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per backend, the fastest one is reported")
+    parser.add_argument("--calibration-data",
+                        help="Dataset yaml to calibrate OpenVINO int8 "
+                             "exports on")
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.images is None:
+            generatePlates(tmpdir, args.images_count)
+            source = DirectoryImageSource(tmpdir, VALID_EXTENSIONS)
+        elif os.path.isdir(args.images):
+            source = DirectoryImageSource(args.images, VALID_EXTENSIONS)
+        else:
+            source = ZipImageSource(args.images, VALID_EXTENSIONS)
+        report = runBackends(tmpdir, source, args.model, args.backends,
+                             args.batch_size, args.repeat,
+                             args.calibration_data)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
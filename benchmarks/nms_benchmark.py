@@ -0,0 +1,93 @@
+'''
+Micro-benchmark of predict.non_max_suppression against the reference
+greedy_non_max_suppression on synthetic plate detections.
+
+Usage:
+    python -m benchmarks.nms_benchmark [--sizes 100 500 5000] [--repeat 5]
+'''
+import argparse
+import time
+
+import numpy as np
+
+from predict import greedy_non_max_suppression, non_max_suppression
+
+DEFAULT_SIZES = [100, 500, 5000]
+
+
+def syntheticBoxes(num_boxes: int, seed: int = 0):
+    '''
+    Generate `num_boxes` normalized [x1, y1, x2, y2] boxes clustered the
+    way YOLO reports embryos: a few jittered duplicates per embryo.
+    Returns (boxes, scores, class_labels)
+    '''
+    rng = np.random.default_rng(seed)
+    num_embryos = max(1, num_boxes // 3)
+    centers = rng.uniform(0.02, 0.98, size=(num_embryos, 2))
+    sizes = rng.uniform(0.01, 0.03, size=(num_embryos, 1))
+    owner = rng.integers(0, num_embryos, size=num_boxes)
+    jitter = rng.normal(0, 0.003, size=(num_boxes, 2))
+    box_centers = centers[owner] + jitter
+    half = sizes[owner] / 2
+    boxes = np.concatenate([box_centers - half, box_centers + half], axis=1)
+    scores = rng.uniform(0.25, 1.0, size=num_boxes)
+    class_labels = rng.integers(0, 2, size=num_boxes).astype(float)
+    return boxes, scores, class_labels
+
+
+def _timeIt(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmarkNMS(sizes=DEFAULT_SIZES, repeat: int = 5,
+                 iou_threshold: float = 0.5):
+    '''
+    Time both NMS implementations in class-agnostic and class-aware mode.
+    Returns one result dict per (size, mode)
+    '''
+    results = []
+    for num_boxes in sizes:
+        boxes, scores, class_labels = syntheticBoxes(num_boxes)
+        for class_agnostic in (True, False):
+            kwargs = dict(iou_threshold=iou_threshold,
+                          class_agnostic=class_agnostic,
+                          class_labels=class_labels)
+            ref_time, (_, ref_indices) = _timeIt(
+                lambda: greedy_non_max_suppression(boxes, scores, **kwargs),
+                repeat)
+            new_time, (_, new_indices) = _timeIt(
+                lambda: non_max_suppression(boxes, scores, **kwargs),
+                repeat)
+            results.append(dict(
+                boxes=num_boxes,
+                mode="agnostic" if class_agnostic else "per-class",
+                kept=len(new_indices),
+                reference_ms=ref_time * 1000,
+                new_ms=new_time * 1000,
+                speedup=ref_time / new_time if new_time else float("inf"),
+                identical=list(ref_indices) == list(new_indices)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--iou", type=float, default=0.5)
+    args = parser.parse_args()
+    print(f"{'boxes':>6} {'mode':>9} {'kept':>5} {'reference':>11} "
+          f"{'new':>10} {'speedup':>8} identical")
+    for row in benchmarkNMS(args.sizes, args.repeat, args.iou):
+        print(f"{row['boxes']:>6} {row['mode']:>9} {row['kept']:>5} "
+              f"{row['reference_ms']:>9.2f}ms {row['new_ms']:>8.2f}ms "
+              f"{row['speedup']:>7.1f}x {row['identical']}")
+
+
+if __name__ == '__main__':
+    main()
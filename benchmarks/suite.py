@@ -0,0 +1,289 @@
+'''
+Benchmark suite for the detection and annotation pipeline. Generates
+synthetic plates, times each stage separately and reports throughput and
+peak memory as JSON.
+
+Usage:
+    python -m benchmarks.suite [--images 20] [--embryos 100] [--model stub]
+                               [--preview [WIDTH]] [--annotation-format png]
+                               [--output results.json]
+                               [--baseline baseline.json --tolerance 0.15]
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic import generatePlates
+from boundingbox import (ANNOTATION_FORMATS, PREVIEW_WIDTH,
+                         addPredictionAnnotations, drawPredictions)
+from imagesource import DirectoryImageSource
+from instrumentation import Metrics
+from predict import (ModelRegistry, convert_to_corners,
+                     convert_to_yolo_format, countPredictions,
+                     filterPredictions, non_max_suppression, runDetection)
+from resultstore import ResultsStore, ResultsWriter
+from stubmodel import stubLoader
+
+STAGES = ["decode", "inference", "nms", "convert", "label_io",
+          "results_store", "draw", "encode", "detection_end_to_end",
+          "annotation_end_to_end"]
+
+
+def _measure(fn, items: int, repeat: int = 1,
+             trace_memory: bool = True) -> dict:
+    '''
+    Run `fn` `repeat` times and return its best wall time and throughput.
+    Peak memory is measured in one extra run under tracemalloc, so
+    tracing doesn't distort the timings
+    '''
+    seconds = float("inf")
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        fn()
+        seconds = min(seconds, time.perf_counter() - start)
+    result = dict(
+        seconds=seconds,
+        items=items,
+        items_per_second=items / seconds if seconds else float("inf"))
+    if trace_memory:
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_memory_mb"] = peak / 1024 ** 2
+    return result
+
+
+def _measureSpans(fn, stage: str, items: int, repeat: int = 1,
+                  trace_memory: bool = True) -> dict:
+    '''
+    Like `_measure`, for a stage that `fn` records in the `Metrics` it is
+    passed (e.g. "encode" in `drawPredictions`): reports the best total
+    wall time of that stage's spans, and their highest memory peak
+    '''
+    seconds = float("inf")
+    for _ in range(max(1, repeat)):
+        metrics = Metrics()
+        fn(metrics)
+        seconds = min(seconds, metrics.summary()[stage]["wall"])
+    result = dict(
+        seconds=seconds,
+        items=items,
+        items_per_second=items / seconds if seconds else float("inf"))
+    if trace_memory:
+        tracemalloc.start()
+        metrics = Metrics(trace_memory=True)
+        fn(metrics)
+        tracemalloc.stop()
+        peak = metrics.summary()[stage]["peak_bytes"] or 0
+        result["peak_memory_mb"] = peak / 1024 ** 2
+    return result
+
+
+def runSuite(workdir: str, images: int = 20, width: int = 2000,
+             height: int = 1500, embryos: int = 100, duplicates: int = 3,
+             model: str = "stub", batch_size: int = 8,
+             workers: int = 1, stages=STAGES, repeat: int = 1,
+             trace_memory: bool = True, preview_width=None,
+             image_format: str = "png") -> dict:
+    '''
+    Generate the synthetic plates in `workdir` and time each stage.
+    `model` is "stub" for the stand-in model, or a model name to run the
+    real weights. Annotated images are drawn at `preview_width` (full
+    resolution if None) and saved in `image_format`, as with
+    `drawPredictions`. Returns the machine readable report
+    '''
+    filenames = generatePlates(workdir, images, width, height, embryos,
+                               duplicates)
+    source = DirectoryImageSource(workdir)
+    labels_dir = os.path.join(workdir, 'predict', 'labels')
+    label_paths = [os.path.join(labels_dir,
+                                os.path.splitext(filename)[0] + '.txt')
+                   for filename in filenames]
+    raw_preds = [np.loadtxt(path) for path in label_paths]
+    filtered_preds = [filterPredictions(pred) for pred in raw_preds]
+    if model == "stub":
+        registry = ModelRegistry(loader=stubLoader(
+            boxes_per_image=embryos * duplicates))
+    else:
+        registry = ModelRegistry()
+    detection_model = registry.get(model)
+    decoded = []
+    results = {}
+
+    def decode():
+        decoded.clear()
+        for filename in filenames:
+            decoded.append(source.loadArray(filename))
+
+    def inference():
+        for start in range(0, len(decoded), batch_size):
+            batch = decoded[start:start + batch_size]
+            detection_model.predict(
+                source=batch, batch=len(batch), classes=[0, 1],
+                agnostic_nms=True, conf=0.25, max_det=500, save=False,
+                verbose=False)
+
+    def nms():
+        for pred in raw_preds:
+            boxes = convert_to_corners(pred)
+            non_max_suppression(boxes, pred[:, 5], iou_threshold=0.5,
+                                class_agnostic=True,
+                                class_labels=pred[:, 0])
+
+    def convert():
+        for pred in raw_preds:
+            boxes = convert_to_corners(pred)
+            convert_to_yolo_format(pred, boxes, np.arange(len(pred)))
+
+    def labelIO():
+        for path, pred in zip(label_paths, filtered_preds):
+            np.savetxt(path, pred, fmt='%f')
+            np.loadtxt(path)
+
+    store_path = os.path.join(workdir, 'predict', 'benchmark.bin')
+
+    def resultsStore():
+        with ResultsWriter(store_path) as writer:
+            for filename, pred in zip(filenames, filtered_preds):
+                writer.add(filename, pred, *countPredictions(pred))
+        with ResultsStore(store_path) as store:
+            for i in range(len(store)):
+                store.pred(i)
+
+    annotated_dir = os.path.join(workdir, 'predict', 'benchmark_annotated')
+    os.makedirs(annotated_dir, exist_ok=True)
+    draw_kwargs = dict(preview_width=preview_width, image_format=image_format)
+
+    def annotate(metrics):
+        # Timed per stage from the spans drawPredictions records
+        for filename, pred in zip(filenames, filtered_preds):
+            drawPredictions(source.path(filename), pred, annotated_dir,
+                            metrics=metrics, **draw_kwargs)
+
+    def detectionEndToEnd():
+        runDetection(workdir, model=detection_model, source=source,
+                     batch_size=batch_size, in_memory=True)
+
+    def annotationEndToEnd():
+        addPredictionAnnotations(workdir, workers=workers, source=source,
+                                 **draw_kwargs)
+
+    stage_functions = dict(
+        decode=decode, inference=inference, nms=nms, convert=convert,
+        label_io=labelIO, results_store=resultsStore,
+        detection_end_to_end=detectionEndToEnd,
+        annotation_end_to_end=annotationEndToEnd)
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if stage == "inference" and not decoded:
+            decode()
+        if stage in ("draw", "encode"):
+            results[stage] = _measureSpans(annotate, stage, len(filenames),
+                                           repeat, trace_memory)
+            continue
+        results[stage] = _measure(stage_functions[stage], len(filenames),
+                                  repeat, trace_memory)
+
+    return dict(
+        meta=dict(
+            images=images, width=width, height=height, embryos=embryos,
+            duplicates=duplicates, model=model, batch_size=batch_size,
+            workers=workers, repeat=repeat, preview_width=preview_width,
+            image_format=image_format, python=platform.python_version(),
+            numpy=np.__version__, platform=platform.platform(),
+            cpu_count=os.cpu_count()),
+        stages=results)
+
+
+def compareToBaseline(report: dict, baseline: dict,
+                      tolerance: float = 0.15) -> list[dict]:
+    '''
+    Compare stage timings against a baseline report. Returns the stages
+    that got more than `tolerance` (a fraction) slower
+    '''
+    regressions = []
+    for stage, result in report["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is None or not previous["seconds"]:
+            continue
+        change = result["seconds"] / previous["seconds"] - 1
+        result["change_vs_baseline"] = change
+        if change > tolerance:
+            regressions.append(dict(
+                stage=stage, baseline_seconds=previous["seconds"],
+                seconds=result["seconds"], change=change))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1500)
+    parser.add_argument("--embryos", type=int, default=100,
+                        help="Embryos per image")
+    parser.add_argument("--duplicates", type=int, default=3,
+                        help="Raw boxes reported per embryo before NMS")
+    parser.add_argument("--model", default="stub",
+                        help="'stub' or a model name to use the weights")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Annotation worker processes")
+    parser.add_argument("--preview", nargs="?", type=int,
+                        const=PREVIEW_WIDTH, metavar="WIDTH",
+                        help="Annotate downscaled to this width "
+                             f"(default: {PREVIEW_WIDTH})")
+    parser.add_argument("--annotation-format", default="png",
+                        choices=sorted(ANNOTATION_FORMATS))
+    parser.add_argument("--stages", nargs="+", default=STAGES,
+                        choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per stage, the fastest one is reported")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the extra traced run for peak memory")
+    parser.add_argument("--workdir",
+                        help="Directory for the synthetic plates "
+                             "(a temporary one by default)")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed slowdown vs the baseline (fraction)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report = runSuite(
+            args.workdir or tmpdir, args.images, args.width, args.height,
+            args.embryos, args.duplicates, args.model, args.batch_size,
+            args.workers, args.stages, args.repeat, not args.no_memory,
+            args.preview, args.annotation_format)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareToBaseline(
+                report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    for regression in regressions:
+        print("REGRESSION: {stage} {baseline_seconds:.3f}s -> "
+              "{seconds:.3f}s ({change:+.0%})".format(**regression),
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
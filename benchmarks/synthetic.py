@@ -0,0 +1,74 @@
+'''
+Synthetic plate images and YOLO label files for benchmarking.
+'''
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def syntheticPredictions(num_embryos: int, duplicates: int = 3,
+                         seed: int = 0) -> np.ndarray:
+    '''
+    Returns raw YOLO formatted predictions ([class, x_center, y_center,
+    width, height, confidence] rows, normalized) for `num_embryos` embryos,
+    each reported `duplicates` times with some jitter as the model does
+    before NMS
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0.03, 0.97, size=(num_embryos, 2))
+    sizes = rng.uniform(0.015, 0.03, size=(num_embryos, 1))
+    classes = rng.integers(0, 2, size=num_embryos)
+    owner = np.repeat(np.arange(num_embryos), duplicates)
+    num_boxes = len(owner)
+    pred = np.column_stack([
+        classes[owner],
+        centers[owner] + rng.normal(0, 0.002, size=(num_boxes, 2)),
+        sizes[owner] * rng.uniform(0.9, 1.1, size=(num_boxes, 2)),
+        rng.uniform(0.25, 1.0, size=num_boxes)]).astype(float)
+    return pred
+
+
+def drawPlate(width: int, height: int, pred: np.ndarray,
+              seed: int = 0) -> Image.Image:
+    '''
+    Draw a plate image with an embryo at each prediction
+    '''
+    rng = np.random.default_rng(seed)
+    background = rng.integers(150, 200, size=(height // 8 + 1,
+                                               width // 8 + 1, 3),
+                              dtype=np.uint8)
+    image = Image.fromarray(background).resize((width, height))
+    draw = ImageDraw.Draw(image)
+    for label, x_center, y_center, box_width, box_height, _ in pred:
+        box = (int((x_center - box_width / 2) * width),
+               int((y_center - box_height / 2) * height),
+               int((x_center + box_width / 2) * width),
+               int((y_center + box_height / 2) * height))
+        fill = (60, 40, 30) if label == 0 else (200, 170, 120)
+        draw.ellipse(box, fill=fill, outline=(20, 20, 20))
+    return image
+
+
+def generatePlates(directory: str, count: int = 20,
+                   width: int = 2000, height: int = 1500,
+                   embryos_per_image: int = 100, duplicates: int = 3,
+                   image_format: str = "jpg", seed: int = 0) -> list[str]:
+    '''
+    Write `count` synthetic plate images to `directory`, and their raw
+    label files to directory > predict > labels, the layout `runDetection`
+    produces. Returns the image file names
+    '''
+    labels_dir = os.path.join(directory, 'predict', 'labels')
+    os.makedirs(labels_dir, exist_ok=True)
+    filenames = []
+    for i in range(count):
+        name = f"plate_{i:05d}"
+        pred = syntheticPredictions(embryos_per_image, duplicates, seed + i)
+        # Draw each embryo once, from its first (unjittered) report
+        image = drawPlate(width, height, pred[::duplicates], seed + i)
+        filename = f"{name}.{image_format}"
+        image.save(os.path.join(directory, filename))
+        np.savetxt(os.path.join(labels_dir, f"{name}.txt"), pred, fmt='%f')
+        filenames.append(filename)
+    return filenames
@@ -1,8 +1,30 @@
+import contextlib
+import io
+import multiprocessing
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from PIL import Image, ImageDraw
+from imagesource import DirectoryImageSource, ImageSource
+from instrumentation import NULL_METRICS, Metrics
+from jobcontrol import JobControl
+from journal import RunJournal
+from memorybudget import MemoryBudget
+from resultstore import ResultsStore, resultsPath
 import typing
 from typing import Callable
 
+# File extension and encoder settings of each annotated image format
+ANNOTATION_FORMATS = dict(
+    png=(".png", dict()),
+    jpeg=(".jpg", dict(quality=85)),
+    webp=(".webp", dict(quality=80, method=0)),
+)
+# Default width of annotated image previews, enough to count eggs by eye
+PREVIEW_WIDTH = 1000
+LINE_WIDTH = 10
+# Box outline colors by label: green for label 0, purple for label 1
+BOX_COLORS = ((155, 255, 0), (255, 0, 255))
+
 
 def centerToBoundingBox(
     center_coords: tuple[int, int], size: tuple[int, int]
@@ -16,35 +38,63 @@ def centerToBoundingBox(
     return (top_left_x, top_left_y, bot_right_x, bot_right_y)
 
 
-def addPredictionAnnotations(pred_image_path,
-                             progress_callback: typing.Optional[Callable[[int], None]] = None):
-    # Create a prediction folder
-    annotated_image_path = os.path.join(
-        pred_image_path, 'predict', 'annotated_images')
-    os.makedirs(annotated_image_path, exist_ok=True)
+def annotationBytes(size: typing.Optional[tuple[int, int]],
+                    preview_width: typing.Optional[int] = None) -> int:
+    '''
+    Estimate the memory annotating an image of the given (width, height)
+    holds: the decoded image and the RGB copy that is drawn on, or the
+    preview it is scaled down to. Returns 0 if the size isn't known
+    '''
+    if size is None:
+        return 0
+    width, height = size
+    if preview_width and width > preview_width:
+        return width * height * 3 + preview_width * round(
+            height * preview_width / width) * 3
+    return width * height * 3 * 2
 
-    processed_images = 0
-    for image_path in os.listdir(pred_image_path):
-        if os.path.isdir(os.path.join(pred_image_path, image_path)):
-            continue
-        # Load the image
-        name = os.path.splitext(image_path)[0]
-        name = name.split("/")[-1]
-        image = Image.open(os.path.join(
-            pred_image_path, image_path)).convert("RGBA")
-        image_draw = ImageDraw.Draw(image, mode="RGBA")
-        image_width, image_height = image.size
-
-        # Load and parse the text file
-        coordinates_path = os.path.join(
-            pred_image_path, 'predict', 'labels', f'{name}.txt')
-        with open(coordinates_path, 'r') as file:
-            lines = file.readlines()
 
-        # Draw bounding boxes
-        for line in lines:
-            label, x_center, y_center, width, height, confidence = map(
-                float, line.strip().split())
+def drawPredictions(image_path, pred, annotated_image_path, name=None,
+                    metrics=NULL_METRICS, preview_width=None,
+                    image_format="png"):
+    '''
+    Draw YOLO formatted predictions ([class, x_center, y_center, width,
+    height, confidence] rows, normalized) onto the image at `image_path`,
+    and save it in `annotated_image_path` in `image_format` (one of
+    `ANNOTATION_FORMATS`).
+    `image_path` can also be the encoded image bytes, in which case
+    `name` must be given. With `preview_width` the image is decoded at
+    reduced size where the format allows it (JPEG) and drawn on at most
+    that width, which is much cheaper than annotating at full resolution.
+    Stage timings are recorded in `metrics`.
+    Returns the name of the annotated image
+    '''
+    # Load the image
+    if isinstance(image_path, bytes):
+        image_path = io.BytesIO(image_path)
+    else:
+        name = name or os.path.splitext(os.path.basename(image_path))[0]
+    with metrics.stage("annotation_decode", name):
+        image = Image.open(image_path)
+        full_width = image.width
+        if preview_width and image.width > preview_width:
+            preview_size = (preview_width, max(
+                1, round(image.height * preview_width / image.width)))
+            # Let the JPEG decoder skip detail at 1/2, 1/4 or 1/8 scale
+            image.draft("RGB", preview_size)
+            image = image.convert("RGB")
+            if image.width > preview_width:
+                image = image.resize(preview_size,
+                                     Image.Resampling.BILINEAR)
+        else:
+            image = image.convert("RGB")
+    image_draw = ImageDraw.Draw(image)
+    image_width, image_height = image.size
+    line_width = max(2, round(LINE_WIDTH * image_width / full_width))
+
+    # Draw bounding boxes
+    with metrics.stage("draw", name):
+        for label, x_center, y_center, width, height, confidence in pred:
             # Convert normalized coordinates to actual coordinates
             x_center = int(x_center * image_width)
             y_center = int(y_center * image_height)
@@ -53,13 +103,170 @@ def addPredictionAnnotations(pred_image_path,
             annotation_bounding_box = centerToBoundingBox(
                 (x_center, y_center), (box_width, box_height))
             # Draw the bounding box
-            # Green for label Fertilized, Purple for label unfertilized
-            color = (155, 255, 0) if label == 0 else (255, 0, 255)
+            color = BOX_COLORS[0] if label == 0 else BOX_COLORS[1]
             image_draw.rectangle(annotation_bounding_box,
-                                 outline=color, width=10)
+                                 outline=color, width=line_width)
+
+    extension, save_kwargs = ANNOTATION_FORMATS[image_format]
+    with metrics.stage("encode", name):
+        image.save(os.path.join(annotated_image_path, name + extension),
+                   **save_kwargs)
+    return name
+
+
+def annotateImage(image_path, coordinates_path, annotated_image_path,
+                  name=None, metrics=NULL_METRICS, preview_width=None,
+                  image_format="png"):
+    '''
+    Draw the bounding boxes from the label file at `coordinates_path` onto
+    the image at `image_path` (or encoded image bytes), and save it in
+    `annotated_image_path`, see `drawPredictions`.
+    Returns the name of the annotated image
+    '''
+    # Load and parse the text file
+    with metrics.stage("label_read", name):
+        with open(coordinates_path, 'r') as file:
+            pred = [tuple(map(float, line.strip().split()))
+                    for line in file if line.strip()]
+    return drawPredictions(image_path, pred, annotated_image_path, name,
+                           metrics, preview_width, image_format)
+
+
+def addPredictionAnnotations(pred_image_path,
+                             progress_callback: typing.Optional[Callable[[int], None]] = None,
+                             workers: int = 1,
+                             source: typing.Optional[ImageSource] = None,
+                             metrics: typing.Optional[Metrics] = None,
+                             journal: typing.Optional[RunJournal] = None,
+                             control: typing.Optional[JobControl] = None,
+                             output_dir=None,
+                             preview_width: typing.Optional[int] = None,
+                             image_format: str = "png",
+                             budget: typing.Optional[MemoryBudget] = None):
+    '''
+    Annotate every image in `pred_image_path` (or in `source` if given)
+    with its predicted bounding boxes, read from the results store that
+    `runDetection` writes (or from YOLO label files for results written
+    before there was a store). Annotated images are saved in `output_dir`,
+    by default at:
+        pred_image_path > predict > annotated_images > <image name>.png
+    With `preview_width` and a lossy `image_format` ("jpeg" or "webp"),
+    cheap downscaled previews are written instead (see `drawPredictions`).
+
+    With `workers` > 1 images are annotated in parallel on a process pool
+    of that size. `progress_callback` receives the number of images
+    annotated so far after each image is done. Stage timings are recorded
+    in `metrics` if given; images annotated on the process pool are
+    recorded as a single "annotate" span each. With a `journal`, each
+    annotated image is recorded in it, and images it already records are
+    skipped. With a `control` the job can be paused, resumed and
+    cancelled between images (see jobcontrol.py). With a `budget` (see
+    memorybudget.py), each image is reserved in it while it is annotated,
+    and no further images are started while it is used up
+    '''
+    # Create a prediction folder
+    annotated_image_path = output_dir or os.path.join(
+        pred_image_path, 'predict', 'annotated_images')
+    os.makedirs(annotated_image_path, exist_ok=True)
+    draw_kwargs = dict(preview_width=preview_width, image_format=image_format)
+    if metrics is None:
+        metrics = NULL_METRICS
+    if source is None:
+        source = DirectoryImageSource(pred_image_path)
+
+    store_path = resultsPath(pred_image_path)
+    # Older results only have the label files
+    with (ResultsStore(store_path) if os.path.isfile(store_path)
+          else contextlib.nullcontext()) as store:
+        def jobs():
+            for filename in source.names():
+                name = os.path.splitext(filename)[0]
+                labels_path = os.path.join(pred_image_path, 'predict',
+                                           'labels', f'{name}.txt')
+                if store is not None and store.index(name) is None:
+                    continue  # Not detected
+                if store is None and not os.path.isfile(labels_path):
+                    continue  # No detections, so no label file either
+                if journal is not None and name in journal.annotated:
+                    continue
+                nbytes = 0
+                if budget is not None:
+                    nbytes = annotationBytes(source.imageSize(filename),
+                                             preview_width)
+                # Images that aren't on disk are sent to the workers encoded
+                image = source.path(filename) or source.read(filename)
+                if store is None:
+                    yield annotateImage, (
+                        image, labels_path, annotated_image_path,
+                        name), nbytes
+                else:
+                    yield drawPredictions, (
+                        image, store.pred(name), annotated_image_path,
+                        name), nbytes
+
+        processed_images = 0
+        if workers <= 1:
+            for annotate, args, nbytes in jobs():
+                if control is not None:
+                    control.checkpoint()
+                if budget is not None:
+                    budget.acquire("annotate", nbytes)
+                try:
+                    name = annotate(*args, metrics=metrics, **draw_kwargs)
+                finally:
+                    if budget is not None:
+                        budget.release("annotate", nbytes)
+                if journal is not None:
+                    journal.recordAnnotation(name)
+                processed_images += 1
+                if progress_callback is not None:
+                    progress_callback(processed_images)
+            return
 
-        image.save(f"{annotated_image_path}/{name}.png")
-        processed_images += 1
+        def collect(futures):
+            nonlocal processed_images
+            for future in futures:
+                name = future.result()
+                if journal is not None:
+                    journal.recordAnnotation(name)
+                if metrics.enabled:
+                    metrics.record(dict(
+                        stage="annotate", image=name, start=started[future],
+                        wall=metrics.now() - started[future]))
+                    del started[future]
+                processed_images += 1
+                if progress_callback is not None:
+                    progress_callback(processed_images)
 
-        if progress_callback is not None:
-            progress_callback(processed_images)
+        # Keep at most two images per worker in flight so only those are
+        # held in memory
+        started = {}
+        # Spawned, as forking the multithreaded GUI process isn't safe
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            pending = set()
+            try:
+                for annotate, args, nbytes in jobs():
+                    if control is not None:
+                        control.checkpoint()
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    if budget is not None:
+                        budget.acquire("annotate", nbytes)
+                    future = executor.submit(annotate, *args, **draw_kwargs)
+                    if budget is not None:
+                        future.add_done_callback(
+                            lambda _, nbytes=nbytes: budget.release(
+                                "annotate", nbytes))
+                    started[future] = metrics.now()
+                    pending.add(future)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
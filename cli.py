@@ -0,0 +1,412 @@
+'''
+Headless command line entry point to run embryo detection (and optionally
+annotation) on a folder or zip file of images, without the GUI.
+
+Usage:
+    python cli.py IMAGES [--model sgd] [--annotate] [--format csv json] ...
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+import typing
+
+from boundingbox import ANNOTATION_FORMATS, PREVIEW_WIDTH
+from detectioncache import DetectionCache
+from imagesource import (VALID_EXTENSIONS, DirectoryImageSource,
+                         ZipImageSource)
+from instrumentation import Metrics
+from journal import RunJournal, journalPath
+from memorybudget import MemoryBudget
+from pipeline import runDetectionPipeline
+from sharding import runShardedDetection
+from predict import (DEFAULT_BACKEND, DEFAULT_MODEL, MODEL_BACKENDS,
+                     MODEL_WEIGHTS, runDetection, setModelBackend)
+from recount import MAX_IOU_THRESHOLD, RAW_CONF, Recounter
+from resultstore import ResultsStore, rawResultsPath, resultsPath
+from watch import watchFolder
+
+OUTPUT_FORMATS = ["txt", "csv", "json"]
+CSV_HEADERS = ["Image", "Unfertilized", "Fertilized"]
+
+
+def parseArgs(argv: typing.Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Count and classify fertilized vs unfertilized "
+                    "Xenopus laevis embryos")
+    parser.add_argument(
+        "images", help="Folder or zip file with the images to process")
+    parser.add_argument(
+        "-m", "--model", default=DEFAULT_MODEL,
+        choices=sorted(MODEL_WEIGHTS), help="Model to run (default: sgd)")
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory for the results. Defaults to the images folder, "
+             "or <zip name>_predictions next to a zip file")
+    parser.add_argument(
+        "--annotate", action="store_true",
+        help="Also save images annotated with the predicted boxes")
+    parser.add_argument(
+        "--annotation-format", default="png",
+        choices=sorted(ANNOTATION_FORMATS),
+        help="Image format of annotated images (default: png)")
+    parser.add_argument(
+        "--preview", nargs="?", type=int, const=PREVIEW_WIDTH, metavar="WIDTH",
+        help="Save annotated images downscaled to this width "
+             f"(default: {PREVIEW_WIDTH}), much faster than full resolution")
+    parser.add_argument(
+        "--format", nargs="+", default=["txt"], choices=OUTPUT_FORMATS,
+        help="Formats to write the per image counts in (default: txt)")
+    parser.add_argument(
+        "--labels", action="store_true",
+        help="Also export the detections as per image YOLO label files "
+             "(they are always stored in predict/detections.bin)")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Journal finished images, and skip the ones an interrupted "
+             "run with the same settings already finished")
+
+    watch = parser.add_argument_group("watch folder")
+    watch.add_argument(
+        "--watch", action="store_true",
+        help="Keep watching the IMAGES folder and detect new images as "
+             "they arrive, appending to the counts files (txt and csv)")
+    watch.add_argument("--poll-interval", type=float, default=1.0,
+                       help="Seconds between looks at the folder")
+    watch.add_argument("--settle-seconds", type=float, default=2.0,
+                       help="Seconds an image must stay unchanged before "
+                            "it counts as completely written")
+    watch.add_argument("--idle-timeout", type=float,
+                       help="Stop after this many seconds without new "
+                            "images (default: watch until interrupted)")
+
+    detection = parser.add_argument_group("detection settings")
+    detection.add_argument("--conf", type=float, default=0.25,
+                           help="Minimum detection confidence")
+    detection.add_argument("--iou", type=float, default=0.5,
+                           help="IoU threshold for non max suppression")
+    detection.add_argument("--max-det", type=int, default=500,
+                           help="Maximum detections per image")
+    detection.add_argument(
+        "--keep-raw", nargs="?", type=float, const=RAW_CONF, metavar="CONF",
+        help="Also keep the detections down to this confidence "
+             f"(default: {RAW_CONF}) in predict/raw_detections.bin, so "
+             "the run can be counted again with --recount")
+    detection.add_argument(
+        "--recount", action="store_true",
+        help="Don't run the model: count a run made with --keep-raw "
+             "again at --conf and --iou, rewriting its results")
+
+    performance = parser.add_argument_group("performance")
+    performance.add_argument("--batch-size", type=int, default=8,
+                             help="Images per model call")
+    performance.add_argument("--batch-memory-mb", type=float,
+                             help="Cap on decoded image memory per batch")
+    performance.add_argument("--memory-budget-mb", type=float,
+                             help="Cap on the memory held by decoded "
+                                  "images, batches and annotations at "
+                                  "once; stages wait while it is used up")
+    performance.add_argument("--processes", type=int, default=1,
+                             help="Split detection across this many "
+                                  "processes, each with its own model")
+    performance.add_argument("--workers", type=int,
+                             default=os.cpu_count() or 1,
+                             help="Annotation worker processes")
+    performance.add_argument("--tile-size", type=int,
+                             help="Run images larger than this in tiles")
+    performance.add_argument("--tile-overlap", type=float, default=0.2,
+                             help="Tile overlap as a fraction of tile size")
+    performance.add_argument("--tile-batch-mb", type=float, default=512,
+                             help="Cap on tile memory per model call")
+    performance.add_argument("--backend", choices=MODEL_BACKENDS,
+                             default=os.environ.get(
+                                 "FROGGLE_MODEL_BACKEND", DEFAULT_BACKEND),
+                             help="Inference backend; models are exported "
+                                  "on first use (default: torch)")
+    performance.add_argument("--server",
+                             help="Url of an inference server (server.py) "
+                                  "to use instead of loading the model")
+    performance.add_argument("--cache-dir",
+                             help="Reuse detections cached in this directory")
+    performance.add_argument("--trace",
+                             help="Write per stage timings to this file as a "
+                                  "Chrome trace (open in Perfetto)")
+    performance.add_argument("--trace-memory", action="store_true",
+                             help="Also record peak memory per stage "
+                                  "(slower)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Don't print progress")
+    args = parser.parse_args(argv)
+    if args.watch:
+        if "json" in args.format:
+            parser.error("--watch appends to the counts files, "
+                         "use --format txt and/or csv")
+        if (args.annotate or args.labels or args.resume
+                or args.processes > 1):
+            parser.error("--watch can't be combined with --annotate, "
+                         "--labels, --resume or --processes")
+    if args.keep_raw is not None and (args.watch or args.processes > 1):
+        parser.error("--keep-raw can't be combined with --watch "
+                     "or --processes")
+    if args.recount:
+        if args.watch or args.annotate or args.resume:
+            parser.error("--recount can't be combined with --watch, "
+                         "--annotate or --resume")
+        if args.iou > MAX_IOU_THRESHOLD:
+            parser.error("raw detections are kept after the model's own "
+                         f"NMS, --recount needs --iou {MAX_IOU_THRESHOLD} "
+                         "or lower")
+    return args
+
+
+def writeCounts(predictions: list[str], output_dir: str,
+                formats: list[str]) -> list[str]:
+    '''
+    Write "<name> <unfertilized> <fertilized>" count lines as csv and/or
+    json in the output directory. The txt format is written by
+    `runDetection` itself. Returns the paths written
+    '''
+    rows = [line.split(' ') for line in predictions]
+    written = []
+    if "csv" in formats:
+        path = os.path.join(output_dir, 'prediction_counts.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADERS)
+            writer.writerows(rows)
+        written.append(path)
+    if "json" in formats:
+        path = os.path.join(output_dir, 'prediction_counts.json')
+        with open(path, 'w') as f:
+            json.dump([dict(image=name,
+                            unfertilized=int(unfertilized),
+                            fertilized=int(fertilized))
+                       for name, unfertilized, fertilized in rows],
+                      f, indent=2)
+        written.append(path)
+    return written
+
+
+def printSummary(summary: dict):
+    '''
+    Print per stage totals from `Metrics.summary` as a table
+    '''
+    print(f"{'stage':<18}{'count':>7}{'wall s':>10}{'cpu s':>10}"
+          f"{'peak MB':>10}", file=sys.stderr)
+    for stage, totals in sorted(summary.items(),
+                                key=lambda item: -item[1]['wall']):
+        peak = totals['peak_bytes']
+        peak = f"{peak / 1024 ** 2:.1f}" if peak is not None else "-"
+        print(f"{stage:<18}{totals['count']:>7}{totals['wall']:>10.3f}"
+              f"{totals['cpu']:>10.3f}{peak:>10}", file=sys.stderr)
+
+
+def watch(args, images: str) -> int:
+    '''
+    Run `watchFolder` on the IMAGES folder with the command line settings
+    '''
+    if not os.path.isdir(images):
+        print(f"No such folder: {args.images}", file=sys.stderr)
+        return 1
+    output_dir = args.output or images
+
+    def onProgress(done: int):
+        if not args.quiet:
+            print(f"\rWatching {args.images}: {done} new images",
+                  end="", file=sys.stderr)
+
+    if not args.server:
+        setModelBackend(args.backend)
+    cache = DetectionCache(args.cache_dir) if args.cache_dir else None
+    budget = None
+    if args.memory_budget_mb:
+        budget = MemoryBudget(args.memory_budget_mb)
+    if not args.quiet:
+        print(f"Watching {args.images}, press Ctrl+C to stop",
+              file=sys.stderr)
+    try:
+        processed = watchFolder(
+            images, output_dir, model=args.model,
+            progress_callback=onProgress, formats=args.format,
+            poll_seconds=args.poll_interval,
+            settle_seconds=args.settle_seconds,
+            idle_seconds=args.idle_timeout,
+            batch_size=args.batch_size,
+            batch_memory_mb=args.batch_memory_mb,
+            in_memory=True,
+            tile_size=args.tile_size,
+            tile_overlap=args.tile_overlap,
+            tile_batch_mb=args.tile_batch_mb,
+            conf=args.conf,
+            iou_threshold=args.iou,
+            max_det=args.max_det,
+            cache=cache,
+            server_url=args.server,
+            budget=budget)
+    finally:
+        if cache is not None:
+            cache.close()
+    if not args.quiet:
+        print(f"\rStopped watching after {processed} new images, counts "
+              f"are in {os.path.join(output_dir, 'predict')}",
+              file=sys.stderr)
+        if budget is not None:
+            printBudgetReport(budget.report())
+    return 0
+
+
+def recount(args, output_dir: str) -> int:
+    '''
+    Count the raw detections a --keep-raw run kept again at the command
+    line thresholds, rewriting the results and counts files of the run
+    '''
+    raw_path = rawResultsPath(output_dir)
+    if not os.path.exists(raw_path):
+        print(f"No raw detections in {os.path.dirname(raw_path)}, "
+              "run with --keep-raw first", file=sys.stderr)
+        return 1
+    with Recounter(raw_path) as recounter:
+        predictions = recounter.write(output_dir, args.conf, args.iou)
+        num_images = len(recounter.names)
+    predict_dir = os.path.join(output_dir, 'predict')
+    if args.labels:
+        with ResultsStore(resultsPath(output_dir)) as store:
+            store.exportYOLOLabels(os.path.join(predict_dir, 'labels'))
+    written = writeCounts(predictions, predict_dir, args.format)
+    if not args.quiet:
+        print(f"Counted {num_images} images again at conf "
+              f"{args.conf:g} and IoU {args.iou:g}, {len(predictions)} "
+              "with detections", file=sys.stderr)
+        for path in [os.path.join(predict_dir, 'prediction_counts.txt')] + \
+                written:
+            print(f"Counts written to {path}", file=sys.stderr)
+    return 0
+
+
+def printBudgetReport(report: dict):
+    '''
+    Print the per stage queue depths and memory of a `MemoryBudget`
+    '''
+    limit = report['limit_bytes']
+    limit = f"{limit / 1024 ** 2:g} MB" if limit is not None else "none"
+    print(f"Memory budget: {limit}, peak "
+          f"{report['peak_bytes'] / 1024 ** 2:.1f} MB", file=sys.stderr)
+    print(f"{'stage':<18}{'items':>7}{'depth':>7}{'peak MB':>10}"
+          f"{'waited s':>10}", file=sys.stderr)
+    for stage, totals in report['stages'].items():
+        print(f"{stage:<18}{totals['items']:>7}{totals['peak_depth']:>7}"
+              f"{totals['peak_bytes'] / 1024 ** 2:>10.1f}"
+              f"{totals['blocked_seconds']:>10.3f}", file=sys.stderr)
+
+
+def main(argv: typing.Optional[list[str]] = None) -> int:
+    args = parseArgs(argv)
+    images = os.path.abspath(args.images)
+    if args.watch:
+        return watch(args, images)
+    metrics = None
+    if args.trace or args.trace_memory:
+        metrics = Metrics(trace_memory=args.trace_memory)
+    if os.path.isdir(images):
+        source = DirectoryImageSource(images, VALID_EXTENSIONS)
+        output_dir = args.output or images
+    elif os.path.isfile(images):
+        if metrics is not None:
+            with metrics.stage("zip_index"):
+                source = ZipImageSource(images, VALID_EXTENSIONS)
+        else:
+            source = ZipImageSource(images, VALID_EXTENSIONS)
+        output_dir = args.output or (
+            os.path.splitext(images)[0] + "_predictions")
+    else:
+        print(f"No such folder or zip file: {args.images}", file=sys.stderr)
+        return 1
+    if args.recount:
+        source.close()
+        return recount(args, output_dir)
+    total = len(source)
+    if total == 0:
+        print(f"No images found in {args.images}", file=sys.stderr)
+        return 1
+
+    def onProgress(done: int):
+        if not args.quiet:
+            print(f"\rDetecting: {done}/{total}", end="", file=sys.stderr)
+
+    def onAnnotated(prediction: str, done: int):
+        if not args.quiet:
+            print(f"\rDetected and annotated: {done}/{total}",
+                  end="", file=sys.stderr)
+
+    if not args.server:
+        setModelBackend(args.backend)
+    cache = DetectionCache(args.cache_dir) if args.cache_dir else None
+    journal = RunJournal(journalPath(output_dir)) if args.resume else None
+    budget = None
+    if args.memory_budget_mb or metrics is not None:
+        budget = MemoryBudget(args.memory_budget_mb)
+    detection_kwargs = dict(
+        model=args.model,
+        batch_size=args.batch_size,
+        batch_memory_mb=args.batch_memory_mb,
+        in_memory=True,
+        save_labels=args.labels,
+        tile_size=args.tile_size,
+        tile_overlap=args.tile_overlap,
+        tile_batch_mb=args.tile_batch_mb,
+        conf=args.conf,
+        iou_threshold=args.iou,
+        max_det=args.max_det,
+        cache=cache,
+        server_url=args.server,
+        source=source,
+        metrics=metrics,
+        journal=journal,
+        budget=budget,
+        raw_conf=args.keep_raw)
+    try:
+        if args.annotate:
+            predictions = runDetectionPipeline(
+                output_dir, progress_callback=onProgress,
+                annotation_callback=onAnnotated,
+                annotation_workers=args.workers,
+                detection_processes=args.processes,
+                preview_width=args.preview,
+                image_format=args.annotation_format, **detection_kwargs)
+        elif args.processes > 1:
+            predictions = runShardedDetection(
+                output_dir, progress_callback=onProgress,
+                processes=args.processes, **detection_kwargs)
+        else:
+            predictions = runDetection(
+                output_dir, progress_callback=onProgress,
+                **detection_kwargs)
+    finally:
+        if cache is not None:
+            cache.close()
+        if journal is not None:
+            journal.close()
+    if journal is not None:
+        journal.remove()
+    predict_dir = os.path.join(output_dir, 'predict')
+    written = writeCounts(predictions, predict_dir, args.format)
+    if "txt" in args.format:
+        written.insert(0, os.path.join(predict_dir, 'prediction_counts.txt'))
+    if not args.quiet:
+        print(f"\rProcessed {total} images, "
+              f"{len(predictions)} with detections", file=sys.stderr)
+        for path in written:
+            print(f"Counts written to {path}", file=sys.stderr)
+    if metrics is not None:
+        if args.trace:
+            metrics.exportChromeTrace(args.trace)
+        if not args.quiet:
+            printSummary(metrics.summary())
+    if budget is not None and not args.quiet:
+        printBudgetReport(budget.report())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+import numpy as np
+
+DEFAULT_MAX_CACHE_MB = 512
+
+
+class DetectionCache():
+    '''
+    Persistent cache of filtered detections, keyed by the image content
+    hash, the model and the detection settings. Entries are evicted least
+    recently used first once the cache grows past `max_mb` megabytes.
+
+    :param cache_dir: Directory holding the cache database
+    :param max_mb: Maximum total size of the cached detections
+    '''
+
+    def __init__(self, cache_dir: typing.Union[str, os.PathLike],
+                 max_mb: float = DEFAULT_MAX_CACHE_MB):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, 'detections.sqlite3'),
+            check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS detections ('
+                'key TEXT PRIMARY KEY, pred BLOB NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS detections_last_used '
+                'ON detections (last_used)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS stats ('
+                'name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        # Running total of the entry sizes, so puts don't have to sum them
+        self._size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM detections').fetchone()[0]
+
+    def __reduce__(self):
+        # Other processes open their own connection to the same database
+        return (DetectionCache, (self.cache_dir, self.max_bytes / 1024 ** 2))
+
+    @staticmethod
+    def key(image_bytes: bytes, model: str, **settings) -> str:
+        '''
+        Returns the cache key for an image's encoded bytes, the model label
+        and any detection settings that change the result
+        (e.g. conf, iou_threshold, max_det)
+        '''
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        settings_key = ','.join(
+            f'{name}={settings[name]}' for name in sorted(settings))
+        return f'{digest}:{model}:{settings_key}'
+
+    def get(self, key: str) -> typing.Optional[np.ndarray]:
+        '''
+        Returns the cached YOLO formatted predictions for a key,
+        or None on a miss
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT pred FROM detections WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._db:
+                self._db.execute(
+                    'UPDATE detections SET last_used = ? WHERE key = ?',
+                    (time.time(), key))
+        return np.frombuffer(row[0], dtype=np.float64).reshape(-1, 6).copy()
+
+    def put(self, key: str, pred: np.ndarray):
+        '''
+        Store the YOLO formatted predictions for a key, evicting the least
+        recently used entries if the cache grows too large
+        '''
+        blob = np.ascontiguousarray(pred, dtype=np.float64).tobytes()
+        size = len(blob) + len(key)
+        with self._lock, self._db:
+            replaced = self._db.execute(
+                'SELECT size FROM detections WHERE key = ?',
+                (key,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO detections '
+                '(key, pred, size, last_used) VALUES (?, ?, ?, ?)',
+                (key, blob, size, time.time()))
+            self._size += size - (replaced[0] if replaced else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Recounted, as other connections (e.g. in worker processes) may
+        # have added or evicted entries since
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM detections').fetchone()[0]
+        self._size = total
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            'SELECT key, size FROM detections ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._db.executemany('DELETE FROM detections WHERE key = ?', evicted)
+        self._size = total
+        self._db.execute(
+            'INSERT INTO stats (name, value) VALUES (\'evictions\', ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + ?',
+            (len(evicted), len(evicted)))
+
+    def addLookups(self, hits: int, misses: int):
+        '''
+        Count hits and misses of lookups made through another connection
+        to the cache, e.g. in a worker process
+        '''
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def flushStats(self):
+        '''
+        Add the hits and misses of this session to the persisted totals
+        '''
+        with self._lock, self._db:
+            for name, value in (('hits', self.hits),
+                                ('misses', self.misses)):
+                self._db.execute(
+                    'INSERT INTO stats (name, value) VALUES (?, ?) '
+                    'ON CONFLICT (name) DO UPDATE SET value = value + ?',
+                    (name, value, value))
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        '''
+        Returns hit/miss counts (this session and all time), evictions,
+        number of entries and total size in bytes
+        '''
+        with self._lock:
+            totals = dict(self._db.execute(
+                'SELECT name, value FROM stats').fetchall())
+            entries, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                'FROM detections').fetchone()
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                total_hits=totals.get('hits', 0) + self.hits,
+                total_misses=totals.get('misses', 0) + self.misses,
+                evictions=totals.get('evictions', 0),
+                entries=entries,
+                size_bytes=size,
+                max_bytes=self.max_bytes)
+
+    def clear(self):
+        '''
+        Remove all cached detections and statistics
+        '''
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM detections')
+            self._db.execute('DELETE FROM stats')
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def close(self, flush_stats: bool = True):
+        '''
+        Close the cache, adding the hits and misses of this session to the
+        persisted totals unless `flush_stats` is False (e.g. when they are
+        handed over with `addLookups`)
+        '''
+        if flush_stats:
+            self.flushStats()
+        self._db.close()
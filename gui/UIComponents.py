@@ -1,17 +1,18 @@
 import os
 import typing
-from PyQt6.QtCore import QSize
+from PyQt6.QtCore import QSize, Qt, pyqtSignal
 from PyQt6.QtWidgets import (
     QAbstractItemView,
     QHBoxLayout,
     QHeaderView,
     QVBoxLayout,
     QDialog, QDialogButtonBox,
-    QLabel, QTableWidget,
-    QTableWidgetItem, QWidget,
+    QLabel, QTableView, QWidget,
     QProgressBar)
 import qtawesome as qta
 
+from gui.predictiontable import PredictionTableModel
+
 
 class LabelWithIcon(QWidget):
 
@@ -86,23 +87,38 @@ class ProgressBar(QWidget):
             self.pbar.setVisible(True)
 
 
-class TableView(QTableWidget):
+class TableView(QTableView):
+    '''
+    Predictions table. Rows live in a columnar store behind a
+    `PredictionTableModel`, so only the visible cells are ever rendered,
+    and clicking a header sorts the rows
+    '''
+    cellClicked = pyqtSignal(int, int)
+
     def __init__(self, data, row, col):
         super(TableView, self).__init__()
-        self.setRowCount(row)
-        self.setColumnCount(col)
         self.setSelectionBehavior(
             QAbstractItemView.SelectionBehavior.SelectRows)
-        self._data = data
+        self._model = PredictionTableModel(data["headers"])
+        self.setModel(self._model)
         self._selected_row = 1
-        self.setData()
+        self.setData(data)
         self.setFixedWidth(400)
         self._resize()
+        # Keep detection order until a header is clicked
+        self.horizontalHeader().setSortIndicator(
+            -1, Qt.SortOrder.AscendingOrder)
+        self.setSortingEnabled(True)
+        self.clicked.connect(
+            lambda index: self.cellClicked.emit(index.row(), index.column()))
         self.show()
 
     def _resize(self):
-        self.resizeColumnsToContents()
-        self.resizeRowsToContents()
+        # Fixed row heights, so the view never measures the rows
+        vertical_header = self.verticalHeader()
+        if vertical_header:
+            vertical_header.setSectionResizeMode(
+                QHeaderView.ResizeMode.Fixed)
 
         header = self.horizontalHeader()
         if header:
@@ -111,31 +127,50 @@ class TableView(QTableWidget):
     def highlightRow(self, row: int):
         self.selectRow(row)
 
-    def setData(self):
-        for i, row in enumerate(self._data["rows"]):
-            for j, col in enumerate(row):
-                self.setItem(i, j, QTableWidgetItem(str(col)))
-        self.setHorizontalHeaderLabels(self._data["headers"])
+    def imageName(self, row: int) -> str:
+        '''
+        Returns the image name shown in the given row
+        '''
+        return self._model.rowValues(row)[0]
+
+    def findImageRow(self, name: str) -> typing.Optional[int]:
+        '''
+        Returns the row showing the image with the given name, if any
+        '''
+        store_row = self._model.store.index(name)
+        if store_row is None:
+            return None
+        return self._model.viewRow(store_row)
+
+    def setData(self, data):
+        self._model.setRows(data["rows"])
 
     def updateData(self, data):
-        self._data = data
-        num_rows = len(data["rows"])
-        num_cols = len(data["rows"][0])
-        self.setColumnCount(num_cols)
-        self.setRowCount(num_rows)
-        self.setData()
-        self._resize()
+        self.setData(data)
+
+    def appendRow(self, row: list[str]):
+        '''
+        Add a single row, at its sorted position if the table is sorted
+        '''
+        self._model.appendRow(row)
+
+    def clearRows(self):
+        '''
+        Remove all rows, keeping the headers
+        '''
+        self._model.clear()
 
     def toCSV(self, directory: typing.Union[str, os.PathLike]):
         '''
-        Save table data as a csv file in the given directory
+        Save table data as a csv file in the given directory, in the
+        order shown. Rows are written as they are read from the store
         '''
         DEFAULT_FILE_NAME = 'Egg_Counts.csv'
         with open(os.path.join(directory, DEFAULT_FILE_NAME), 'w+') as fo:
-            fo.writelines(",".join(self._data["headers"]))
+            fo.writelines(",".join(self._model.headers))
             fo.write("\n")
-            for row in self._data["rows"]:
-                fo.write(",".join(row) + "\n")
+            for name, unfertilized, fertilized in self._model.rows():
+                fo.write(f"{name},{unfertilized},{fertilized}\n")
 
 
 class CustomDialog(QDialog):
@@ -12,16 +12,24 @@ from PyQt6.QtWidgets import (
     QLabel,
     QPushButton,
     QSizePolicy,
+    QSlider,
     QVBoxLayout,
     QWidget,)
-from PyQt6.QtGui import QIcon, QMovie, QPixmap, QFont, QFontDatabase
+from PyQt6.QtGui import QIcon, QMovie, QFont, QFontDatabase
 
 from gui.UIComponents import CustomDialog, TableView, ProgressBar
+from gui.overlay import drawDetections
+from gui.pixmapcache import PixmapCache
+from jobcontrol import PRIORITY_INTERACTIVE
+from resultstore import ResultsStore, resultsPath
 import qtawesome as qta
 
 UPLOAD_BUTTON_DESC = "To get started, upload a zip file"
 UPLOAD_BUTTON_LABEL = "Upload Zip File"
 UPLOAD_BUTTON_TOOLTIP = "Select zip file with images"
+WATCH_BUTTON_LABEL = "Watch Folder"
+WATCH_BUTTON_TOOLTIP = "Detect images as they are saved into a folder"
+WATCH_STATUS_TEXT = "Watching {}: {} new images"
 RUN_MODEL_BUTTON_LABEL = "Run YOLO Predictions"
 MODEL_SELECTION_TEXT = "Selected model:"
 EXTRACT_PROGRESS_TEXT = "Extracting images..."
@@ -30,11 +38,31 @@ ANNOTATION_PROGRESS_TEXT = "Annotating images..."
 SLIDER_NEXT_LABEL = "Next >>>"
 SLIDER_PREV_LABEL = "<<< Prev"
 CSV_DOWNLOAD_BUTTON_LABEL = "Download as CSV"
+EXPORT_IMAGES_BUTTON_LABEL = "Export annotated images"
 SELECT_DIRECTORY_TEXT = "Select directory"
+PAUSE_BUTTON_LABEL = "Pause"
+RESUME_BUTTON_LABEL = "Resume"
+CANCEL_BUTTON_LABEL = "Cancel"
+CONF_SLIDER_LABEL = "Confidence"
+IOU_SLIDER_LABEL = "Overlap (IoU)"
+THRESHOLD_SLIDERS_TOOLTIP = "Count again at other thresholds, without " \
+    "running the model"
+THRESHOLDS_UNAVAILABLE_TEXT = "Runs split across processes " \
+    "(FROGGLE_DETECTION_PROCESSES) can't be counted again at other " \
+    "thresholds"
 
 
 class AppGUI(QWidget):
     ANNOTATED_IMG_SIZE = 500
+    # Scaled annotated images kept in memory, and neighbours of the shown
+    # image decoded ahead on each side
+    ANNOTATED_IMG_CACHE_SIZE = 32
+    ANNOTATED_IMG_PREFETCH = 2
+    # Most recent images kept in the carousel while watching a folder
+    WATCH_CAROUSEL_SIZE = 200
+    # Threshold slider ranges, in hundredths
+    CONF_SLIDER_RANGE = (5, 95)
+    IOU_SLIDER_RANGE = (10, 70)
     INTRO_TEXT = """
     <h2>Frog Embryo Counter </h2>
     <b>Count and classify fertilized vs unfertilized Xenopus laevis embryos</b>
@@ -72,17 +100,37 @@ class AppGUI(QWidget):
         self.intro_text = None
         self.run_model_button = None
         self.select_model_dropdown = None
+        self.job_controls = None
+        self.pause_button = None
 
         self.predictionResultsLoaded = False
         self.annotated_img_container = None
         self.annotated_label_container = None
         self.next_image_button = None
         self.prev_image_button = None
-        self.annotated_img_ct = 0
+        # File names of the images with detections, in detection order,
+        # their detections, and the carousel position of each image name
+        self.carousel_images = []
+        self.detections = {}
+        self.carousel_index = {}
+        # Images dropped from the front of the carousel once it holds
+        # twice this many, if set
+        self.carousel_limit = None
+        # Scaled original images; boxes are drawn over them when shown
+        self.pixmap_cache = PixmapCache(
+            AppGUI.ANNOTATED_IMG_SIZE, AppGUI.ANNOTATED_IMG_CACHE_SIZE,
+            threadpool=self.controller.threadpool,
+            priority=PRIORITY_INTERACTIVE,
+            read=self._readImage)
         self.extraction_progress = None
         self.pred_table = None
         self.detection_progress = None
         self.annotation_progress = None
+        self.watch_button = None
+        self.watch_status = None
+        self.threshold_sliders = None
+        self.conf_slider = None
+        self.iou_slider = None
 
         self._initUI()
 
@@ -163,6 +211,9 @@ class AppGUI(QWidget):
         upload_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         upload_button.setToolTip(UPLOAD_BUTTON_TOOLTIP)
         upload_button.clicked.connect(self.onUploadZipFile)
+        watch_button = QPushButton(WATCH_BUTTON_LABEL)
+        watch_button.setToolTip(WATCH_BUTTON_TOOLTIP)
+        watch_button.clicked.connect(self.onWatchFolder)
 
         model_selection_frame = QFrame()
         model_selection_layout = QHBoxLayout()
@@ -185,13 +236,32 @@ class AppGUI(QWidget):
         left_panel_layout.addWidget(upload_label)
         left_panel_layout.addWidget(
             upload_button, alignment=Qt.AlignmentFlag.AlignCenter)
+        left_panel_layout.addWidget(
+            watch_button, alignment=Qt.AlignmentFlag.AlignCenter)
         left_panel_layout.addWidget(
             model_selection_frame)
         left_panel_layout.addWidget(
             run_model_button, alignment=Qt.AlignmentFlag.AlignCenter)
+
+        job_controls = QFrame()
+        job_controls_layout = QHBoxLayout()
+        job_controls_layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        job_controls.setLayout(job_controls_layout)
+        pause_button = QPushButton(PAUSE_BUTTON_LABEL)
+        pause_button.clicked.connect(self.controller.togglePauseJob)
+        cancel_button = QPushButton(CANCEL_BUTTON_LABEL)
+        cancel_button.clicked.connect(self.controller.cancelJob)
+        for button in (pause_button, cancel_button):
+            button.setStyleSheet("min-width: 80px; max-width: 80px;")
+            job_controls_layout.addWidget(button)
+        job_controls.setVisible(False)
+        left_panel_layout.addWidget(job_controls)
+        self.job_controls = job_controls
+        self.pause_button = pause_button
         self.run_model_button = run_model_button
         self.select_model_dropdown = select_model_dropdown
         self.upload_button = upload_button
+        self.watch_button = watch_button
         self.left_panel = left_panel_layout
         self.toggleRunModelButton(False)
         return left_panel
@@ -234,7 +304,7 @@ class AppGUI(QWidget):
         if self.intro_text:
             self.intro_text.setVisible(False)
         self.addPredictionsTable()
-        self.initPredictionImages(self.controller.getWorkingDirectory())
+        self.loadStoredDetections()
 
     def _initFonts(self):
         '''
@@ -284,18 +354,25 @@ class AppGUI(QWidget):
     def addPredictionsTable(self, data: typing.Optional[list[str]] = None):
         '''
         Display prediction counts on the UI.
-        If "data" parameter is not provided, counts is expected at:
+        If "data" parameter is not provided, counts are read from the
+        results store at:
+            "working directory" > test_images > predict > detections.bin
+        or from the counts file of older results at:
             "working directory" > test_images > predict > prediction_counts.txt
         '''
         prediction_counts_dir = self.controller.getWorkingDirectory()
         if data is None:
+            images_dir = os.path.join(prediction_counts_dir, 'test_images')
             counts_file_path = os.path.join(
-                prediction_counts_dir, 'test_images',
-                'predict', 'prediction_counts.txt')
-            if not os.path.isfile(counts_file_path):
+                images_dir, 'predict', 'prediction_counts.txt')
+            if os.path.isfile(resultsPath(images_dir)):
+                with ResultsStore(resultsPath(images_dir)) as store:
+                    data = store.countLines()
+            elif os.path.isfile(counts_file_path):
+                with open(counts_file_path, 'r') as f:
+                    data = f.readlines()
+            else:
                 return
-            with open(counts_file_path, 'r') as f:
-                data = f.readlines()
         table_data = dict(
             rows=list(map(lambda line: line.strip().split(' '), data)),
             headers=["Image", "Unfertilized", "Fertilized"])
@@ -306,16 +383,181 @@ class AppGUI(QWidget):
             self.download_csv_button = QPushButton(
                 text=CSV_DOWNLOAD_BUTTON_LABEL)
             self.download_csv_button.clicked.connect(self._saveTableAsCSV)
+            self.export_images_button = QPushButton(
+                text=EXPORT_IMAGES_BUTTON_LABEL)
+            self.export_images_button.clicked.connect(
+                self._exportAnnotatedImages)
             if self.left_panel:
                 self.left_panel.addWidget(
                     self.download_csv_button,
                     alignment=Qt.AlignmentFlag.AlignCenter)
+                self.left_panel.addWidget(
+                    self.export_images_button,
+                    alignment=Qt.AlignmentFlag.AlignCenter)
                 self.left_panel.addWidget(
                     self.pred_table,
                     alignment=Qt.AlignmentFlag.AlignLeft,
                 )
             self.pred_table.cellClicked.connect(self._onPredictionsTableClick)
 
+    def appendPrediction(self, prediction: str):
+        '''
+        Add the counts of a single image ("<name> <unfertilized>
+        <fertilized>") to the predictions table, creating the table
+        if needed
+        '''
+        if self.pred_table is None:
+            self.addPredictionsTable(data=[prediction])
+        else:
+            self.pred_table.appendRow(prediction.strip().split(' '))
+
+    def addDetection(self, filename: str, pred):
+        '''
+        Add an image with its YOLO formatted predictions to the carousel,
+        showing the carousel if this is the first image
+        '''
+        if filename not in self.detections:
+            self.carousel_index[os.path.splitext(filename)[0]] = len(
+                self.carousel_images)
+            self.carousel_images.append(filename)
+        self.detections[filename] = pred
+        if (self.carousel_limit is not None and
+                len(self.carousel_images) > 2 * self.carousel_limit):
+            self._trimCarousel()
+        self.initPredictionImages()
+
+    def _trimCarousel(self):
+        '''
+        Drop the oldest images from the carousel, keeping the most recent
+        `carousel_limit`, so a long watch doesn't hold on to every image
+        '''
+        dropped = len(self.carousel_images) - self.carousel_limit
+        for filename in self.carousel_images[:dropped]:
+            del self.detections[filename]
+        self.carousel_images = self.carousel_images[dropped:]
+        self.carousel_index = {
+            os.path.splitext(filename)[0]: idx
+            for idx, filename in enumerate(self.carousel_images)}
+        if self.annotated_img_container is not None:
+            self.annotated_img_idx = max(0, self.annotated_img_idx - dropped)
+
+    def loadStoredDetections(self):
+        '''
+        Add the detections of the last run, read from the results store
+        at:
+            "working directory" > test_images > predict > detections.bin
+        to the carousel
+        '''
+        source = self.controller.getImageSource()
+        store_path = resultsPath(os.path.join(
+            self.controller.getWorkingDirectory(), 'test_images'))
+        if source is None or not os.path.isfile(store_path):
+            return
+        filenames = {os.path.splitext(filename)[0]: filename
+                     for filename in source.names()}
+        with ResultsStore(store_path) as store:
+            for image_id, name in enumerate(store.names):
+                pred = store.pred(image_id)
+                if len(pred) and name in filenames:
+                    self.addDetection(filenames[name], pred)
+
+    def setCarouselDetections(self, detections: typing.Mapping):
+        '''
+        Replace the images of the carousel with the ones in `detections`
+        (file names to YOLO formatted predictions, in detection order),
+        e.g. after counting again at other thresholds. Keeps showing the
+        current image if it is still there
+        '''
+        shown = None
+        if self.annotated_img_container is not None and \
+                0 <= self.annotated_img_idx < len(self.carousel_images):
+            shown = self.carousel_images[self.annotated_img_idx]
+        self.carousel_limit = None
+        self.carousel_images = list(detections)
+        self.detections = detections
+        self.carousel_index = {
+            os.path.splitext(filename)[0]: idx
+            for idx, filename in enumerate(self.carousel_images)}
+        self.initPredictionImages()
+        if self.annotated_img_container is None:
+            return
+        if self.carousel_images:
+            idx = self.carousel_index.get(
+                os.path.splitext(shown)[0], 0) if shown else 0
+            self.selectPredictionImage(idx)
+        else:
+            self.annotated_img_container.clear()
+            self.annotated_label_container.setText("")
+
+    def showThresholdSliders(self, conf: float, iou_threshold: float,
+                             visible: bool = True, enabled: bool = True):
+        '''
+        Show/Hide the confidence and IoU threshold sliders, which count the
+        images of the last run again as they are moved. Disabled, they
+        only show the thresholds of the last run, with a note on why they
+        can't be moved
+        '''
+        if self.threshold_sliders is None:
+            if not visible:
+                return
+            self.threshold_sliders = QWidget()
+            self.threshold_sliders.setToolTip(THRESHOLD_SLIDERS_TOOLTIP)
+            sliders_layout = QVBoxLayout(self.threshold_sliders)
+            self.conf_slider = self._addThresholdSlider(
+                sliders_layout, CONF_SLIDER_LABEL, AppGUI.CONF_SLIDER_RANGE)
+            self.iou_slider = self._addThresholdSlider(
+                sliders_layout, IOU_SLIDER_LABEL, AppGUI.IOU_SLIDER_RANGE)
+            self.thresholds_unavailable = QLabel(THRESHOLDS_UNAVAILABLE_TEXT)
+            self.thresholds_unavailable.setWordWrap(True)
+            sliders_layout.addWidget(self.thresholds_unavailable)
+            if self.left_panel:
+                self.left_panel.addWidget(self.threshold_sliders)
+        for slider, value in ((self.conf_slider, conf),
+                              (self.iou_slider, iou_threshold)):
+            # Moved without counting again
+            slider.blockSignals(True)
+            slider.setValue(round(value * 100))
+            slider.blockSignals(False)
+            slider.value_label.setText(f"{slider.value() / 100:.2f}")
+            slider.setEnabled(enabled)
+        self.thresholds_unavailable.setVisible(not enabled)
+        self.threshold_sliders.setVisible(visible)
+
+    def _addThresholdSlider(self, layout, label: str,
+                            value_range: tuple[int, int]) -> QSlider:
+        row = QHBoxLayout()
+        slider = QSlider(Qt.Orientation.Horizontal)
+        slider.setRange(*value_range)
+        slider.value_label = QLabel()
+        slider.valueChanged.connect(self._onThresholdChange)
+        row.addWidget(QLabel(label))
+        row.addWidget(slider, stretch=1)
+        row.addWidget(slider.value_label)
+        layout.addLayout(row)
+        return slider
+
+    @pyqtSlot(int)
+    def _onThresholdChange(self, _):
+        conf = self.conf_slider.value() / 100
+        iou_threshold = self.iou_slider.value() / 100
+        self.conf_slider.value_label.setText(f"{conf:.2f}")
+        self.iou_slider.value_label.setText(f"{iou_threshold:.2f}")
+        self.controller.recount(conf, iou_threshold)
+
+    def resetPredictions(self, carousel_limit: typing.Optional[int] = None):
+        '''
+        Clear the predictions of a previous run before starting a new one.
+        With a `carousel_limit`, the carousel only keeps about that many
+        of the most recent images
+        '''
+        if self.pred_table is not None:
+            self.pred_table.clearRows()
+        self.carousel_limit = carousel_limit
+        self.carousel_images = []
+        self.detections = {}
+        self.carousel_index = {}
+        self.pixmap_cache.clear()
+
     @pyqtSlot(int)
     def _onModelSelectionChange(self, idx):
         '''
@@ -331,7 +573,9 @@ class AppGUI(QWidget):
         '''
         if self.pred_table:
             self.pred_table.selectRow(row)
-            self.selectPredictionImage(row)
+            idx = self.carousel_index.get(self.pred_table.imageName(row))
+            if idx is not None:
+                self.selectPredictionImage(idx)
 
     @ pyqtSlot()
     def _saveTableAsCSV(self):
@@ -339,27 +583,28 @@ class AppGUI(QWidget):
         if self.pred_table:
             self.pred_table.toCSV(saveDirectory)
 
-    def initPredictionImages(
-            self,
-            parent_directory: typing.Union[str, os.PathLike]
-    ):
+    @ pyqtSlot()
+    def _exportAnnotatedImages(self):
         '''
-        Initialize the slider on the right panel to show
-        annotated images. This includes the image container,
+        Write full resolution annotated images to a selected directory.
+        The carousel only draws boxes over scaled down images on screen
+        '''
+        saveDirectory = self.openDirectorySelectDialog()
+        if saveDirectory:
+            self.controller.annotateImagesWithPredictions(
+                output_dir=saveDirectory)
+
+    def initPredictionImages(self):
+        '''
+        Initialize the slider on the right panel to show images with
+        their detections. This includes the image container,
         the label for the image,
         and the prev and next buttons to switch between images
         '''
-        if self.annotated_img_container is None:
-            annotated_directory = os.path.join(
-                parent_directory, 'test_images', 'predict', 'annotated_images')
-            if not os.path.isdir(annotated_directory):
-                return
-
-            self.annotated_dir = annotated_directory
+        if self.annotated_img_container is None and self.carousel_images:
             self.annotated_img_container = QLabel()
             self.annotated_label_container = QLabel()
             self.annotated_img_idx = -1
-            self.annotated_img_ct = 1
             self._nextPredictionImage()
             nav_button_group = QHBoxLayout()
 
@@ -377,73 +622,97 @@ class AppGUI(QWidget):
             self.prev_image_button = prev_image_button
             self.next_image_button = next_image_button
 
-    def updateAnnotatedImageCount(self, count: int):
-        '''
-        Add prediction images to the UI generated at:
-            parent_directory > test_images > predict > annotated_images
-        '''
-        self.annotated_img_ct = count
-
     @ pyqtSlot()
     def _nextPredictionImage(self):
         '''
-        Load the next image in the annotated_dir directory onto the slider
+        Load the next image with detections onto the slider
         '''
-        idx = (self.annotated_img_idx + 1) % self.annotated_img_ct
-        self.selectPredictionImage(idx)
+        if self.carousel_images:
+            self.selectPredictionImage(
+                (self.annotated_img_idx + 1) % len(self.carousel_images))
 
     @ pyqtSlot()
     def _prevPredictionImage(self):
         '''
-        Load the previous image in the annotated_dir directory onto the slider
+        Load the previous image with detections onto the slider
         '''
-        idx = (self.annotated_img_idx -
-               1) if self.annotated_img_idx > 0 else self.annotated_img_ct - 1
-        self.selectPredictionImage(idx)
+        if self.carousel_images:
+            self.selectPredictionImage(
+                (self.annotated_img_idx - 1) % len(self.carousel_images))
+
+    def _readImage(self, filename: str) -> typing.Union[str, bytes]:
+        '''
+        Returns the path of an uploaded image, or its bytes if it is only
+        in the zip file. Called off the UI thread by the pixmap cache
+        '''
+        source = self.controller.getImageSource()
+        return source.path(filename) or source.read(filename)
 
     def selectPredictionImage(self, idx):
         '''
-        Set the prediction image shown on the carousel to the one
-        at position `idx` in the annotated images directory
+        Set the image shown on the carousel to the one at position `idx`
+        in detection order, drawing its detections over the scaled
+        original image, and start decoding its neighbours in the
+        background
 
         Additionally highlights the corresponding row on the prediction table
         if the table has been initialized
         '''
-        self.annotated_img_idx = idx
-        if idx >= self.annotated_img_ct:
+        if idx >= len(self.carousel_images):
             return
-        for image_path in os.listdir(self.annotated_dir):
-            _, image_extension = os.path.splitext(image_path)
-            if (os.path.isdir(image_path) or
-                    image_extension not
-                    in self.controller.getValidExtensions()):
-                continue
-            if idx > 0:
-                idx -= 1
-                continue
-            if self.annotated_label_container:
-                self.annotated_label_container.setText(
-                    f"#{self.annotated_img_idx+1}: {image_path}")
-            if self.annotated_img_container:
-                self.annotated_img_container.setPixmap(QPixmap(os.path.join(
-                    self.annotated_dir, image_path)).scaledToWidth(
-                        AppGUI.ANNOTATED_IMG_SIZE))
-            break
+        self.annotated_img_idx = idx
+        image_name = self.carousel_images[idx]
+        if self.annotated_label_container:
+            self.annotated_label_container.setText(
+                f"#{idx+1}: {image_name}")
+        if self.annotated_img_container:
+            self.annotated_img_container.setPixmap(drawDetections(
+                self.pixmap_cache.get(image_name),
+                self.detections[image_name]))
+        count = len(self.carousel_images)
+        neighbours = []
+        for offset in range(1, AppGUI.ANNOTATED_IMG_PREFETCH + 1):
+            neighbours.append((idx + offset) % count)
+            neighbours.append((idx - offset) % count)
+        self.pixmap_cache.prefetch(
+            [self.carousel_images[neighbour] for neighbour in neighbours
+             if neighbour != idx])
         if self.pred_table:
-            self.pred_table.highlightRow(self.annotated_img_idx)
+            row = self.pred_table.findImageRow(
+                os.path.splitext(image_name)[0])
+            if row is not None:
+                self.pred_table.highlightRow(row)
 
     def toggleUploadButton(self, enable=None):
         '''
-        Enable/Disable the "Upload images" button on the UI
+        Enable/Disable the "Upload images" and "Watch Folder" buttons on
+        the UI
         '''
         if enable is None:
             enable = not self.upload_button
-        if self.upload_button:
-            self.upload_button.setEnabled(enable)
-            if enable:
-                self.upload_button.setStyleSheet("background-color:#fff")
-            else:
-                self.upload_button.setStyleSheet("background-color:gray")
+        for button in (self.upload_button, self.watch_button):
+            if button:
+                button.setEnabled(enable)
+                if enable:
+                    button.setStyleSheet("background-color:#fff")
+                else:
+                    button.setStyleSheet("background-color:gray")
+
+    def showJobControls(self, visible=True):
+        '''
+        Show/Hide the pause and cancel buttons of the running job
+        '''
+        if self.job_controls:
+            self.job_controls.setVisible(visible)
+        self.setJobPaused(False)
+
+    def setJobPaused(self, paused):
+        '''
+        Label the pause button according to the job's state
+        '''
+        if self.pause_button:
+            self.pause_button.setText(
+                RESUME_BUTTON_LABEL if paused else PAUSE_BUTTON_LABEL)
 
     def toggleRunModelButton(self, enable=None):
         '''
@@ -486,9 +755,26 @@ class AppGUI(QWidget):
     def onUploadZipFile(self):
         self.openFileNameDialog()
 
-    def showAnnotationProgress(self, progress):
+    def onWatchFolder(self):
+        directory = self.openDirectorySelectDialog()
+        if directory:
+            self.controller.watchFolder(directory)
+
+    def showWatchStatus(self, directory: str, count: int):
+        '''
+        Initialize or update the status of a folder watch
+        '''
+        if not self.watch_status:
+            self.watch_status = QLabel()
+            if self.left_panel:
+                self.left_panel.addWidget(self.watch_status)
+        self.watch_status.setText(
+            WATCH_STATUS_TEXT.format(os.path.basename(directory), count))
+
+    def showAnnotationProgress(self, progress,
+                               progress_count: typing.Optional[int] = None):
         '''
-        Initialize or update the image annotation progress
+        Initialize or update the image annotation (export) progress
         '''
         if not self.annotation_progress:
             self.annotation_progress = ProgressBar(
@@ -499,14 +785,12 @@ class AppGUI(QWidget):
                 self.left_panel.addWidget(self.annotation_progress)
         self.annotation_progress.setProgress(
             progress,
-            progress_count=self.annotated_img_ct,
+            progress_count=progress_count,
             total_count=self.controller.getImageCount())
 
     def showDetectionProgress(self, progress):
         '''
-        Initialize or update the egg detection progress.
-        Additionally, reset the annotation progress if detection has just
-        been started
+        Initialize or update the egg detection progress
         '''
         if not self.detection_progress:
             self.detection_progress = ProgressBar(
@@ -521,9 +805,6 @@ class AppGUI(QWidget):
             progress,
             progress_count=num_images_done,
             total_count=self.controller.getImageCount())
-        if self.annotation_progress and progress == 0:
-            self.updateAnnotatedImageCount(0)
-            self.showAnnotationProgress(0)
 
     def showImageExtractionProgress(self, progress):
         '''
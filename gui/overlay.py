@@ -0,0 +1,38 @@
+import numpy as np
+from PyQt6.QtCore import QRectF
+from PyQt6.QtGui import QColor, QPainter, QPen, QPixmap
+
+from boundingbox import BOX_COLORS
+
+LINE_WIDTH = 2
+
+
+def drawDetections(pixmap: QPixmap, pred: np.ndarray,
+                   line_width: int = LINE_WIDTH) -> QPixmap:
+    '''
+    Returns a copy of `pixmap` with the YOLO formatted predictions
+    ([class, x_center, y_center, width, height, confidence] rows,
+    normalized) drawn on top as box outlines, colored by class like the
+    annotated images `drawPredictions` writes. Boxes are drawn at the
+    pixmap's resolution, so this is cheap enough to do every time an
+    image is shown
+    '''
+    overlay = pixmap.copy()
+    if pred is None or len(pred) == 0 or overlay.isNull():
+        return overlay
+    pred = np.asarray(pred).reshape(-1, 6)
+    scale = np.array([overlay.width(), overlay.height()])
+    corners = (pred[:, 1:3] - pred[:, 3:5] / 2) * scale
+    sizes = pred[:, 3:5] * scale
+    rects = np.hstack([corners, sizes]).tolist()
+    # Labels other than 0 share the second color, as in drawPredictions
+    labels = np.minimum(pred[:, 0], len(BOX_COLORS) - 1)
+
+    painter = QPainter(overlay)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    for label, color in enumerate(BOX_COLORS):
+        painter.setPen(QPen(QColor(*color), line_width))
+        painter.drawRects([QRectF(*rects[i])
+                           for i in np.flatnonzero(labels == label)])
+    painter.end()
+    return overlay
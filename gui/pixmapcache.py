@@ -0,0 +1,142 @@
+import os
+import typing
+from collections import OrderedDict
+from typing import Callable
+
+from PyQt6.QtCore import (QBuffer, QByteArray, QObject, QRunnable, QSize,
+                          QThreadPool, Qt, pyqtSignal, pyqtSlot)
+from PyQt6.QtGui import QImage, QImageReader, QPixmap
+
+
+def loadScaledImage(image: typing.Union[str, os.PathLike, bytes],
+                    width: int) -> QImage:
+    '''
+    Decode the image at path `image` (or encoded image bytes) scaled to
+    `width` (keeping its aspect ratio). Only uses QImage, so it is safe to
+    call off the UI thread
+    '''
+    if isinstance(image, bytes):
+        buffer = QBuffer()
+        buffer.setData(QByteArray(image))
+        reader = QImageReader(buffer)
+    else:
+        reader = QImageReader(os.fspath(image))
+    size = reader.size()
+    if size.isValid() and size.width() > width:
+        reader.setScaledSize(QSize(
+            width, max(1, round(size.height() * width / size.width()))))
+    image = reader.read()
+    if not image.isNull() and image.width() != width:
+        image = image.scaledToWidth(
+            width, Qt.TransformationMode.SmoothTransformation)
+    return image
+
+
+class _PrefetchSignals(QObject):
+    loaded = pyqtSignal(str, int, QImage)
+
+
+class _PrefetchJob(QRunnable):
+
+    def __init__(self, key: str, read: Callable, width: int,
+                 generation: int, signals: _PrefetchSignals):
+        super().__init__()
+        self.key = key
+        self.read = read
+        self.generation = generation
+        self.width = width
+        self.signals = signals
+
+    @pyqtSlot()
+    def run(self):
+        self.signals.loaded.emit(self.key, self.generation,
+                                 loadScaledImage(self.read(self.key),
+                                                 self.width))
+
+
+class PixmapCache(QObject):
+    '''
+    Bounded LRU cache of pixmaps pre-scaled to a fixed width, with a
+    background prefetcher. Images are decoded and scaled as QImages on
+    a thread pool and only converted to pixmaps on the UI thread, so
+    browsing through cached images never decodes on the UI thread
+
+    :param width: Width the pixmaps are scaled to
+    :param max_items: Number of pixmaps to keep
+    :param threadpool: Threadpool to decode on, a private one with two
+                threads if not given
+    :param priority: Threadpool priority of the decoding jobs
+    :param read: Returns the path or encoded bytes of the image a key
+                refers to, e.g. to read images out of a zip file. Keys
+                are image paths if not given. Called on the threadpool
+    '''
+
+    def __init__(self, width: int, max_items: int = 32,
+                 threadpool: typing.Optional[QThreadPool] = None,
+                 priority: int = 0,
+                 read: typing.Optional[Callable[
+                     [str], typing.Union[str, bytes]]] = None):
+        super().__init__()
+        self.width = width
+        self.read = read or (lambda key: key)
+        self.max_items = max(1, max_items)
+        self.priority = priority
+        self._pixmaps = OrderedDict()
+        self._pending = set()
+        self._generation = 0
+        if threadpool is None:
+            threadpool = QThreadPool()
+            threadpool.setMaxThreadCount(2)
+        self._threadpool = threadpool
+        self._signals = _PrefetchSignals()
+        self._signals.loaded.connect(self._onLoaded)
+
+    def get(self, key: str) -> QPixmap:
+        '''
+        Returns the scaled pixmap of the image `key` refers to, decoding
+        it right away if it isn't cached yet
+        '''
+        pixmap = self._pixmaps.get(key)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(key)
+            return pixmap
+        pixmap = QPixmap.fromImage(
+            loadScaledImage(self.read(key), self.width))
+        self._store(key, pixmap)
+        return pixmap
+
+    def prefetch(self, keys: list[str]):
+        '''
+        Decode the images `keys` refer to in the background, unless they
+        are cached or already being decoded
+        '''
+        for key in keys:
+            if key in self._pixmaps or key in self._pending:
+                continue
+            self._pending.add(key)
+            self._threadpool.start(
+                _PrefetchJob(key, self.read, self.width, self._generation,
+                             self._signals), self.priority)
+
+    def clear(self):
+        '''
+        Drop all cached pixmaps, e.g. when the images are rewritten.
+        Prefetches still running are discarded when they finish
+        '''
+        self._pixmaps.clear()
+        self._pending.clear()
+        self._generation += 1
+
+    def _store(self, key: str, pixmap: QPixmap):
+        self._pixmaps[key] = pixmap
+        self._pixmaps.move_to_end(key)
+        while len(self._pixmaps) > self.max_items:
+            self._pixmaps.popitem(last=False)
+
+    @pyqtSlot(str, int, QImage)
+    def _onLoaded(self, key: str, generation: int, image: QImage):
+        if generation != self._generation or key not in self._pending:
+            return
+        self._pending.discard(key)
+        if not image.isNull():
+            self._store(key, QPixmap.fromImage(image))
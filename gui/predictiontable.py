@@ -0,0 +1,215 @@
+import bisect
+import typing
+
+import numpy as np
+from PyQt6.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+HEADERS = ["Image", "Unfertilized", "Fertilized"]
+
+
+class PredictionCounts():
+    '''
+    Columnar store of per image counts: image names, plus unfertilized
+    and fertilized counts in two integer arrays that grow by doubling,
+    so appending a row is amortized O(1) and needs no per cell objects
+
+    :param capacity: Number of rows to allocate up front
+    '''
+
+    def __init__(self, capacity: int = 1024):
+        self.names = []
+        self._unfertilized = np.zeros(max(1, capacity), dtype=np.int32)
+        self._fertilized = np.zeros(max(1, capacity), dtype=np.int32)
+        self._index = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def unfertilized(self) -> np.ndarray:
+        return self._unfertilized[:len(self.names)]
+
+    @property
+    def fertilized(self) -> np.ndarray:
+        return self._fertilized[:len(self.names)]
+
+    def _reserve(self, size: int):
+        if size <= len(self._unfertilized):
+            return
+        capacity = max(size, 2 * len(self._unfertilized))
+        for column in ('_unfertilized', '_fertilized'):
+            grown = np.zeros(capacity, dtype=np.int32)
+            grown[:len(self.names)] = getattr(self, column)[:len(self.names)]
+            setattr(self, column, grown)
+
+    def append(self, name: str, unfertilized: int, fertilized: int) -> int:
+        '''
+        Add a row and return its index
+        '''
+        idx = len(self.names)
+        self._reserve(idx + 1)
+        self._unfertilized[idx] = int(unfertilized)
+        self._fertilized[idx] = int(fertilized)
+        self.names.append(name)
+        self._index[name] = idx
+        return idx
+
+    def clear(self):
+        self.names = []
+        self._index = {}
+
+    def row(self, idx: int) -> tuple[str, int, int]:
+        return (self.names[idx], int(self._unfertilized[idx]),
+                int(self._fertilized[idx]))
+
+    def index(self, name: str) -> typing.Optional[int]:
+        '''
+        Returns the row of the image with the given name, if any
+        '''
+        return self._index.get(name)
+
+    def sortKeys(self, column: int) -> typing.Union[list, np.ndarray]:
+        '''
+        Returns the values of the given column (0: names, 1: unfertilized,
+        2: fertilized) to sort by
+        '''
+        if column == 0:
+            return self.names
+        return self.unfertilized if column == 1 else self.fertilized
+
+
+class PredictionTableModel(QAbstractTableModel):
+    '''
+    Table model over a `PredictionCounts` store. Cells are formatted on
+    demand for the visible rows only. Sorting reorders a permutation of
+    row indices rather than the rows themselves, and rows appended while
+    sorted are inserted at their sorted position
+    '''
+
+    def __init__(self, headers: list[str] = HEADERS):
+        super().__init__()
+        self.headers = list(headers)
+        self.store = PredictionCounts()
+        # View row -> store row, None while in insertion order
+        self._order = None
+        self._sort_column = -1
+        self._sort_order = Qt.SortOrder.AscendingOrder
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.store)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return str(self.store.row(self.storeRow(index.row()))[
+                index.column()])
+        if role == Qt.ItemDataRole.TextAlignmentRole and index.column() > 0:
+            return Qt.AlignmentFlag.AlignCenter
+        return None
+
+    def headerData(self, section, orientation,
+                   role=Qt.ItemDataRole.DisplayRole):
+        if (role == Qt.ItemDataRole.DisplayRole and
+                orientation == Qt.Orientation.Horizontal and
+                section < len(self.headers)):
+            return self.headers[section]
+        return super().headerData(section, orientation, role)
+
+    def storeRow(self, row: int) -> int:
+        '''
+        Returns the store index of the row shown at `row`
+        '''
+        return row if self._order is None else int(self._order[row])
+
+    def viewRow(self, store_row: int) -> int:
+        '''
+        Returns the row at which the store index `store_row` is shown
+        '''
+        if self._order is None:
+            return store_row
+        return int(np.flatnonzero(self._order == store_row)[0])
+
+    def rowValues(self, row: int) -> tuple[str, int, int]:
+        return self.store.row(self.storeRow(row))
+
+    def rows(self) -> typing.Iterator[tuple[str, int, int]]:
+        '''
+        Iterate over all rows in display order
+        '''
+        for row in range(len(self.store)):
+            yield self.rowValues(row)
+
+    def setRows(self, rows: list[list[str]]):
+        '''
+        Replace all rows with [name, unfertilized, fertilized] rows
+        '''
+        self.beginResetModel()
+        self.store.clear()
+        for name, unfertilized, fertilized in rows:
+            self.store.append(name, unfertilized, fertilized)
+        self._order = self._sortedOrder()
+        self.endResetModel()
+
+    def appendRow(self, row: list[str]):
+        '''
+        Add a [name, unfertilized, fertilized] row
+        '''
+        name, unfertilized, fertilized = row
+        size = len(self.store)
+        if self._order is None:
+            self.beginInsertRows(QModelIndex(), size, size)
+            self.store.append(name, unfertilized, fertilized)
+            self.endInsertRows()
+            return
+        value = name if self._sort_column == 0 else int(
+            unfertilized if self._sort_column == 1 else fertilized)
+        keys = self.store.sortKeys(self._sort_column)
+        descending = self._sort_order == Qt.SortOrder.DescendingOrder
+
+        def isAfter(row):
+            key = keys[self._order[row]]
+            return key < value if descending else key > value
+
+        # Insert after the rows with an equal key, keeping the sort stable
+        position = bisect.bisect_right(range(size), False, key=isAfter)
+        self.beginInsertRows(QModelIndex(), position, position)
+        store_row = self.store.append(name, unfertilized, fertilized)
+        self._order = np.insert(self._order, position, store_row)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.store.clear()
+        self._order = None if self._order is None else np.zeros(0, int)
+        self.endResetModel()
+
+    def _sortedOrder(self) -> typing.Optional[np.ndarray]:
+        if self._sort_column < 0 or self._sort_column >= len(self.headers):
+            return None
+        keys = self.store.sortKeys(self._sort_column)
+        descending = self._sort_order == Qt.SortOrder.DescendingOrder
+        if self._sort_column == 0:
+            order = sorted(range(len(keys)), key=keys.__getitem__,
+                           reverse=descending)
+            return np.asarray(order, dtype=np.int64)
+        return np.argsort(-keys if descending else keys, kind='stable')
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        '''
+        Sort the view by `column` (-1 for detection order) without
+        moving any rows in the store
+        '''
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        store_rows = [self.storeRow(index.row()) for index in persistent]
+        self._sort_column = column
+        self._sort_order = order
+        self._order = self._sortedOrder()
+        self.changePersistentIndexList(persistent, [
+            self.index(self.viewRow(store_row), index.column())
+            for index, store_row in zip(persistent, store_rows)])
+        self.layoutChanged.emit()
@@ -0,0 +1,292 @@
+import io
+import os
+import queue
+import threading
+import typing
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from instrumentation import NULL_METRICS
+
+VALID_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+
+
+def isValidImageMember(member: str,
+                       valid_extensions: typing.Optional[
+                           list[str]] = VALID_EXTENSIONS) -> bool:
+    '''
+    Returns whether a zip member (or file name) is an image to process.
+    Skips directories, macOS resource forks ("._" files and "__MACOSX/")
+    and files without a valid extension
+    '''
+    filename = os.path.basename(member)
+    _, file_extension = os.path.splitext(filename)
+    return not (not filename or filename.startswith('._')
+                or member.startswith('__MACOSX/')
+                or (valid_extensions is not None
+                    and file_extension not in valid_extensions))
+
+
+def toModelArray(image: Image.Image) -> np.ndarray:
+    '''
+    Convert a PIL image to the BGR numpy layout ultralytics expects
+    '''
+    return np.ascontiguousarray(np.asarray(image.convert("RGB"))[..., ::-1])
+
+
+class ImageSource():
+    '''
+    A collection of images addressed by file name. Subclasses implement
+    `names`, `read` and optionally `path` for images that live on disk
+    '''
+
+    def names(self) -> list[str]:
+        '''
+        Returns the file names of all images, in processing order
+        '''
+        raise NotImplementedError
+
+    def read(self, filename: str) -> bytes:
+        '''
+        Returns the encoded bytes of an image
+        '''
+        raise NotImplementedError
+
+    def path(self, filename: str) -> typing.Optional[str]:
+        '''
+        Returns the on disk path of an image, or None if it isn't on disk
+        '''
+        return None
+
+    def __len__(self):
+        return len(self.names())
+
+    def close(self):
+        '''
+        Release any files held open for reading the images
+        '''
+
+    def open(self, filename: str) -> Image.Image:
+        '''
+        Returns the image as a (lazily decoded) PIL image
+        '''
+        image_path = self.path(filename)
+        if image_path is not None:
+            return Image.open(image_path)
+        return Image.open(io.BytesIO(self.read(filename)))
+
+    def imageSize(self, filename: str) -> typing.Optional[tuple[int, int]]:
+        '''
+        Returns the (width, height) of an image from its header, or None
+        if it can't be read
+        '''
+        try:
+            with self.open(filename) as image:
+                return image.size
+        except (OSError, ValueError):
+            return None
+
+    def loadArray(self, filename: str) -> np.ndarray:
+        '''
+        Decode an image to a BGR numpy array
+        '''
+        with self.open(filename) as image:
+            return toModelArray(image)
+
+    def iterDecoded(self, filenames: typing.Optional[list[str]] = None,
+                    prefetch: int = 4, metrics=NULL_METRICS, budget=None):
+        '''
+        Yield (filename, BGR array) pairs in order, decoding up to
+        `prefetch` images ahead on a background thread so callers can
+        start on the first image while the rest are still being read.
+        Decode times are recorded in `metrics`.
+        With a `budget` (see memorybudget.py), every image is reserved in
+        its "decode" stage before it is decoded, so decoding ahead waits
+        while the budget is used up, but never while the caller is waiting
+        for the next image. The caller takes over the reservation of each
+        yielded array (`array.nbytes`)
+        '''
+        if filenames is None:
+            filenames = self.names()
+        decoded = queue.Queue(maxsize=max(1, prefetch))
+        stop = threading.Event()
+        # Set while the caller waits for an image that isn't decoded yet
+        starved = threading.Event()
+        done = object()
+
+        def decode(filename):
+            estimate = 0
+            if budget is not None:
+                size = self.imageSize(filename)
+                if size is not None:
+                    estimate = size[0] * size[1] * 3
+                if not budget.acquire("decode", estimate, stop=stop,
+                                      urgent=starved):
+                    return None
+            try:
+                with metrics.stage("decode", filename):
+                    pixels = self.loadArray(filename)
+            except Exception as e:
+                if budget is not None:
+                    budget.release("decode", estimate)
+                return (filename, e)
+            if budget is not None:
+                budget.resize("decode", estimate, pixels.nbytes)
+            return (filename, pixels)
+
+        def reader():
+            try:
+                for filename in filenames:
+                    if stop.is_set():
+                        return
+                    item = decode(filename)
+                    if item is None:
+                        return
+                    decoded.put(item)
+            finally:
+                decoded.put(done)
+
+        def discard(item):
+            if (budget is not None and item is not done
+                    and isinstance(item[1], np.ndarray)):
+                budget.release("decode", item[1].nbytes)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    item = decoded.get_nowait()
+                except queue.Empty:
+                    starved.set()
+                    item = decoded.get()
+                    starved.clear()
+                if item is done:
+                    break
+                filename, pixels = item
+                if isinstance(pixels, Exception):
+                    raise pixels
+                yield filename, pixels
+        finally:
+            stop.set()
+            # Unblock the reader if it's waiting on a full queue
+            while thread.is_alive():
+                try:
+                    discard(decoded.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+            while not decoded.empty():
+                discard(decoded.get_nowait())
+
+
+class DirectoryImageSource(ImageSource):
+    '''
+    Images stored as files in a directory
+
+    :param directory: Directory holding the images
+    :param valid_extensions: Extensions to include, or None for every file
+    '''
+
+    def __init__(self, directory: typing.Union[str, os.PathLike],
+                 valid_extensions: typing.Optional[list[str]] = None):
+        self.directory = directory
+        self.valid_extensions = valid_extensions
+        self._names = None
+
+    def names(self) -> list[str]:
+        if self._names is None:
+            self._names = [
+                filename for filename in os.listdir(self.directory)
+                if not os.path.isdir(os.path.join(self.directory, filename))
+                and (self.valid_extensions is None
+                     or isValidImageMember(filename, self.valid_extensions))]
+        return self._names
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def read(self, filename: str) -> bytes:
+        with open(self.path(filename), 'rb') as f:
+            return f.read()
+
+
+class ZipImageSource(ImageSource):
+    '''
+    Images read straight out of a zip archive, without extracting it.
+    Members are addressed by their base name; as with extraction, a later
+    member with the same name replaces an earlier one
+
+    :param zip_path: Path to the zip archive
+    :param valid_extensions: Extensions to include
+    '''
+
+    def __init__(self, zip_path: typing.Union[str, os.PathLike],
+                 valid_extensions: list[str] = VALID_EXTENSIONS):
+        self.zip_path = zip_path
+        self.valid_extensions = valid_extensions
+        self._zip = zipfile.ZipFile(zip_path, 'r')
+        self._members = {}
+        for member in self._zip.namelist():
+            if isValidImageMember(member, valid_extensions):
+                self._members[os.path.basename(member)] = member
+
+    def names(self) -> list[str]:
+        return list(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def read(self, filename: str) -> bytes:
+        return self._zip.read(self._members[filename])
+
+    def imageSize(self, filename: str) -> typing.Optional[tuple[int, int]]:
+        # Only read as much of the member as the header needs
+        try:
+            with self._zip.open(self._members[filename]) as member:
+                with Image.open(member) as image:
+                    return image.size
+        except (OSError, ValueError):
+            return None
+
+    def __reduce__(self):
+        # Sent to other processes by path, each opens the archive itself
+        return (ZipImageSource, (self.zip_path, self.valid_extensions))
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SubsetImageSource(ImageSource):
+    '''
+    Some of the images of another source, e.g. one shard of a run
+
+    :param source: Source holding the images
+    :param filenames: File names of the images to include, in order
+    '''
+
+    def __init__(self, source: ImageSource, filenames: list[str]):
+        self.source = source
+        self.filenames = list(filenames)
+
+    def names(self) -> list[str]:
+        return list(self.filenames)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def read(self, filename: str) -> bytes:
+        return self.source.read(filename)
+
+    def path(self, filename: str) -> typing.Optional[str]:
+        return self.source.path(filename)
+
+    def imageSize(self, filename: str) -> typing.Optional[tuple[int, int]]:
+        return self.source.imageSize(filename)
@@ -0,0 +1,107 @@
+import io
+import json
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_SERVER_URL = "http://127.0.0.1:8765"
+
+
+class RemoteModel():
+    '''
+    Client for the local inference server (see server.py) with the same
+    `predict` interface as the in-process models, so `runDetection` can use
+    it in their place. Images of a batch are sent as concurrent requests,
+    which the server coalesces into batches with other clients' requests.
+    Returns raw YOLO formatted predictions, before the custom NMS
+
+    :param url: Base url of the inference server
+    :param model: Model name to run on the server
+    :param timeout: Seconds to wait for each image's detections
+    '''
+
+    # The server doesn't write YOLO label files, see `runDetection`
+    in_memory_only = True
+    # Images are sent encoded and decoded on the server, see `runDetection`
+    encoded_input = True
+
+    def __init__(self, url: str = DEFAULT_SERVER_URL, model: str = "",
+                 timeout: float = 300):
+        self.url = url.rstrip('/')
+        self.model = model
+        self.timeout = timeout
+
+    def _encode(self, image) -> tuple[bytes, str]:
+        '''
+        Returns the request body and content type for an image path,
+        encoded image bytes or decoded BGR array (e.g. a tile)
+        '''
+        if isinstance(image, bytes):
+            return image, 'application/octet-stream'
+        if isinstance(image, np.ndarray):
+            buffer = io.BytesIO()
+            np.save(buffer, image, allow_pickle=False)
+            return buffer.getvalue(), 'application/x-npy'
+        with open(image, 'rb') as f:
+            return f.read(), 'application/octet-stream'
+
+    def detect(self, image, conf: float = 0.25, max_det: int = 500,
+               raw: bool = False) -> dict:
+        '''
+        Send one image (path, encoded bytes or BGR array) to the server
+        and return the decoded JSON response
+        '''
+        body, content_type = self._encode(image)
+        query = urllib.parse.urlencode(dict(
+            model=self.model, conf=conf, max_det=max_det, raw=int(raw)))
+        request = urllib.request.Request(
+            f'{self.url}/detect?{query}', data=body, method='POST',
+            headers={'Content-Type': content_type})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def predict(self, source, conf: float = 0.25, max_det: int = 500,
+                **kwargs) -> list[np.ndarray]:
+        images = source if isinstance(source, list) else [source]
+
+        def detectRaw(image):
+            boxes = self.detect(image, conf, max_det, raw=True)['boxes']
+            return np.asarray(boxes, dtype=float).reshape(-1, 6)
+
+        if len(images) == 1:
+            return [detectRaw(images[0])]
+        with ThreadPoolExecutor(max_workers=len(images)) as executor:
+            return list(executor.map(detectRaw, images))
+
+    def health(self) -> dict:
+        '''
+        Returns the server status: loaded models and batching statistics
+        '''
+        with urllib.request.urlopen(f'{self.url}/health',
+                                    timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def resultLabel(self) -> str:
+        '''
+        Returns the label the server's results of this model are stored
+        under, which depends on the backend the server runs it on (see
+        `ModelRegistry.resultLabel`)
+        '''
+        query = urllib.parse.urlencode(dict(model=self.model))
+        with urllib.request.urlopen(f'{self.url}/health?{query}',
+                                    timeout=self.timeout) as response:
+            return json.loads(response.read())['result_label']
+
+
+def isServerAvailable(url: str = DEFAULT_SERVER_URL,
+                      timeout: float = 0.5) -> bool:
+    '''
+    Returns whether an inference server is answering at `url`
+    '''
+    try:
+        RemoteModel(url, timeout=timeout).health()
+        return True
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,157 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import typing
+from typing import Callable
+
+
+class _Stage():
+
+    def __init__(self, metrics: "Metrics", name: str,
+                 image: typing.Optional[str]):
+        self.metrics = metrics
+        self.name = name
+        self.image = image
+
+    def __enter__(self):
+        if self.metrics.trace_memory:
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.cpu_start
+        peak = None
+        if self.metrics.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+        self.metrics.record(dict(
+            stage=self.name, image=self.image,
+            start=self.start - self.metrics.origin, wall=wall, cpu=cpu,
+            peak_bytes=peak, thread=threading.get_ident()))
+        return False
+
+
+class Metrics():
+    '''
+    Records wall time, CPU time and (optionally) tracemalloc peaks of the
+    pipeline stages, per image where a stage works on a single image.
+    Pass it as `metrics` to `runDetection`, `addPredictionAnnotations` or
+    `runDetectionPipeline`, then read `records`/`summary()` or export a
+    Chrome trace (viewable in Perfetto or chrome://tracing).
+    Memory peaks are process wide, so they are only exact when stages
+    don't run concurrently
+
+    :param trace_memory: Whether to record tracemalloc peaks per stage.
+                Starts tracemalloc, which slows down allocations
+    :param callback: Called with each record as it is made
+    '''
+
+    enabled = True
+
+    def __init__(self, trace_memory: bool = False,
+                 callback: typing.Optional[Callable[[dict], None]] = None):
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.records = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name: str, image: typing.Optional[str] = None):
+        '''
+        Context manager timing one stage, e.g.
+            with metrics.stage("nms", image=name):
+                ...
+        '''
+        return _Stage(self, name, image)
+
+    def record(self, record: dict):
+        '''
+        Add a record made outside of `stage`, e.g. a span measured in
+        another process. Needs at least stage, start (seconds since the
+        metrics were created) and wall
+        '''
+        record.setdefault('image', None)
+        record.setdefault('cpu', None)
+        record.setdefault('peak_bytes', None)
+        record.setdefault('thread', threading.get_ident())
+        with self._lock:
+            self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def now(self) -> float:
+        '''
+        Returns the current time in the records' clock
+        '''
+        return time.perf_counter() - self.origin
+
+    def summary(self) -> dict:
+        '''
+        Returns per stage totals: count, wall and CPU seconds, and the
+        highest memory peak
+        '''
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            stage = stages.setdefault(record['stage'], dict(
+                count=0, wall=0.0, cpu=0.0, peak_bytes=None))
+            stage['count'] += 1
+            stage['wall'] += record['wall']
+            stage['cpu'] += record['cpu'] or 0.0
+            if record['peak_bytes'] is not None:
+                stage['peak_bytes'] = max(stage['peak_bytes'] or 0,
+                                          record['peak_bytes'])
+        return stages
+
+    def exportChromeTrace(self, path: typing.Union[str, os.PathLike]):
+        '''
+        Write the records as a Chrome trace event file
+        '''
+        pid = os.getpid()
+        events = []
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            args = {}
+            if record['image'] is not None:
+                args['image'] = record['image']
+            if record['cpu'] is not None:
+                args['cpu_ms'] = record['cpu'] * 1000
+            if record['peak_bytes'] is not None:
+                args['peak_kb'] = record['peak_bytes'] / 1024
+            events.append(dict(
+                name=record['stage'], cat='froggle', ph='X',
+                ts=record['start'] * 1e6, dur=record['wall'] * 1e6,
+                pid=pid, tid=record['thread'], args=args))
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+
+class _NullMetrics():
+    '''
+    Stand-in used when instrumentation is disabled. Every call is a no-op
+    '''
+
+    enabled = False
+    trace_memory = False
+    _null_stage = contextlib.nullcontext()
+
+    def stage(self, name: str, image: typing.Optional[str] = None):
+        return self._null_stage
+
+    def record(self, record: dict):
+        pass
+
+    def now(self) -> float:
+        return 0.0
+
+
+NULL_METRICS = _NullMetrics()
@@ -0,0 +1,59 @@
+import threading
+import typing
+
+
+# QThreadPool priorities: interactive work (e.g. decoding images for the
+# carousel) is started ahead of queued bulk detection and annotation jobs
+PRIORITY_BULK = 0
+PRIORITY_INTERACTIVE = 10
+
+
+class JobCancelled(Exception):
+    '''
+    Raised at a checkpoint of a job that has been cancelled
+    '''
+
+
+class JobControl():
+    '''
+    Cooperative pause, resume and cancellation for a long running job.
+    The job calls `checkpoint` between units of work (e.g. per batch or
+    per image); other threads call `pause`, `resume` and `cancel`
+
+    :param event: Event type to use, e.g. `multiprocessing.Event` for a
+                control shared with worker processes
+    '''
+
+    def __init__(self, event: typing.Callable = threading.Event):
+        self._cancelled = event()
+        self._running = event()
+        self._running.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        # Wake up a paused job so it sees the cancellation
+        self._running.set()
+
+    def checkpoint(self):
+        '''
+        Block while the job is paused, and raise `JobCancelled` if it has
+        been cancelled
+        '''
+        if not self._running.is_set():
+            self._running.wait()
+        if self._cancelled.is_set():
+            raise JobCancelled()
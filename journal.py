@@ -0,0 +1,172 @@
+'''
+Append-only journal of a run's completed work, so an interrupted run can
+pick up where it left off.
+
+Layout (little endian):
+    b"FROGJRN1" | record*
+    record: uint32 payload size | uint32 crc32 of payload | payload
+The first record holds the run settings as JSON. Every further record is
+one finished image: its detections and counts, or the fact that its
+annotated image was written. A record only counts once it is complete
+and its checksum matches, so a crash mid-write loses at most that record.
+'''
+import json
+import os
+import struct
+import threading
+import typing
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+JOURNAL_FILE_NAME = "journal.bin"
+MAGIC = b"FROGJRN1"
+_RECORD_HEADER = struct.Struct('<II')
+_SETTINGS = b'S'
+_DETECTION = b'D'
+_ANNOTATION = b'A'
+_DETECTION_HEADER = struct.Struct('<iiI')
+
+
+def journalPath(prediction_dir: typing.Union[str, os.PathLike]) -> str:
+    '''
+    Returns where the journal of runs on `prediction_dir` is kept
+    '''
+    return os.path.join(prediction_dir, 'predict', JOURNAL_FILE_NAME)
+
+
+class RunJournal():
+    '''
+    Journal of completed images. Pass it to `runDetection`,
+    `addPredictionAnnotations` or `runDetectionPipeline` to skip work a
+    previous, interrupted run with the same settings already finished,
+    and `remove` it once the run is complete.
+    Records are flushed as they are written and synced to disk on `sync`
+
+    :param path: Path of the journal, created if it doesn't exist
+    '''
+
+    def __init__(self, path: typing.Union[str, os.PathLike]):
+        self.path = os.fspath(path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.settings = None
+        # name -> (pred, num_unfertilized, num_fertilized), in run order
+        self.detections = OrderedDict()
+        self.annotated = set()
+        self._lock = threading.Lock()
+        valid_size = self._load()
+        self._file = open(self.path, 'r+b' if valid_size else 'w+b')
+        if valid_size:
+            # Drop a record left half written by a crash
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        else:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def _load(self) -> int:
+        '''
+        Read the complete records, returning the size of the valid part
+        of the file (0 if there is no usable journal)
+        '''
+        if not os.path.isfile(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            return 0
+        position = len(MAGIC)
+        while position + _RECORD_HEADER.size <= len(data):
+            size, checksum = _RECORD_HEADER.unpack_from(data, position)
+            start = position + _RECORD_HEADER.size
+            payload = data[start:start + size]
+            if len(payload) < size or zlib.crc32(payload) != checksum:
+                break
+            self._apply(payload)
+            position = start + size
+        return position
+
+    def _apply(self, payload: bytes):
+        kind, body = payload[:1], payload[1:]
+        if kind == _SETTINGS:
+            self.settings = json.loads(body)
+        elif kind == _DETECTION:
+            num_unfertilized, num_fertilized, name_size = \
+                _DETECTION_HEADER.unpack_from(body)
+            start = _DETECTION_HEADER.size
+            name = body[start:start + name_size].decode()
+            pred = np.frombuffer(body[start + name_size:], dtype='<f4')
+            self.detections[name] = (pred.reshape(-1, 6).astype(float),
+                                     num_unfertilized, num_fertilized)
+        elif kind == _ANNOTATION:
+            self.annotated.add(body.decode())
+
+    def _append(self, payload: bytes):
+        with self._lock:
+            self._file.write(_RECORD_HEADER.pack(
+                len(payload), zlib.crc32(payload)) + payload)
+            self._file.flush()
+
+    def start(self, settings: dict) -> bool:
+        '''
+        Begin (or continue) a run with the given settings. If the journal
+        was written with different settings it is cleared, since its
+        results don't apply. Returns whether earlier work is resumed
+        '''
+        settings = json.loads(json.dumps(settings))
+        if self.settings == settings:
+            return bool(self.detections)
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(MAGIC)
+        self.detections.clear()
+        self.annotated.clear()
+        self.settings = settings
+        self._append(_SETTINGS + json.dumps(settings).encode())
+        return False
+
+    def recordDetection(self, name: str, pred: typing.Optional[np.ndarray],
+                        num_unfertilized: int = 0, num_fertilized: int = 0):
+        '''
+        Record the filtered YOLO formatted predictions of a finished image
+        '''
+        if pred is None:
+            pred = np.zeros((0, 6))
+        encoded_name = name.encode()
+        self._append(
+            _DETECTION +
+            _DETECTION_HEADER.pack(num_unfertilized, num_fertilized,
+                                   len(encoded_name)) +
+            encoded_name +
+            np.ascontiguousarray(pred, dtype='<f4').tobytes())
+        self.detections[name] = (pred, num_unfertilized, num_fertilized)
+
+    def recordAnnotation(self, name: str):
+        '''
+        Record that the annotated image of `name` has been written
+        '''
+        self._append(_ANNOTATION + name.encode())
+        self.annotated.add(name)
+
+    def sync(self):
+        '''
+        Make sure everything recorded so far survives a crash
+        '''
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def remove(self):
+        '''
+        Delete the journal, once the run it tracks is complete
+        '''
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
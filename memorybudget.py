@@ -0,0 +1,160 @@
+'''
+Memory budget shared by the stages of a run. Before a stage allocates
+something big (a decoded image, a batch going through the model, an image
+being annotated) it reserves the estimated size, and it releases the
+reservation once the memory is freed again. A reservation that doesn't
+fit blocks until later stages release enough, so a slow stage holds the
+stages before it back instead of letting their output pile up in memory.
+
+Stages are ordered from upstream to downstream (see `STAGES`). A stage
+only waits for memory held by itself and the stages after it: the last
+stages always make progress and release what they hold, so stages
+waiting on each other can't deadlock. The budget can therefore be
+overshot by about one item per stage, and a single item larger than the
+whole budget is let through once nothing else is held. A stage whose
+next stage is waiting for its output (see `acquire`'s `urgent`) is let
+through too, e.g. when images of a batch still being put together hold
+the budget.
+'''
+import threading
+import time
+import typing
+
+# Stages in pipeline order
+STAGES = ("decode", "inference", "nms", "annotate")
+
+
+class MemoryBudget():
+    '''
+    Bounds the memory the stages of a run hold at once, and tracks per
+    stage queue depth (items held) and memory for `report`.
+    Pass it as `budget` to `runDetection`, `addPredictionAnnotations` or
+    `runDetectionPipeline`
+
+    :param limit_mb: Megabytes the stages may hold together, or None to
+                only track depths and memory
+    '''
+
+    def __init__(self, limit_mb: typing.Optional[float] = None):
+        self.limit = None if limit_mb is None else int(limit_mb * 1024 ** 2)
+        self._condition = threading.Condition()
+        self._used = 0
+        self._peak = 0
+        self._stages = {stage: self._newStage() for stage in STAGES}
+
+    @staticmethod
+    def _newStage() -> dict:
+        return dict(depth=0, bytes=0, items=0, peak_depth=0, peak_bytes=0,
+                    blocked_seconds=0.0)
+
+    def _stage(self, stage: str) -> dict:
+        if stage not in self._stages:
+            self._stages[stage] = self._newStage()
+        return self._stages[stage]
+
+    def _heldFrom(self, stage: str) -> int:
+        '''
+        Bytes held by `stage` and the stages after it
+        '''
+        if stage not in STAGES:
+            return self._used
+        downstream = STAGES[STAGES.index(stage):]
+        return sum(self._stages[name]['bytes'] for name in downstream)
+
+    def _add(self, stage: str, nbytes: int, items: int):
+        state = self._stage(stage)
+        state['depth'] += items
+        state['bytes'] += nbytes
+        state['peak_depth'] = max(state['peak_depth'], state['depth'])
+        state['peak_bytes'] = max(state['peak_bytes'], state['bytes'])
+        self._used += nbytes
+        self._peak = max(self._peak, self._used)
+
+    def acquire(self, stage: str, nbytes: int, items: int = 1,
+                stop: typing.Optional[threading.Event] = None,
+                urgent: typing.Optional[threading.Event] = None) -> bool:
+        '''
+        Reserve `nbytes` for `items` items entering `stage`, blocking
+        while the budget is exhausted. Returns False without reserving
+        anything if `stop` is set while waiting. Reserves over the budget
+        once `urgent` is set, i.e. while the next stage can't go on
+        without this item
+        '''
+        nbytes = max(0, int(nbytes))
+        with self._condition:
+            start = None
+            while (self.limit is not None
+                   and self._used + nbytes > self.limit
+                   and self._heldFrom(stage) > 0):
+                if stop is not None and stop.is_set():
+                    return False
+                if urgent is not None and urgent.is_set():
+                    break
+                if start is None:
+                    start = time.perf_counter()
+                # Wake up now and then to notice `stop`
+                self._condition.wait(timeout=0.1)
+            if start is not None:
+                self._stage(stage)['blocked_seconds'] += (
+                    time.perf_counter() - start)
+            self._add(stage, nbytes, items)
+            self._stage(stage)['items'] += items
+        return True
+
+    def release(self, stage: str, nbytes: int, items: int = 1):
+        '''
+        Release a reservation made with `acquire`
+        '''
+        nbytes = max(0, int(nbytes))
+        with self._condition:
+            self._add(stage, -nbytes, -items)
+            self._condition.notify_all()
+
+    def resize(self, stage: str, nbytes: int, new_nbytes: int):
+        '''
+        Correct a reservation to the actual size once it is known, e.g.
+        after decoding an image whose size was estimated. Never blocks
+        '''
+        with self._condition:
+            self._add(stage, int(new_nbytes) - int(nbytes), 0)
+            self._condition.notify_all()
+
+    def move(self, stage: str, to_stage: str, nbytes: int, items: int = 1):
+        '''
+        Hand a reservation over to the next stage without releasing it,
+        e.g. when a decoded image is taken into an inference batch
+        '''
+        nbytes = max(0, int(nbytes))
+        with self._condition:
+            self._add(stage, -nbytes, -items)
+            self._add(to_stage, nbytes, items)
+            self._stage(to_stage)['items'] += items
+            self._condition.notify_all()
+
+    def include(self, report: dict, prefix: str):
+        '''
+        Add the stages of another budget's `report`, e.g. of a worker
+        process, under names starting with `prefix`. Its peak is added to
+        the total peak, which is then an upper bound
+        '''
+        with self._condition:
+            for stage, state in report['stages'].items():
+                self._stages[f"{prefix}{stage}"] = dict(
+                    state, depth=0, bytes=0)
+            self._peak += report['peak_bytes']
+
+    def report(self) -> dict:
+        '''
+        Returns the limit, the highest total reserved at once, and per
+        stage: items that went through it, peak depth, peak memory and
+        time spent waiting for the budget
+        '''
+        with self._condition:
+            return dict(
+                limit_bytes=self.limit, peak_bytes=self._peak,
+                stages={stage: dict(
+                    items=state['items'], peak_depth=state['peak_depth'],
+                    peak_bytes=state['peak_bytes'],
+                    blocked_seconds=state['blocked_seconds'])
+                    for stage, state in self._stages.items()
+                    if state['items']})
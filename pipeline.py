@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+import typing
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from typing import Callable
+
+from boundingbox import annotationBytes, drawPredictions
+from imagesource import DirectoryImageSource, ImageSource
+from instrumentation import NULL_METRICS, Metrics
+from jobcontrol import JobControl
+from journal import RunJournal
+from memorybudget import MemoryBudget
+from predict import DEFAULT_MODEL, runDetection
+from sharding import runShardedDetection
+
+
+def runDetectionPipeline(prediction_dir,
+                         model: str = DEFAULT_MODEL,
+                         progress_callback: typing.Optional[
+                             Callable[[int], None]] = None,
+                         annotation_callback: typing.Optional[
+                             Callable[[str, int], None]] = None,
+                         annotation_workers: int = 1,
+                         detection_processes: int = 1,
+                         source: typing.Optional[ImageSource] = None,
+                         metrics: typing.Optional[Metrics] = None,
+                         journal: typing.Optional[RunJournal] = None,
+                         control: typing.Optional[JobControl] = None,
+                         preview_width: typing.Optional[int] = None,
+                         image_format: str = "png",
+                         budget: typing.Optional[MemoryBudget] = None,
+                         **detection_kwargs):
+    '''
+    Run detection on every image in `prediction_dir` (or in `source` if
+    given, see `runDetection`) and annotate each image as soon as its
+    detections are final, while the model moves on to the next images.
+
+    Annotation runs on a process pool of `annotation_workers` processes
+    (or a single background thread if that is 1). At most two images per
+    annotation worker are queued at once, so a slow annotation stage
+    holds detection back instead of piling up predictions in memory.
+
+    `progress_callback` receives detection progress exactly like
+    `runDetection`. `annotation_callback` is called with the count line of
+    each image as soon as its annotated image is written, together with
+    the number of images annotated so far.
+    Stage timings are recorded in `metrics` if given; images annotated on
+    the process pool are recorded as a single "annotate" span each.
+    With a `journal`, detections and annotated images are recorded as
+    they finish, and work an interrupted run recorded is skipped (see
+    `runDetection`). With a `control` the run can be paused, resumed and
+    cancelled; annotations already running are finished first.
+    With `detection_processes` above 1, detection itself is split across
+    that many processes (see `runShardedDetection`).
+    `preview_width` and `image_format` select downscaled, cheaply encoded
+    annotated images (see `drawPredictions`).
+    With a `budget` (see memorybudget.py), decoding, inference, NMS and
+    annotation all reserve what they hold in it: once it is used up,
+    detection waits for annotations to finish, and decoding waits for
+    detection.
+    Remaining keyword arguments are passed on to `runDetection`.
+    Returns the count lines of all images, in detection order
+    '''
+    annotated_image_path = os.path.join(
+        prediction_dir, 'predict', 'annotated_images')
+    os.makedirs(annotated_image_path, exist_ok=True)
+
+    if source is None:
+        source = DirectoryImageSource(prediction_dir)
+    if metrics is None:
+        metrics = NULL_METRICS
+    annotation_workers = max(1, annotation_workers)
+    if annotation_workers > 1:
+        # Spawned, as detection threads are already running
+        executor = ProcessPoolExecutor(
+            max_workers=annotation_workers,
+            mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+    draw_kwargs = dict(preview_width=preview_width, image_format=image_format)
+    max_pending = 2 * annotation_workers
+    pending = {}
+    started = {}
+    annotated_count = 0
+
+    def collect(futures):
+        nonlocal annotated_count
+        for future in futures:
+            prediction = pending.pop(future)
+            name = future.result()
+            if journal is not None:
+                journal.recordAnnotation(name)
+            if future in started:
+                start = started.pop(future)
+                metrics.record(dict(stage="annotate", image=name,
+                                    start=start, wall=metrics.now() - start))
+            annotated_count += 1
+            if annotation_callback is not None:
+                annotation_callback(prediction, annotated_count)
+
+    def onImageDetected(filename, prediction, pred):
+        nonlocal annotated_count
+        name = os.path.splitext(filename)[0]
+        if journal is not None and name in journal.annotated:
+            annotated_count += 1
+            if annotation_callback is not None:
+                annotation_callback(prediction, annotated_count)
+            return
+        if len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        nbytes = 0
+        if budget is not None:
+            nbytes = annotationBytes(source.imageSize(filename),
+                                     preview_width)
+            budget.acquire("annotate", nbytes)
+        # Images that aren't on disk are sent to the workers encoded
+        image = source.path(filename) or source.read(filename)
+        if annotation_workers > 1:
+            # Metrics don't cross process boundaries, time the whole job
+            future = executor.submit(
+                drawPredictions, image, pred, annotated_image_path, name,
+                **draw_kwargs)
+            if metrics.enabled:
+                started[future] = metrics.now()
+        else:
+            future = executor.submit(
+                drawPredictions, image, pred, annotated_image_path, name,
+                metrics, **draw_kwargs)
+        if budget is not None:
+            future.add_done_callback(
+                lambda _: budget.release("annotate", nbytes))
+        pending[future] = prediction
+        collect([future for future in list(pending) if future.done()])
+
+    if detection_processes > 1:
+        detect = runShardedDetection
+        detection_kwargs.update(processes=detection_processes)
+    else:
+        detect = runDetection
+    try:
+        predictions = detect(
+            prediction_dir, model=model,
+            progress_callback=progress_callback,
+            result_callback=onImageDetected,
+            source=source,
+            metrics=metrics,
+            journal=journal,
+            control=control,
+            budget=budget,
+            **detection_kwargs)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return predictions
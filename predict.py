@@ -1,35 +1,546 @@
+import contextlib
+import gc
 import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import typing
 import numpy as np
+from collections import OrderedDict
 from typing import Callable
-from ultralytics import YOLO
-model_sgd = YOLO(os.path.join(os.path.dirname(__file__),"./model/sgd.pt"))
-model_adam = YOLO(os.path.join(os.path.dirname(__file__),"./model/adam.pt"))
-model_adam_w = YOLO(os.path.join(os.path.dirname(__file__),"./model/adam_w.pt"))
+from detectioncache import DetectionCache
+from imagesource import DirectoryImageSource, ImageSource
+from inferenceclient import RemoteModel
+from instrumentation import NULL_METRICS, Metrics
+from jobcontrol import JobCancelled, JobControl
+from journal import RunJournal
+from memorybudget import MemoryBudget
+from resultstore import (ResultsStore, ResultsWriter, rawResultsPath,
+                         removeRawResults,
+                         resultsPath)
 
 
-# Log initial message
+MODEL_DIR = os.path.join(os.path.dirname(__file__), "model")
+MODEL_WEIGHTS = dict(
+    sgd="sgd.pt",
+    adam="adam.pt",
+    adam_w="adam_w.pt")
 DEFAULT_MODEL = "sgd"
+# Inference backends: the PyTorch weights as they are, or the weights
+# exported (once, next to them) to ONNX Runtime or OpenVINO, optionally
+# quantized to int8, which run considerably faster on CPUs
+MODEL_BACKENDS = ["torch", "onnx", "onnx-int8", "openvino", "openvino-int8"]
+DEFAULT_BACKEND = "torch"
+# Age after which the lock of an export is taken to be left behind by a
+# process that died while exporting
+EXPORT_LOCK_STALE_SECONDS = 30 * 60
+
+
+def normalizeModelLabel(model: str = "") -> str:
+    '''
+    Returns the registry label for a model name, e.g. "Adam-W" -> "adam_w".
+    Unknown or empty names default to SGD
+    '''
+    label = (model or DEFAULT_MODEL).strip().lower().replace('-', '_')
+    return label if label in MODEL_WEIGHTS else DEFAULT_MODEL
+
+
+def _loadYOLOModel(label: str):
+    '''
+    Load the YOLO weights for the given registry label
+    '''
+    # Imported here so importing this module doesn't pull in torch
+    from ultralytics import YOLO
+    return YOLO(os.path.join(MODEL_DIR, MODEL_WEIGHTS[label]))
+
+
+def exportedModelPath(label: str, backend: str) -> str:
+    '''
+    Returns where the export of the weights of a registry label for an
+    exported backend (see `MODEL_BACKENDS`) is kept, next to the weights
+    '''
+    runtime, _, precision = backend.partition('-')
+    stem = os.path.splitext(MODEL_WEIGHTS[label])[0]
+    if precision:
+        stem = f"{stem}_{precision}"
+    if runtime == "onnx":
+        return os.path.join(MODEL_DIR, f"{stem}.onnx")
+    return os.path.join(MODEL_DIR, f"{stem}_openvino_model")
+
+
+@contextlib.contextmanager
+def _exportLock(path: str):
+    '''
+    Hold `<path>.lock` while exporting to `path`, so processes exporting
+    the same model at once (e.g. sharded workers) export it only once
+    '''
+    lock_path = f"{path}.lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if (time.time() - os.path.getmtime(lock_path)
+                        > EXPORT_LOCK_STALE_SECONDS):
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.5)
+    os.close(fd)
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def exportModel(label: str, backend: str,
+                calibration_data: typing.Optional[str] = None) -> str:
+    '''
+    Export the weights of a registry label for the given backend, unless
+    that was already done, and return the path of the export.
+    Exports take dynamic batch and image sizes, so batched and tiled runs
+    work as with the PyTorch weights.
+    ONNX int8 models are quantized dynamically from the float model and
+    need no calibration data. OpenVINO int8 models are calibrated on
+    `calibration_data` (an ultralytics dataset yaml), or on ultralytics'
+    sample dataset if not given.
+    Only one process exports a model at a time, and the export is written
+    to a temporary path and moved into place when complete, so a process
+    never loads a partly written export
+    '''
+    if backend not in MODEL_BACKENDS or backend == "torch":
+        raise ValueError(f"Can't export models for backend {backend}")
+    path = exportedModelPath(label, backend)
+    if os.path.exists(path):
+        return path
+    with _exportLock(path):
+        # Exported by another process while waiting for the lock
+        if os.path.exists(path):
+            return path
+        runtime, _, precision = backend.partition('-')
+        export_dir = tempfile.mkdtemp(dir=MODEL_DIR, prefix=".export-")
+        try:
+            if backend == "onnx-int8":
+                # Imported here, only needed to quantize
+                from onnxruntime.quantization import (QuantType,
+                                                      quantize_dynamic)
+                exported = os.path.join(export_dir, os.path.basename(path))
+                quantize_dynamic(exportModel(label, "onnx"), exported,
+                                 weight_type=QuantType.QUInt8)
+            else:
+                from ultralytics import YOLO
+                export_kwargs = dict(format=runtime, dynamic=True)
+                if precision == "int8":
+                    export_kwargs.update(int8=True)
+                    if calibration_data:
+                        export_kwargs.update(data=calibration_data)
+                # ultralytics exports next to the weights, so export a
+                # copy of them in the temporary directory
+                weights = os.path.join(export_dir, MODEL_WEIGHTS[label])
+                shutil.copyfile(
+                    os.path.join(MODEL_DIR, MODEL_WEIGHTS[label]), weights)
+                exported = YOLO(weights).export(**export_kwargs)
+            os.replace(exported, path)
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+    return path
+
+
+def backendLoader(
+        backend: str = DEFAULT_BACKEND) -> Callable[[str], typing.Any]:
+    '''
+    Returns a `ModelRegistry` loader for the given backend (see
+    `MODEL_BACKENDS`), exporting the weights on first use
+    '''
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"Unknown model backend {backend}, "
+                         f"expected one of {', '.join(MODEL_BACKENDS)}")
+    if backend == "torch":
+        return _loadYOLOModel
+
+    def load(label: str):
+        from ultralytics import YOLO
+        return YOLO(exportModel(label, backend), task="detect")
+    return load
+
+
+class ModelRegistry():
+    '''
+    Loads models on first use and keeps at most `max_models` of them
+    in memory, evicting the least recently used one when full
+
+    :param max_models: Maximum number of models kept loaded
+    :param loader: Callable that takes a registry label and returns a model
+    '''
+
+    def __init__(self, max_models: int = 1,
+                 loader: Callable[[str], typing.Any] = _loadYOLOModel):
+        self.max_models = max(1, max_models)
+        self.loader = loader
+        self.backend = DEFAULT_BACKEND
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+
+    def setBackend(self, backend: str):
+        '''
+        Load models for the given backend (see `MODEL_BACKENDS`) from now
+        on, dropping the models loaded for the previous one
+        '''
+        loader = backendLoader(backend)
+        with self._lock:
+            if backend != self.backend:
+                self._models.clear()
+            self.loader = loader
+            self.backend = backend
+
+    def resultLabel(self, model: str = "") -> str:
+        '''
+        Returns the label results of the given model are stored under,
+        e.g. in the detection cache. Exported backends don't give exactly
+        the same detections, so they get their own label
+        '''
+        label = normalizeModelLabel(model)
+        if self.backend == DEFAULT_BACKEND:
+            return label
+        return f"{label}@{self.backend}"
+
+    def get(self, model: str = ""):
+        '''
+        Returns the model for the given name, loading it if needed
+        '''
+        label = normalizeModelLabel(model)
+        with self._lock:
+            if label in self._models:
+                self._models.move_to_end(label)
+                return self._models[label]
+            loaded_model = self.loader(label)
+            self._models[label] = loaded_model
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            return loaded_model
+
+    def evict(self, model: typing.Optional[str] = None):
+        '''
+        Drop the given model from memory, or all models if none is given
+        '''
+        with self._lock:
+            if model is None:
+                self._models.clear()
+            else:
+                self._models.pop(normalizeModelLabel(model), None)
+
+    def loadedModels(self) -> list[str]:
+        '''
+        Returns the labels of the models currently in memory,
+        least recently used first
+        '''
+        with self._lock:
+            return list(self._models)
+
+    def warmUp(self, model: str = DEFAULT_MODEL) -> threading.Thread:
+        '''
+        Load the given model on a background thread so the first
+        detection run doesn't pay for it
+        '''
+        thread = threading.Thread(
+            target=self.get, args=(model,), daemon=True)
+        thread.start()
+        return thread
+
+
+model_registry = ModelRegistry()
 
 
 def getModelFromLabel(model: str = ""):
     '''
-    Returns the corresponding model from its name. Defaults to SGD
+    Returns the corresponding model from its name. Defaults to SGD.
+    Models are loaded on first use
+    '''
+    return model_registry.get(model)
+
+
+def setModelBackend(backend: str = DEFAULT_BACKEND):
+    '''
+    Select the inference backend models are loaded with (see
+    `MODEL_BACKENDS`)
     '''
-    if not model:
-        model = DEFAULT_MODEL
-    model_map = dict(
-        sgd=model_sgd,
-        adam=model_adam,
-        adam_w=model_adam_w)
-    return model_map.get(model, model_sgd)
+    model_registry.setBackend(backend)
+
+
+def warmUpModel(model: str = DEFAULT_MODEL) -> threading.Thread:
+    '''
+    Start loading the given model in the background
+    '''
+    return model_registry.warmUp(model)
+
+
+def releaseModels():
+    '''
+    Drop every loaded model and hand their memory back, e.g. after a
+    cancelled run
+    '''
+    model_registry.evict()
+    gc.collect()
+    # Only if a model already pulled in torch
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def score_order(scores):
+    '''
+    Returns the indices that sort boxes by score, highest first, with
+    boxes of equal score in their original order. Every NMS here goes
+    through it, so ties are broken the same way per image and across
+    images
+    '''
+    return np.argsort(-np.asarray(scores), kind='stable')
 
 
 def non_max_suppression(
+        boxes, scores, iou_threshold=0.5,
+        class_agnostic=False, class_labels=[],
+        block_size=256
+):
+    '''
+    Greedy NMS over [x1, y1, x2, y2] boxes, highest score first.
+    Gives the same selection as `greedy_non_max_suppression`.
+
+    Up to `block_size` boxes are compared all against all. Larger sets
+    use a uniform grid so only boxes in neighbouring cells are compared,
+    falling back to blocked IoU matrices when the grid can't help
+    (degenerate boxes, negative thresholds, or one huge box)
+    '''
+    sorted_indices = score_order(scores)
+    sorted_boxes = boxes[sorted_indices]
+    if len(sorted_boxes) == 0:
+        return np.array([]), []
+    sorted_classes = None
+    if not class_agnostic:
+        sorted_classes = np.asarray(class_labels)[sorted_indices]
+
+    keep = None
+    if len(sorted_boxes) > block_size:
+        keep = _gridNMS(sorted_boxes, sorted_classes, iou_threshold)
+    if keep is None:
+        keep = _blockedNMS(sorted_boxes, sorted_classes,
+                           iou_threshold, block_size)
+    return sorted_boxes[keep], list(sorted_indices[keep])
+
+
+def _blockedNMS(sorted_boxes, sorted_classes, iou_threshold, block_size):
+    '''
+    Returns the keep mask for score sorted boxes. Each block of
+    `block_size` boxes is checked against all boxes kept in earlier
+    blocks with one IoU matrix; only the greedy pass inside a block
+    is done box by box
+    '''
+    num_boxes = len(sorted_boxes)
+    keep = np.zeros(num_boxes, dtype=bool)
+    for start in range(0, num_boxes, block_size):
+        stop = min(start + block_size, num_boxes)
+        block = sorted_boxes[start:stop]
+        alive = np.ones(stop - start, dtype=bool)
+
+        # Suppress block boxes overlapping any box kept in earlier blocks
+        kept = np.flatnonzero(keep[:start])
+        if len(kept):
+            suppress = ~(compute_iou_matrix(
+                sorted_boxes[kept], block) <= iou_threshold)
+            if sorted_classes is not None:
+                suppress &= (sorted_classes[kept][:, None] ==
+                             sorted_classes[start:stop][None, :])
+            alive &= ~suppress.any(axis=0)
+
+        # Greedy pass within the block
+        suppress = ~(compute_iou_matrix(block, block) <= iou_threshold)
+        if sorted_classes is not None:
+            block_classes = sorted_classes[start:stop]
+            suppress &= block_classes[:, None] == block_classes[None, :]
+        for i in np.flatnonzero(alive):
+            if alive[i]:
+                keep[start + i] = True
+                alive[i + 1:] &= ~suppress[i, i + 1:]
+    return keep
+
+
+def _gridNMS(sorted_boxes, sorted_classes, iou_threshold,
+             max_pairs=4_000_000):
+    '''
+    Returns the keep mask for score sorted boxes, comparing only boxes
+    that intersect (see `_overlappingPairs`). Returns None if the grid
+    can't give exact results or would produce more than `max_pairs`
+    candidate pairs
+    '''
+    # Non-intersecting boxes can still be suppressed if the threshold is
+    # negative
+    if iou_threshold < 0:
+        return None
+    pairs = _overlappingPairs(sorted_boxes, max_pairs)
+    if pairs is None:
+        return None
+    first, second, ious = pairs
+    suppress = ious > iou_threshold
+    if sorted_classes is not None:
+        suppress &= sorted_classes[first] == sorted_classes[second]
+    return resolve_suppression(len(sorted_boxes), first[suppress],
+                               second[suppress])
+
+
+def _overlappingPairs(sorted_boxes, max_pairs=None):
+    '''
+    Returns (first, second, ious) for every pair of intersecting boxes,
+    with first < second, comparing only boxes whose top-left corners fall
+    in neighbouring grid cells. Cells are as large as the largest box
+    side, so no intersecting pair is missed. Returns None for zero area
+    boxes (whose IoU is undefined) or if there would be more than
+    `max_pairs` candidate pairs
+    '''
+    widths = sorted_boxes[:, 2] - sorted_boxes[:, 0]
+    heights = sorted_boxes[:, 3] - sorted_boxes[:, 1]
+    if not np.all(widths > 0) or not np.all(heights > 0):
+        return None
+    cell_size = max(widths.max(), heights.max())
+    cell_x = np.floor(sorted_boxes[:, 0] / cell_size).astype(np.int64)
+    cell_y = np.floor(sorted_boxes[:, 1] / cell_size).astype(np.int64)
+    cell_x -= cell_x.min()
+    cell_y -= cell_y.min() - 1
+    rows = cell_y.max() + 2
+    cell_keys = cell_x * rows + cell_y
+    by_cell = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[by_cell]
+
+    num_boxes = len(sorted_boxes)
+    first, second = [], []
+    num_pairs = 0
+    for dx in (-1, 0, 1):
+        # The cells above and below in a column have adjacent keys, so
+        # each column is one range. Looked up in cell order, as sorted
+        # lookups are much faster
+        column_keys = sorted_keys + dx * rows
+        lo = np.searchsorted(sorted_keys, column_keys - 1, side='left')
+        hi = np.searchsorted(sorted_keys, column_keys + 1, side='right')
+        counts = hi - lo
+        num_pairs += counts.sum()
+        if max_pairs is not None and num_pairs > max_pairs:
+            return None
+        i = by_cell[np.repeat(np.arange(num_boxes), counts)]
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        j = by_cell[np.repeat(lo, counts) + offsets]
+        # Keep each pair once, higher scoring box first
+        ordered = i < j
+        first.append(i[ordered])
+        second.append(j[ordered])
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+
+    box_i = sorted_boxes[first]
+    box_j = sorted_boxes[second]
+    x1 = np.maximum(box_i[:, 0], box_j[:, 0])
+    y1 = np.maximum(box_i[:, 1], box_j[:, 1])
+    x2 = np.minimum(box_i[:, 2], box_j[:, 2])
+    y2 = np.minimum(box_i[:, 3], box_j[:, 3])
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area_i = widths[first] * heights[first]
+    area_j = widths[second] * heights[second]
+    ious = inter_area / (area_i + area_j - inter_area)
+    intersecting = ious > 0
+    return first[intersecting], second[intersecting], ious[intersecting]
+
+
+def _shiftApart(boxes, image_ids):
+    '''
+    Returns a float copy of the [x1, y1, x2, y2] boxes shifted along x by
+    image id, leaving room for a grid cell (the largest box side) between
+    images, so boxes of different images never intersect or share cells
+    '''
+    shifted = np.array(boxes, dtype=float)
+    extent = max(np.ptp(shifted[:, [0, 2]]), np.ptp(shifted[:, [1, 3]]))
+    shift = np.asarray(image_ids) * (3 * extent + 1)
+    shifted[:, 0] += shift
+    shifted[:, 2] += shift
+    return shifted
+
+
+def overlapping_box_pairs(boxes, image_ids):
+    '''
+    Returns (first, second, ious) for every pair of intersecting
+    [x1, y1, x2, y2] boxes of the same image, first < second, for
+    `resolve_suppression`. Boxes should be sorted by score, highest
+    first, for first to be the box that suppresses. Returns None if a box
+    has zero area
+    '''
+    empty = np.zeros(0, dtype=np.int64)
+    if len(boxes) == 0:
+        return empty, empty, np.zeros(0)
+    return _overlappingPairs(_shiftApart(boxes, image_ids))
+
+
+def resolve_suppression(num_boxes, first, second):
+    '''
+    Returns the greedy NMS keep mask given every (higher scoring, lower
+    scoring) pair of boxes that overlap enough for the first to suppress
+    the second: a box is kept unless a kept box suppresses it. Settled
+    in rounds over all pairs at once instead of box by box; each round
+    settles at least the highest scoring box left, and usually far more
+    '''
+    keep = np.ones(num_boxes, dtype=bool)
+    undecided = np.zeros(num_boxes, dtype=bool)
+    undecided[second] = True
+    while len(first):
+        first_undecided = undecided[first]
+        removed = np.zeros(num_boxes, dtype=bool)
+        removed[second[~first_undecided & keep[first]]] = True
+        waiting = np.zeros(num_boxes, dtype=bool)
+        waiting[second[first_undecided]] = True
+        keep[removed] = False
+        undecided &= removed | waiting
+        undecided[removed] = False
+        active = undecided[second]
+        first = first[active]
+        second = second[active]
+    return keep
+
+
+def batched_non_max_suppression(boxes, scores, image_ids, iou_threshold=0.5,
+                                block_size=256):
+    '''
+    Class agnostic greedy NMS over the [x1, y1, x2, y2] boxes of many
+    images at once, giving the selection `non_max_suppression` gives on
+    each image. Boxes are shifted apart by image id so boxes of different
+    images never intersect, and a single pass over the score sorted boxes
+    of all images does the job. Returns the keep mask
+    '''
+    keep = np.zeros(len(boxes), dtype=bool)
+    if len(boxes) == 0:
+        return keep
+    order = score_order(scores)
+    sorted_boxes = _shiftApart(np.asarray(boxes)[order],
+                               np.asarray(image_ids)[order])
+    sorted_keep = None
+    if len(sorted_boxes) > block_size:
+        sorted_keep = _gridNMS(sorted_boxes, None, iou_threshold)
+    if sorted_keep is None:
+        sorted_keep = _blockedNMS(sorted_boxes, None, iou_threshold,
+                                  block_size)
+    keep[order] = sorted_keep
+    return keep
+
+
+def greedy_non_max_suppression(
         boxes, scores, iou_threshold=0.5,
         class_agnostic=False, class_labels=[]
 ):
-    sorted_indices = np.argsort(scores)[::-1]
+    '''
+    Reference box-by-box NMS, kept for benchmarking and result checks
+    against `non_max_suppression`
+    '''
+    sorted_indices = score_order(scores)
     sorted_boxes = boxes[sorted_indices]
     selected_boxes = []
     selected_indices = []
@@ -47,9 +558,9 @@ def non_max_suppression(
         else:
             current_class = class_labels[sorted_indices[0]]
             class_filter = class_labels[sorted_indices[1:]] == current_class
-            sorted_boxes = rest_boxes[ious <= iou_threshold | ~class_filter]
-            sorted_indices = sorted_indices[1:][ious <=
-                                                iou_threshold | ~class_filter]
+            remaining = (ious <= iou_threshold) | ~class_filter
+            sorted_boxes = rest_boxes[remaining]
+            sorted_indices = sorted_indices[1:][remaining]
 
     return np.array(selected_boxes), selected_indices
 
@@ -70,6 +581,26 @@ def compute_iou(box, boxes):
     return iou
 
 
+def compute_iou_matrix(boxes_a, boxes_b):
+    '''
+    IoU of every box in `boxes_a` against every box in `boxes_b`,
+    as a len(boxes_a) x len(boxes_b) matrix. Row i matches
+    compute_iou(boxes_a[i], boxes_b) exactly
+    '''
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    union_area = area_a[:, None] + area_b[None, :] - inter_area
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return inter_area / union_area
+
+
 def convert_to_corners(pred):
     # Convert from [x_center, y_center, width, height] to [x1, y1, x2, y2]
     x_center, y_center, width, height = (pred[:, 1], pred[:, 2],
@@ -100,63 +631,593 @@ def convert_to_yolo_format(pred, selected_boxes, selected_indices):
     return selected_pred
 
 
+def _estimateImageBytes(source, filename):
+    '''
+    Estimate the decoded (RGB) size of an image from its header,
+    falling back to the encoded size if the header can't be read
+    '''
+    size = source.imageSize(filename)
+    if size is None:
+        return len(source.read(filename))
+    width, height = size
+    return width * height * 3
+
+
+def _batchImages(source, filenames, batch_size=1, batch_memory_mb=None):
+    '''
+    Group images into batches of at most `batch_size` images.
+    If `batch_memory_mb` is given, a batch is also closed once the
+    estimated decoded size of its images would exceed the budget.
+    Every batch holds at least one image.
+    '''
+    batch_size = max(1, batch_size)
+    budget = None if batch_memory_mb is None else batch_memory_mb * 1024 ** 2
+    batch = []
+    batch_bytes = 0
+    for filename in filenames:
+        image_bytes = 0
+        if budget is not None:
+            image_bytes = _estimateImageBytes(source, filename)
+        if batch and (len(batch) >= batch_size or (
+                budget is not None and batch_bytes + image_bytes > budget)):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(filename)
+        batch_bytes += image_bytes
+    if batch:
+        yield batch
+
+
+def filterPredictions(pred, iou_threshold=0.5):
+    '''
+    Run the custom NMS over YOLO formatted predictions
+    ([class, x_center, y_center, width, height, confidence] rows)
+    and return the selected rows in the same format
+    '''
+    class_labels = pred[:, 0]
+    boxes = convert_to_corners(pred)  # Convert to corner format for NMS
+    scores = pred[:, 5]  # Confidence scores are at index 5
+    selected_boxes, selected_indices = non_max_suppression(
+        boxes, scores,
+        iou_threshold=iou_threshold, class_agnostic=True,
+        class_labels=class_labels)
+    # Convert back to YOLO format
+    return convert_to_yolo_format(pred, selected_boxes, selected_indices)
+
+
+def filterRawPredictions(raw_pred, conf=0.25, iou_threshold=0.5):
+    '''
+    Filter raw predictions, kept at a lower confidence threshold, down to
+    what a run with `conf` would have found: boxes above `conf` (the
+    model keeps boxes strictly above its threshold), then NMS
+    '''
+    pred = raw_pred[raw_pred[:, 5] > conf]
+    if len(pred) == 0:
+        return pred
+    return filterPredictions(pred, iou_threshold=iou_threshold)
+
+
+def countPredictions(pred):
+    '''
+    Returns the (unfertilized, fertilized) counts for YOLO formatted
+    predictions. Class 0 is fertilized, everything else unfertilized
+    '''
+    num_fertilized = int(np.count_nonzero(pred[:, 0] == 0))
+    return len(pred) - num_fertilized, num_fertilized
+
+
+def _toNumpy(values):
+    '''
+    Convert a torch tensor (on any device) or array-like to a numpy array
+    '''
+    if hasattr(values, 'cpu'):
+        values = values.cpu().numpy()
+    return np.asarray(values, dtype=float)
+
+
+def resultToPred(result):
+    '''
+    Convert an ultralytics `Results` object to YOLO formatted predictions
+    ([class, x_center, y_center, width, height, confidence] rows with
+    normalized coordinates), the same layout save_txt/save_conf writes.
+    Models that already return predictions in that layout (the stub model,
+    the inference server client) are passed through
+    '''
+    if isinstance(result, np.ndarray):
+        return result
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 6))
+    return np.column_stack([
+        _toNumpy(boxes.cls),
+        _toNumpy(boxes.xywhn).reshape(-1, 4),
+        _toNumpy(boxes.conf)])
+
+
+def _loadLabels(pred_path):
+    '''
+    Load YOLO formatted predictions from a label file.
+    Returns None if the file doesn't exist
+    '''
+    if not os.path.exists(pred_path):
+        return None
+    pred = np.loadtxt(pred_path)
+    if pred.ndim == 1:
+        # Ensure pred is 2D for a single prediction case
+        pred = np.expand_dims(pred, axis=0)
+    return pred
+
+
+def _tileOrigins(length, tile_size, tile_overlap):
+    '''
+    Returns the start offsets of overlapping tiles covering `length` pixels.
+    The last tile is aligned with the end so every tile is full size
+    '''
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - tile_overlap)))
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def _isCutAtSeam(pred, origin, tile_size, image_size, overlap_px,
+                 edge_px=1):
+    '''
+    Returns a mask of the tile predictions that touch an inner tile edge
+    (one that isn't also an image edge) and are smaller than the overlap
+    along that axis
+    '''
+    cut = np.zeros(len(pred), dtype=bool)
+    for axis in (0, 1):
+        start = origin[axis]
+        length = tile_size[axis]
+        center = pred[:, 1 + axis] * length
+        extent = pred[:, 3 + axis] * length
+        low = center - extent / 2
+        high = center + extent / 2
+        small = extent < overlap_px
+        if start > 0:
+            cut |= small & (low <= edge_px)
+        if start + length < image_size[axis]:
+            cut |= small & (high >= length - edge_px)
+    return cut
+
+
+def _predictTiled(prediction_model, pixels, tile_size, tile_overlap,
+                  tile_batch_mb, predict_kwargs):
+    '''
+    Run the model on overlapping `tile_size` tiles of a BGR image, batching
+    as many tiles as fit in `tile_batch_mb` megabytes per predict call.
+    Returns the YOLO formatted predictions of all tiles mapped back to
+    normalized image coordinates.
+
+    Boxes cut by an inner tile edge are dropped when they are narrower than
+    the overlap, since the neighbouring tile then sees the whole embryo.
+    Remaining duplicates along the seams are left for the NMS pass to merge
+    '''
+    image_height, image_width = pixels.shape[:2]
+    tiles = [(x, y)
+             for y in _tileOrigins(image_height, tile_size, tile_overlap)
+             for x in _tileOrigins(image_width, tile_size, tile_overlap)]
+    tiles_per_batch = max(
+        1, int(tile_batch_mb * 1024 ** 2 // (tile_size * tile_size * 3)))
+    overlap_px = tile_size * tile_overlap
+
+    tile_preds = []
+    for start in range(0, len(tiles), tiles_per_batch):
+        batch = tiles[start:start + tiles_per_batch]
+        crops = [np.ascontiguousarray(pixels[y:y + tile_size,
+                                             x:x + tile_size])
+                 for x, y in batch]
+        results = prediction_model.predict(
+            source=crops, batch=len(crops), save_txt=False,
+            **predict_kwargs)
+        for (x, y), crop, result in zip(batch, crops, results):
+            pred = resultToPred(result)
+            if len(pred) == 0:
+                continue
+            tile_height, tile_width = crop.shape[:2]
+            pred = pred[~_isCutAtSeam(
+                pred, (x, y), (tile_width, tile_height),
+                (image_width, image_height), overlap_px)]
+            pred[:, 1] = (pred[:, 1] * tile_width + x) / image_width
+            pred[:, 2] = (pred[:, 2] * tile_height + y) / image_height
+            pred[:, 3] = pred[:, 3] * tile_width / image_width
+            pred[:, 4] = pred[:, 4] * tile_height / image_height
+            tile_preds.append(pred)
+    if not tile_preds:
+        return np.zeros((0, 6))
+    return np.concatenate(tile_preds)
+
+
+def detectionSettings(conf: float = 0.25, iou_threshold: float = 0.5,
+                      max_det: int = 500,
+                      tile_size: typing.Optional[int] = None,
+                      tile_overlap: float = 0.2, **_) -> dict:
+    '''
+    Returns the `runDetection` settings that change its results, which
+    key the detection cache and the journal. Other keyword arguments are
+    ignored, so `runDetection` keyword arguments can be passed as they are
+    '''
+    return dict(
+        conf=conf, iou_threshold=iou_threshold, max_det=max_det,
+        tile_size=tile_size, tile_overlap=tile_overlap if tile_size else None)
+
+
 def runDetection(prediction_dir,
                  model: str = DEFAULT_MODEL,
                  progress_callback: typing.Optional[
                      Callable[
-                         [int], None]] = None):
+                         [int], None]] = None,
+                 batch_size: int = 1,
+                 batch_memory_mb: typing.Optional[float] = None,
+                 in_memory: bool = False,
+                 save_labels: bool = False,
+                 tile_size: typing.Optional[int] = None,
+                 tile_overlap: float = 0.2,
+                 tile_batch_mb: float = 512,
+                 result_callback: typing.Optional[
+                     Callable[[str, str, np.ndarray], None]] = None,
+                 source: typing.Optional[ImageSource] = None,
+                 conf: float = 0.25,
+                 iou_threshold: float = 0.5,
+                 max_det: int = 500,
+                 cache: typing.Optional[DetectionCache] = None,
+                 server_url: typing.Optional[str] = None,
+                 metrics: typing.Optional[Metrics] = None,
+                 journal: typing.Optional[RunJournal] = None,
+                 control: typing.Optional[JobControl] = None,
+                 results_writer: typing.Optional[ResultsWriter] = None,
+                 budget: typing.Optional[MemoryBudget] = None,
+                 raw_conf: typing.Optional[float] = None,
+                 model_label: typing.Optional[str] = None):
+    '''
+    Run the detection model on every image in `prediction_dir`, or in
+    `source` if given (e.g. a zip archive that hasn't been extracted).
+    Results are always written under `prediction_dir`.
+
+    Images are sent to the model in batches of up to `batch_size` images.
+    If `batch_memory_mb` is set, batches are additionally capped so the
+    decoded images of a batch stay within that many megabytes.
+
+    By default the model writes its raw labels to disk, which are read
+    back and filtered. With `in_memory` the boxes are taken straight from
+    the model results instead. Images that aren't on disk are decoded on a
+    background thread while the model runs, and always use the in memory
+    path.
+
+    If `tile_size` is set, images larger than `tile_size` pixels on either
+    side are cut into tiles overlapping by `tile_overlap` (a fraction of
+    the tile size), which are run in batches of at most `tile_batch_mb`
+    megabytes. Tiled runs always use the in memory path.
+
+    `result_callback` is called as soon as an image's filtered predictions
+    are final, with the image file name in the source, its
+    "<name> <unfertilized> <fertilized>" count line and the YOLO formatted
+    predictions.
 
+    `conf` is the minimum confidence for a detection, `iou_threshold` the
+    overlap above which NMS drops the lower scoring box and `max_det` the
+    maximum number of detections per image (or per tile).
+    If a `cache` is given, images already detected with the same model
+    and settings reuse the cached filtered predictions instead of running
+    the model.
+    `model` is a model name, or an already loaded model. The cache and the
+    journal tell the results of loaded models apart by `model_label`,
+    which must be given to use either with one.
+    With `server_url` the images are sent to the inference server at that
+    url (see server.py) instead of loading the model in this process.
+    Per stage timings are recorded in `metrics` if given (see
+    instrumentation.py).
+    If a `journal` is given, every finished image is recorded in it as
+    soon as it is done, and images a previous, interrupted run with the
+    same settings recorded are taken from it instead of detected again
+    (they are still passed to `result_callback`). The caller removes the
+    journal once the run is complete.
+    With a `control`, the run can be paused, resumed and cancelled
+    between batches (see jobcontrol.py). A cancelled run raises
+    `JobCancelled` after dropping its partial results and decoded images;
+    a journal keeps the images finished so far.
+
+    The filtered detections of all images are saved in a single results
+    store (see resultstore.py) at:
+        prediction_dir > predict > detections.bin
+    and the per image counts at:
+        prediction_dir > predict > prediction_counts.txt
+    With `save_labels` the filtered detections are also exported as YOLO
+    label files at:
+        prediction_dir > predict > labels > <image name>.txt
+    If a `results_writer` is given, the detections are added to it
+    instead, e.g. to collect several runs in one store, and neither the
+    store nor the counts file is written; the caller closes the writer.
+
+    With a `budget` (see memorybudget.py), decoded images, batches in the
+    model and predictions waiting for NMS are reserved in it, and
+    decoding ahead or starting the next batch waits while it is used up.
+    Unless `batch_memory_mb` says otherwise, a batch then takes at most
+    half of the budget, so the next one can be decoded meanwhile.
+
+    With `raw_conf`, the model keeps boxes down to that confidence, and
+    these raw detections (before `conf` and NMS are applied) are saved as
+    well, so the run can be counted again at other thresholds without the
+    model (see recount.py):
+        prediction_dir > predict > raw_detections.bin
+    The cache and the journal then hold raw detections too
+    '''
+    if (not isinstance(model, str) and model_label is None
+            and (cache is not None or journal is not None)):
+        raise ValueError("Pass the model_label of the loaded model to cache "
+                         "or journal its detections")
     os.makedirs(prediction_dir, exist_ok=True)
+    if metrics is None:
+        metrics = NULL_METRICS
+    if source is None:
+        source = DirectoryImageSource(prediction_dir)
+    with metrics.stage("list_images"):
+        filenames = source.names()
+    on_disk = all(source.path(filename) is not None
+                  for filename in filenames)
+    if control is not None:
+        control.checkpoint()
+    if not isinstance(model, str):
+        prediction_model = model
+    elif server_url:
+        prediction_model = RemoteModel(server_url, model)
+    else:
+        with metrics.stage("load_model"):
+            prediction_model = getModelFromLabel(model)
+    if (tile_size or not on_disk
+            or getattr(prediction_model, 'in_memory_only', False)):
+        in_memory = True
+    if budget is not None and budget.limit:
+        # Leave room in the budget for decoding ahead and annotating
+        budget_batch_mb = budget.limit / 2 / 1024 ** 2
+        if batch_memory_mb is None or batch_memory_mb > budget_batch_mb:
+            batch_memory_mb = budget_batch_mb
     processed_img_count = 0
     predictions = []
-    prediction_model = getModelFromLabel(model)
-    for image in os.listdir(prediction_dir):
-        if progress_callback is not None:
-            progress_callback(processed_img_count)
-        image_path = os.path.join(prediction_dir, image)
-        name = os.path.splitext(image)[0]
-        if os.path.isdir(image_path):
-            continue
-        prediction_model.predict(
-            source=image_path, classes=[0, 1],
-            project=prediction_dir, agnostic_nms=True,
-            conf=0.25, max_det=500, save=False,
-            save_txt=True, save_conf=True,
-            show_labels=False, show_conf=False,
-            show_boxes=True, line_width=3, exist_ok=True)
-
-        # Apply NMS
-        # Load the predicted labels from YOLO
-        pred_path = os.path.join(
-            prediction_dir, 'predict', 'labels', f'{name}.txt')
-        if not os.path.exists(pred_path):
-            continue  # Skip if the label file doesn't exist
-
-        pred = np.loadtxt(pred_path)
-        if pred.ndim == 1:
-            # Ensure pred is 2D for a single prediction case
-            pred = np.expand_dims(pred, axis=0)
-
-        if len(pred) == 0:
-            continue  # Skip if there are no predictions
-
-        class_labels = pred[:, 0]
-        boxes = convert_to_corners(pred)  # Convert to corner format for NMS
-        scores = pred[:, 5]  # Confidence scores are at index 5
-        selected_boxes, selected_indices = non_max_suppression(
-            boxes, scores,
-            iou_threshold=0.5, class_agnostic=True,
-            class_labels=class_labels)
-        # Convert back to YOLO format
-        pred = convert_to_yolo_format(pred, selected_boxes, selected_indices)
-        num_fertilized = sum(
-            1 if pred_line[0] == 0 else 0 for pred_line in pred)
-        num_unfertilized = len(pred) - num_fertilized
-        predictions.append(f"{name} {num_unfertilized} {num_fertilized}")
-        # Save the filtered predictions
-        np.savetxt(pred_path, pred, fmt='%f')
-        processed_img_count += 1
-    with open(
+    owns_results = results_writer is None
+    if owns_results:
+        results_writer = ResultsWriter(resultsPath(prediction_dir))
+    raw_writer = None
+    if raw_conf is not None and owns_results:
+        raw_writer = ResultsWriter(rawResultsPath(prediction_dir))
+    elif owns_results:
+        # Raw detections of an earlier run would no longer match
+        removeRawResults(prediction_dir)
+    labels_dir = os.path.join(prediction_dir, 'predict', 'labels')
+    predict_kwargs = dict(
+        classes=[0, 1],
+        project=prediction_dir, agnostic_nms=True,
+        conf=conf if raw_conf is None else min(conf, raw_conf),
+        max_det=max_det, save=False,
+        save_conf=True,
+        show_labels=False, show_conf=False,
+        show_boxes=True, line_width=3, exist_ok=True)
+    cache_settings = detectionSettings(conf, iou_threshold, max_det,
+                                       tile_size, tile_overlap)
+    journal_settings = cache_settings
+    if raw_conf is not None:
+        # Raw detections don't depend on the thresholds applied later
+        cache_settings = dict(
+            detectionSettings(raw_conf, None, max_det, tile_size,
+                              tile_overlap), raw=True)
+        journal_settings = dict(journal_settings, raw_conf=raw_conf)
+    if isinstance(model, str) and server_url:
+        model_label = prediction_model.resultLabel()
+    elif isinstance(model, str):
+        model_label = model_registry.resultLabel(model)
+    if not in_memory:
+        os.makedirs(labels_dir, exist_ok=True)
+    if journal is not None:
+        journal.start(dict(model=model_label, **journal_settings))
+        remaining = []
+        for filename in filenames:
+            name = os.path.splitext(filename)[0]
+            if name not in journal.detections:
+                remaining.append(filename)
+                continue
+            if progress_callback is not None:
+                progress_callback(processed_img_count)
+            pred, num_unfertilized, num_fertilized = journal.detections[name]
+            if raw_conf is not None:
+                if raw_writer is not None:
+                    raw_writer.add(name, pred, num_unfertilized,
+                                   num_fertilized)
+                pred = filterRawPredictions(pred, conf, iou_threshold)
+            results_writer.add(name, pred, num_unfertilized, num_fertilized)
+            if len(pred) == 0:
+                continue
+            prediction = f"{name} {num_unfertilized} {num_fertilized}"
+            predictions.append(prediction)
+            processed_img_count += 1
+            if result_callback is not None:
+                result_callback(filename, prediction, pred)
+        filenames = remaining
+    # Models taking encoded images (the inference server, which decodes
+    # them itself) are sent the bytes as they are in the source
+    encoded_input = getattr(prediction_model, 'encoded_input', False)
+    decoded = None
+    if not on_disk and not encoded_input:
+        decoded = source.iterDecoded(filenames, prefetch=max(4, batch_size),
+                                     metrics=metrics, budget=budget)
+
+    def checkpoint():
+        try:
+            control.checkpoint()
+        except JobCancelled:
+            # Release everything held for the run right away
+            if decoded is not None:
+                decoded.close()
+            if owns_results:
+                results_writer.abort()
+            if raw_writer is not None:
+                raw_writer.abort()
+            if journal is not None:
+                journal.sync()
+            raise
+
+    for batch in _batchImages(source, filenames, batch_size,
+                              batch_memory_mb):
+        if control is not None:
+            checkpoint()
+        names = [os.path.splitext(filename)[0] for filename in batch]
+        if decoded is not None:
+            inputs = []
+            with metrics.stage("wait_decoded"):
+                try:
+                    for _ in batch:
+                        image = next(decoded)[1]
+                        # Taken into the batch right away, so decoding the
+                        # rest of the batch doesn't wait on it
+                        if budget is not None:
+                            budget.move("decode", "inference", image.nbytes)
+                        inputs.append(image)
+                except Exception:
+                    # e.g. an image that can't be decoded
+                    if budget is not None:
+                        budget.release(
+                            "inference",
+                            sum(image.nbytes for image in inputs),
+                            len(inputs))
+                    raise
+            batch_bytes = sum(image.nbytes for image in inputs)
+        else:
+            inputs = [source.path(filename) or source.read(filename)
+                      for filename in batch]
+            if budget is not None:
+                batch_bytes = sum(_estimateImageBytes(source, filename)
+                                  for filename in batch)
+                with metrics.stage("wait_budget"):
+                    budget.acquire("inference", batch_bytes, len(batch))
+        batch_preds = [None] * len(batch)
+        cache_keys = [None] * len(batch)
+        todo = list(range(len(batch)))
+        if cache is not None:
+            todo = []
+            for i, filename in enumerate(batch):
+                with metrics.stage("cache_lookup", names[i]):
+                    image_bytes = inputs[i] if isinstance(
+                        inputs[i], bytes) else source.read(filename)
+                    cache_keys[i] = DetectionCache.key(
+                        image_bytes, model_label, **cache_settings)
+                    batch_preds[i] = cache.get(cache_keys[i])
+                if batch_preds[i] is None:
+                    todo.append(i)
+        whole = todo
+        if tile_size:
+            whole = []
+            for i in todo:
+                filename, image = batch[i], inputs[i]
+                if isinstance(image, np.ndarray):
+                    size = image.shape[:2]
+                else:
+                    size = source.imageSize(filename)
+                if size is not None and max(size) > tile_size:
+                    if not isinstance(image, np.ndarray):
+                        with metrics.stage("decode", names[i]):
+                            image = source.loadArray(filename)
+                    with metrics.stage("tiled_inference", names[i]):
+                        batch_preds[i] = _predictTiled(
+                            prediction_model, image, tile_size,
+                            tile_overlap, tile_batch_mb, predict_kwargs)
+                else:
+                    whole.append(i)
+        if whole:
+            sources = [inputs[i] for i in whole]
+            with metrics.stage("inference",
+                               ' '.join(names[i] for i in whole)):
+                results = prediction_model.predict(
+                    source=sources if len(sources) > 1 else sources[0],
+                    batch=len(sources), save_txt=not in_memory,
+                    **predict_kwargs)
+            for i, result in zip(whole, results):
+                if in_memory:
+                    batch_preds[i] = resultToPred(result)
+                else:
+                    # Load the predicted labels from YOLO, the filtered
+                    # ones go to the results store
+                    label_path = os.path.join(labels_dir, f'{names[i]}.txt')
+                    with metrics.stage("label_read", names[i]):
+                        batch_preds[i] = _loadLabels(label_path)
+                    if batch_preds[i] is not None:
+                        os.remove(label_path)
+            results = sources = None
+        # Drop the images (results hold on to them too) before the next
+        # batch is read
+        inputs = None
+        if budget is not None:
+            budget.release("inference", batch_bytes, len(batch))
+            nms_bytes = [0 if pred is None else pred.nbytes
+                         for pred in batch_preds]
+            budget.acquire("nms", sum(nms_bytes), len(batch))
+
+        for i, (filename, name, pred) in enumerate(
+                zip(batch, names, batch_preds)):
+            if progress_callback is not None:
+                progress_callback(processed_img_count)
+            raw_pred = None
+            if raw_conf is not None:
+                # Cached raw predictions still need filtering
+                raw_pred = pred if pred is not None else np.zeros((0, 6))
+                if i in todo and cache is not None:
+                    with metrics.stage("cache_store", name):
+                        cache.put(cache_keys[i], raw_pred)
+                with metrics.stage("nms", name):
+                    pred = filterRawPredictions(raw_pred, conf, iou_threshold)
+            # Cached predictions have already been filtered
+            elif i in todo:
+                if pred is not None and len(pred):
+                    # Apply NMS
+                    with metrics.stage("nms", name):
+                        pred = filterPredictions(
+                            pred, iou_threshold=iou_threshold)
+                if cache is not None:
+                    with metrics.stage("cache_store", name):
+                        cache.put(cache_keys[i], pred if pred is not None
+                                  else np.zeros((0, 6)))
+            if budget is not None:
+                budget.release("nms", nms_bytes[i])
+            if pred is None or len(pred) == 0:
+                with metrics.stage("results_write", name):
+                    results_writer.add(name, None)
+                    if raw_writer is not None:
+                        raw_writer.add(name, raw_pred)
+                    if journal is not None:
+                        journal.recordDetection(name, raw_pred)
+                continue  # Skip if there are no predictions
+
+            num_unfertilized, num_fertilized = countPredictions(pred)
+            with metrics.stage("results_write", name):
+                results_writer.add(name, pred, num_unfertilized,
+                                   num_fertilized)
+                if raw_writer is not None:
+                    raw_writer.add(name, raw_pred, num_unfertilized,
+                                   num_fertilized)
+                if journal is not None:
+                    journal.recordDetection(
+                        name, pred if raw_pred is None else raw_pred,
+                        num_unfertilized, num_fertilized)
+            prediction = f"{name} {num_unfertilized} {num_fertilized}"
+            predictions.append(prediction)
+            processed_img_count += 1
+            if result_callback is not None:
+                result_callback(filename, prediction, pred)
+        if journal is not None:
+            with metrics.stage("journal_sync"):
+                journal.sync()
+
+    if not owns_results:
+        return predictions
+    with metrics.stage("results_close"):
+        results_writer.close()
+        if raw_writer is not None:
+            raw_writer.close()
+    if save_labels:
+        with metrics.stage("label_write"), \
+                ResultsStore(results_writer.path) as store:
+            store.exportYOLOLabels(labels_dir)
+    with metrics.stage("counts_write"), open(
             os.path.join(prediction_dir, 'predict', 'prediction_counts.txt'),
             'w+') as f:
         f.write('\n'.join(predictions))
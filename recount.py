@@ -0,0 +1,197 @@
+'''
+Counting a finished run again at other confidence and IoU thresholds,
+without running the model. `runDetection(raw_conf=...)` keeps the raw
+detections of the run (see resultstore.RAW_RESULTS_FILE_NAME); the
+confidence threshold and NMS are then applied to the boxes of all images
+at once, which takes milliseconds instead of a full detection run.
+'''
+import os
+import typing
+from collections.abc import Mapping
+
+import numpy as np
+
+from predict import (batched_non_max_suppression, convert_to_corners,
+                     overlapping_box_pairs, resolve_suppression,
+                     score_order)
+from resultstore import ResultsStore, ResultsWriter, resultsPath
+
+# Confidence raw detections are kept down to by default, the lowest
+# threshold a run can be counted again at
+RAW_CONF = 0.05
+# Highest IoU threshold worth counting again at: the model already
+# suppresses boxes overlapping more than that before NMS is applied
+MAX_IOU_THRESHOLD = 0.7
+
+
+class Recounter():
+    '''
+    Counts the images of a run at any confidence and IoU thresholds,
+    from the raw detections store the run wrote. Boxes are sorted by
+    confidence and the overlapping pairs among them found once, when
+    opened; each confidence threshold is then a prefix of the boxes, and
+    NMS only has to settle the pairs overlapping more than the IoU
+    threshold
+
+    :param path: Path of the raw detections store
+    '''
+
+    def __init__(self, path: typing.Union[str, os.PathLike]):
+        self.store = ResultsStore(path)
+        self.names = self.store.names
+        conf = np.asarray(self.store.conf, dtype=float)
+        self._order = score_order(conf)
+        self._conf = conf[self._order]
+        self._image_id = np.asarray(self.store.image_id)[self._order]
+        self._fertilized = np.asarray(self.store.cls)[self._order] == 0
+        pred = np.zeros((len(self._order), 6))
+        pred[:, 1:5] = self.store.box[self._order]
+        self._corners = convert_to_corners(pred)
+        pairs = overlapping_box_pairs(self._corners, self._image_id)
+        if pairs is not None:
+            first, second, ious = pairs
+            self._pairs = (first.astype(np.int32), second.astype(np.int32),
+                           ious)
+        else:
+            self._pairs = None
+        self._cached = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        return False
+
+    def keep(self, conf: float = 0.25,
+             iou_threshold: float = 0.5) -> np.ndarray:
+        '''
+        Returns the store positions of the boxes a run with these
+        thresholds would have kept, in image order
+        '''
+        if self._cached is not None and self._cached[0] == (
+                conf, iou_threshold):
+            return self._cached[1]
+        # Boxes strictly above the threshold, as the model keeps them
+        count = int(np.searchsorted(-self._conf, -conf, side='left'))
+        if self._pairs is not None and iou_threshold >= 0:
+            first, second, ious = self._pairs
+            # Pairs are ordered, so the second box is the lower scoring one
+            active = (second < count) & (ious > iou_threshold)
+            keep = resolve_suppression(count, first[active], second[active])
+        else:
+            keep = batched_non_max_suppression(
+                self._corners[:count], self._conf[:count],
+                self._image_id[:count], iou_threshold)
+        kept = np.sort(self._order[:count][keep])
+        self._cached = ((conf, iou_threshold), kept)
+        return kept
+
+    def counts(self, conf: float = 0.25,
+               iou_threshold: float = 0.5) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns the per image (unfertilized, fertilized) counts at the
+        given thresholds, as arrays in image order
+        '''
+        kept = self.keep(conf, iou_threshold)
+        image_id = self.store.image_id[kept]
+        fertilized = self.store.cls[kept] == 0
+        num_images = len(self.names)
+        num_fertilized = np.bincount(
+            image_id[fertilized], minlength=num_images)
+        num_unfertilized = np.bincount(
+            image_id[~fertilized], minlength=num_images)
+        return num_unfertilized, num_fertilized
+
+    def countLines(self, conf: float = 0.25,
+                   iou_threshold: float = 0.5) -> list[str]:
+        '''
+        Returns "<name> <unfertilized> <fertilized>" lines for the images
+        with detections at the given thresholds, as in
+        prediction_counts.txt
+        '''
+        num_unfertilized, num_fertilized = self.counts(conf, iou_threshold)
+        return [f"{self.names[i]} {num_unfertilized[i]} {num_fertilized[i]}"
+                for i in np.flatnonzero(num_unfertilized + num_fertilized)]
+
+    def pred(self, image: typing.Union[int, str], conf: float = 0.25,
+             iou_threshold: float = 0.5) -> np.ndarray:
+        '''
+        Returns the YOLO formatted predictions of an image (by id or
+        name) at the given thresholds
+        '''
+        if isinstance(image, str):
+            image = self.store.index(image)
+        kept = self.keep(conf, iou_threshold)
+        offsets = self.store.offsets
+        kept = kept[np.searchsorted(kept, offsets[image]):
+                    np.searchsorted(kept, offsets[image + 1])]
+        return np.column_stack([
+            self.store.cls[kept], self.store.box[kept],
+            self.store.conf[kept]]).astype(float)
+
+    def write(self, prediction_dir: typing.Union[str, os.PathLike],
+              conf: float = 0.25, iou_threshold: float = 0.5) -> list[str]:
+        '''
+        Replace the results of the run (detections.bin and
+        prediction_counts.txt in prediction_dir > predict) with the
+        detections at the given thresholds, e.g. before annotating images
+        or exporting labels. Returns the count lines
+        '''
+        kept = self.keep(conf, iou_threshold)
+        num_unfertilized, num_fertilized = self.counts(conf, iou_threshold)
+        bounds = np.searchsorted(kept, self.store.offsets)
+        with ResultsWriter(resultsPath(prediction_dir)) as writer:
+            for i, name in enumerate(self.names):
+                boxes = kept[bounds[i]:bounds[i + 1]]
+                writer.add(name, np.column_stack([
+                    self.store.cls[boxes], self.store.box[boxes],
+                    self.store.conf[boxes]]),
+                    int(num_unfertilized[i]), int(num_fertilized[i]))
+        lines = self.countLines(conf, iou_threshold)
+        with open(os.path.join(prediction_dir, 'predict',
+                               'prediction_counts.txt'), 'w+') as f:
+            f.write('\n'.join(lines))
+        return lines
+
+    def close(self):
+        self.store.close()
+
+
+class ThresholdPredictions(Mapping):
+    '''
+    Read only mapping from the file names of the images with detections
+    at the given thresholds to their YOLO formatted predictions, which
+    are only worked out when looked up, e.g. as the carousel shows them
+
+    :param recounter: Recounter of the run
+    :param filenames: File names of the images of the run
+    :param conf: Confidence threshold
+    :param iou_threshold: IoU threshold
+    '''
+
+    def __init__(self, recounter: Recounter, filenames: typing.Iterable[str],
+                 conf: float = 0.25, iou_threshold: float = 0.5):
+        self.recounter = recounter
+        self.conf = conf
+        self.iou_threshold = iou_threshold
+        num_unfertilized, num_fertilized = recounter.counts(
+            conf, iou_threshold)
+        detected = {recounter.names[i] for i in np.flatnonzero(
+            num_unfertilized + num_fertilized)}
+        self._filenames = [filename for filename in filenames
+                           if os.path.splitext(filename)[0] in detected]
+        self._names = {filename: os.path.splitext(filename)[0]
+                       for filename in self._filenames}
+
+    def __getitem__(self, filename: str) -> np.ndarray:
+        if filename not in self._names:
+            raise KeyError(filename)
+        return self.recounter.pred(self._names[filename], self.conf,
+                                   self.iou_threshold)
+
+    def __iter__(self):
+        return iter(self._filenames)
+
+    def __len__(self) -> int:
+        return len(self._filenames)
@@ -0,0 +1,259 @@
+'''
+Single file, columnar store for the detections of a run, replacing one
+YOLO label text file per image.
+
+Layout (little endian):
+    b"FROGDET1" | uint64 header size | JSON header | columns
+The JSON header holds the image names and, for every column, its dtype,
+shape and byte offset. Columns start on 64 byte boundaries so they can be
+memory-mapped as numpy arrays without copying:
+    per box:   image_id (uint32), cls (uint8),
+               box (float32 x_center, y_center, width, height, normalized),
+               conf (float32)
+    per image: offsets (int64, boxes of image i are offsets[i]:offsets[i+1]),
+               unfertilized (int32), fertilized (int32)
+'''
+import json
+import os
+import shutil
+import typing
+
+import numpy as np
+
+RESULTS_FILE_NAME = "detections.bin"
+# Detections before the confidence threshold and NMS, see recount.py
+RAW_RESULTS_FILE_NAME = "raw_detections.bin"
+MAGIC = b"FROGDET1"
+VERSION = 1
+_ALIGNMENT = 64
+_BOX_COLUMNS = dict(image_id='<u4', cls='u1', box='<f4', conf='<f4')
+_IMAGE_COLUMNS = dict(offsets='<i8', unfertilized='<i4', fertilized='<i4')
+
+
+def resultsPath(prediction_dir: typing.Union[str, os.PathLike]) -> str:
+    '''
+    Returns where `runDetection` stores the results of `prediction_dir`
+    '''
+    return os.path.join(prediction_dir, 'predict', RESULTS_FILE_NAME)
+
+
+def rawResultsPath(prediction_dir: typing.Union[str, os.PathLike]) -> str:
+    '''
+    Returns where `runDetection` stores the raw detections of
+    `prediction_dir`, if it keeps them
+    '''
+    return os.path.join(prediction_dir, 'predict', RAW_RESULTS_FILE_NAME)
+
+
+def removeRawResults(prediction_dir: typing.Union[str, os.PathLike]):
+    '''
+    Remove the raw detections of an earlier run in `prediction_dir`, if
+    any, when a run that doesn't keep them replaces its results
+    '''
+    try:
+        os.remove(rawResultsPath(prediction_dir))
+    except FileNotFoundError:
+        pass
+
+
+def _padding(position: int) -> bytes:
+    return b"\0" * (-position % _ALIGNMENT)
+
+
+class ResultsWriter():
+    '''
+    Writes the detections of a run image by image. Box columns are
+    appended to spill files next to the store as images come in, so memory
+    use doesn't grow with the run; `close` assembles the store and
+    atomically replaces any previous one
+
+    :param path: Path of the store to write
+    '''
+
+    def __init__(self, path: typing.Union[str, os.PathLike]):
+        self.path = os.fspath(path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.names = []
+        self._counts = []
+        self._sizes = []
+        self._num_boxes = 0
+        self._spills = {column: open(f"{self.path}.{column}.tmp", 'wb')
+                        for column in _BOX_COLUMNS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def add(self, name: str, pred: typing.Optional[np.ndarray],
+            num_unfertilized: int = 0, num_fertilized: int = 0):
+        '''
+        Add the YOLO formatted predictions ([class, x_center, y_center,
+        width, height, confidence] rows) of an image and its counts
+        '''
+        image_id = len(self.names)
+        self.names.append(name)
+        self._counts.append((num_unfertilized, num_fertilized))
+        if pred is None or len(pred) == 0:
+            self._sizes.append(0)
+            return
+        pred = np.asarray(pred).reshape(-1, 6)
+        columns = dict(
+            image_id=np.full(len(pred), image_id),
+            cls=pred[:, 0], box=pred[:, 1:5], conf=pred[:, 5])
+        for column, dtype in _BOX_COLUMNS.items():
+            self._spills[column].write(
+                np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+        self._sizes.append(len(pred))
+        self._num_boxes += len(pred)
+
+    def close(self):
+        '''
+        Write the store and remove the spill files
+        '''
+        for spill in self._spills.values():
+            spill.close()
+        counts = np.asarray(self._counts, dtype='<i4').reshape(-1, 2)
+        image_columns = dict(
+            offsets=np.concatenate([[0], np.cumsum(self._sizes)]),
+            unfertilized=counts[:, 0], fertilized=counts[:, 1])
+        shapes = dict(image_id=[self._num_boxes], cls=[self._num_boxes],
+                      box=[self._num_boxes, 4], conf=[self._num_boxes])
+        shapes.update({column: [len(values)]
+                       for column, values in image_columns.items()})
+
+        header = dict(version=VERSION, images=len(self.names),
+                      boxes=self._num_boxes, names=self.names, columns={})
+        offset = 0
+        for column, dtype in {**_BOX_COLUMNS, **_IMAGE_COLUMNS}.items():
+            header['columns'][column] = dict(
+                dtype=dtype, shape=shapes[column], offset=offset)
+            offset += int(np.prod(shapes[column])) * np.dtype(dtype).itemsize
+            offset += len(_padding(offset))
+        header_bytes = json.dumps(header).encode()
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.array(len(header_bytes), dtype='<u8').tobytes())
+            f.write(header_bytes)
+            f.write(_padding(f.tell()))
+            for column in _BOX_COLUMNS:
+                with open(self._spills[column].name, 'rb') as spill:
+                    shutil.copyfileobj(spill, f)
+                f.write(_padding(f.tell()))
+            for column, dtype in _IMAGE_COLUMNS.items():
+                f.write(np.ascontiguousarray(
+                    image_columns[column], dtype=dtype).tobytes())
+                f.write(_padding(f.tell()))
+        os.replace(tmp_path, self.path)
+        self._removeSpills()
+
+    def abort(self):
+        '''
+        Discard everything written so far, keeping any previous store
+        '''
+        for spill in self._spills.values():
+            spill.close()
+        self._removeSpills()
+
+    def _removeSpills(self):
+        for spill in self._spills.values():
+            if os.path.exists(spill.name):
+                os.remove(spill.name)
+
+
+class ResultsStore():
+    '''
+    Read only view of a store written by `ResultsWriter`. The file is
+    memory-mapped, so opening it is cheap and columns are only paged in
+    when used
+
+    :param path: Path of the store
+    '''
+
+    def __init__(self, path: typing.Union[str, os.PathLike]):
+        self.path = os.fspath(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a detections store")
+            header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_size))
+        data_start = len(MAGIC) + 8 + header_size
+        data_start += len(_padding(data_start))
+        if header['version'] > VERSION:
+            raise ValueError(
+                f"{self.path} was written by a newer version "
+                f"(format {header['version']})")
+        self.names = header['names']
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        self.columns = {}
+        for column, spec in header['columns'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            size = int(np.prod(spec['shape'])) * dtype.itemsize
+            self.columns[column] = self._data[start:start + size].view(
+                dtype).reshape(spec['shape'])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        return False
+
+    def __getattr__(self, column):
+        # Columns are exposed as attributes, e.g. store.conf
+        columns = self.__dict__.get('columns', {})
+        if column in columns:
+            return columns[column]
+        raise AttributeError(column)
+
+    def index(self, name: str) -> typing.Optional[int]:
+        '''
+        Returns the image id of the image with the given name, if any
+        '''
+        return self._index.get(name)
+
+    def pred(self, image: typing.Union[int, str]) -> np.ndarray:
+        '''
+        Returns the YOLO formatted predictions of an image (by id or name)
+        '''
+        if isinstance(image, str):
+            image = self._index[image]
+        start, end = self.offsets[image], self.offsets[image + 1]
+        return np.column_stack([
+            self.cls[start:end], self.box[start:end],
+            self.conf[start:end]]).astype(float)
+
+    def countLines(self) -> list[str]:
+        '''
+        Returns "<name> <unfertilized> <fertilized>" lines for the images
+        with detections, as in prediction_counts.txt
+        '''
+        sizes = np.diff(self.offsets)
+        return [f"{self.names[i]} {self.unfertilized[i]} {self.fertilized[i]}"
+                for i in np.flatnonzero(sizes)]
+
+    def exportYOLOLabels(self, labels_dir: typing.Union[str, os.PathLike]):
+        '''
+        Write one YOLO label text file per image with detections, in the
+        format the model itself writes
+        '''
+        os.makedirs(labels_dir, exist_ok=True)
+        for i in np.flatnonzero(np.diff(self.offsets)):
+            np.savetxt(os.path.join(labels_dir, f'{self.names[i]}.txt'),
+                       self.pred(int(i)), fmt='%f')
+
+    def close(self):
+        self.columns = {}
+        self._data = None
@@ -0,0 +1,271 @@
+'''
+Local inference server holding one pool of loaded models for all clients.
+Concurrent requests are coalesced into dynamic batches.
+
+Usage:
+    python server.py [--host 127.0.0.1] [--port 8765] [--max-batch-size 16]
+                     [--max-wait-ms 20] [--stub]
+
+Endpoints:
+    POST /detect?model=sgd&conf=0.25&max_det=500&raw=0
+        Body: encoded image bytes, a .npy BGR array
+        (Content-Type: application/x-npy), or JSON {"path": "<image path>"}
+        (Content-Type: application/json). Returns
+        {"counts": {"unfertilized": n, "fertilized": n}, "boxes": [...]}
+        with YOLO formatted [class, x_center, y_center, width, height,
+        confidence] boxes after NMS (before NMS with raw=1)
+    GET /health?model=sgd
+        Loaded models, backend and batching statistics, and with `model`
+        the label results of that model should be stored under
+'''
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+import typing
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+from imagesource import toModelArray
+from predict import (DEFAULT_BACKEND, MODEL_BACKENDS, ModelRegistry,
+                     countPredictions, filterPredictions,
+                     normalizeModelLabel, resultToPred)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class _DetectionRequest():
+
+    def __init__(self, model: str, pixels: np.ndarray, conf: float,
+                 max_det: int):
+        self.model = model
+        self.pixels = pixels
+        self.conf = conf
+        self.max_det = max_det
+        self.pred = None
+        self.error = None
+        self.done = threading.Event()
+
+    def batchKey(self):
+        return (self.model, self.conf, self.max_det)
+
+
+class DynamicBatcher():
+    '''
+    Coalesces detection requests from concurrent clients into batches.
+    A batch is closed once it holds `max_batch_size` requests or the
+    oldest request has waited `max_wait_ms`, and is then split by model
+    and settings into one predict call per group
+
+    :param registry: Registry the models are loaded from
+    :param max_batch_size: Maximum number of images per batch
+    :param max_wait_ms: Maximum time a request waits for others to join
+    '''
+
+    def __init__(self, registry: ModelRegistry, max_batch_size: int = 16,
+                 max_wait_ms: float = 20):
+        self.registry = registry
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.images = 0
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def detect(self, model: str, pixels: np.ndarray, conf: float = 0.25,
+               max_det: int = 500) -> np.ndarray:
+        '''
+        Queue a BGR image for detection and wait for its raw YOLO
+        formatted predictions
+        '''
+        request = _DetectionRequest(
+            normalizeModelLabel(model), pixels, conf, max_det)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.pred
+
+    def _collectBatch(self) -> list[_DetectionRequest]:
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = {}
+            for request in self._collectBatch():
+                groups.setdefault(request.batchKey(), []).append(request)
+            for (model, conf, max_det), requests in groups.items():
+                try:
+                    results = self.registry.get(model).predict(
+                        source=[request.pixels for request in requests],
+                        batch=len(requests), classes=[0, 1],
+                        agnostic_nms=True, conf=conf, max_det=max_det,
+                        save=False, verbose=False)
+                    for request, result in zip(requests, results):
+                        request.pred = resultToPred(result)
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+                self.batches += 1
+                self.images += len(requests)
+                for request in requests:
+                    request.done.set()
+
+    def stats(self) -> dict:
+        return dict(
+            batches=self.batches,
+            images=self.images,
+            mean_batch_size=self.images / self.batches if self.batches else 0,
+            queued=self._requests.qsize(),
+            max_batch_size=self.max_batch_size,
+            max_wait_ms=self.max_wait * 1000)
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP handler for the inference server. The server is expected to have
+    a `batcher` attribute
+    '''
+
+    def _sendJSON(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _readImage(self) -> np.ndarray:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-npy'):
+            return np.load(io.BytesIO(body), allow_pickle=False)
+        if content_type.startswith('application/json'):
+            image = Image.open(json.loads(body)['path'])
+        else:
+            image = Image.open(io.BytesIO(body))
+        with image:
+            return toModelArray(image)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/health':
+            self._sendJSON(404, dict(error="Not found"))
+            return
+        batcher = self.server.batcher
+        health = dict(
+            models=batcher.registry.loadedModels(),
+            backend=batcher.registry.backend,
+            batching=batcher.stats())
+        params = urllib.parse.parse_qs(url.query)
+        if 'model' in params:
+            # Clients cache detections under the label of the backend here
+            health['result_label'] = batcher.registry.resultLabel(
+                params['model'][0])
+        self._sendJSON(200, health)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/detect':
+            self._sendJSON(404, dict(error="Not found"))
+            return
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            model = params.get('model', [''])[0]
+            conf = float(params.get('conf', [0.25])[0])
+            max_det = int(params.get('max_det', [500])[0])
+            iou_threshold = float(params.get('iou_threshold', [0.5])[0])
+            raw = params.get('raw', ['0'])[0] == '1'
+            pixels = self._readImage()
+        except (KeyError, ValueError, OSError) as e:
+            self._sendJSON(400, dict(error=str(e)))
+            return
+        try:
+            pred = self.server.batcher.detect(model, pixels, conf, max_det)
+        except Exception as e:
+            self._sendJSON(500, dict(error=str(e)))
+            return
+        if not raw and len(pred):
+            pred = filterPredictions(pred, iou_threshold=iou_threshold)
+        num_unfertilized, num_fertilized = countPredictions(pred)
+        self._sendJSON(200, dict(
+            model=normalizeModelLabel(model),
+            counts=dict(unfertilized=num_unfertilized,
+                        fertilized=num_fertilized),
+            boxes=np.asarray(pred).tolist()))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def createServer(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 registry: typing.Optional[ModelRegistry] = None,
+                 max_batch_size: int = 16, max_wait_ms: float = 20,
+                 verbose: bool = False) -> ThreadingHTTPServer:
+    '''
+    Create (but don't start) an inference server. A registry holding
+    every model is created if none is given; pass one with a stub loader
+    to run without the real weights. Use port 0 to pick a free port
+    '''
+    if registry is None:
+        registry = ModelRegistry(max_models=3)
+    server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.daemon_threads = True
+    server.batcher = DynamicBatcher(registry, max_batch_size, max_wait_ms)
+    server.verbose = verbose
+    return server
+
+
+def main(argv: typing.Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--stub", action="store_true",
+                        help="Serve a stand-in model instead of the weights")
+    parser.add_argument("--backend", choices=MODEL_BACKENDS,
+                        default=DEFAULT_BACKEND,
+                        help="Inference backend of the models")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    registry = None
+    if args.stub:
+        from stubmodel import stubLoader
+        registry = ModelRegistry(max_models=3, loader=stubLoader())
+    else:
+        registry = ModelRegistry(max_models=3)
+        registry.setBackend(args.backend)
+    server = createServer(args.host, args.port, registry,
+                          args.max_batch_size, args.max_wait_ms,
+                          args.verbose)
+    print("Serving detections on http://{}:{}".format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+'''
+Detection split across several worker processes. Every worker loads its
+own model, with its share of the CPU threads, and runs `runDetection` on
+a shard of the images, so decoding, inference, NMS and file I/O of
+different images run in parallel. Results are streamed back and merged
+into a single ordered run, as if `runDetection` had run on all images.
+'''
+import multiprocessing
+import os
+import queue
+import shutil
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+import numpy as np
+
+from imagesource import DirectoryImageSource, ImageSource, SubsetImageSource
+from inferenceclient import RemoteModel
+from instrumentation import NULL_METRICS, Metrics
+from jobcontrol import JobControl
+from journal import RunJournal
+from memorybudget import MemoryBudget
+from predict import (DEFAULT_BACKEND, DEFAULT_MODEL, detectionSettings,
+                     exportModel, model_registry, normalizeModelLabel,
+                     runDetection, setModelBackend)
+from resultstore import (ResultsStore, ResultsWriter, removeRawResults,
+                         resultsPath)
+
+_PROGRESS = 0
+_RESULT = 1
+_DONE = 2
+# Seconds between journal syncs while merging
+_JOURNAL_SYNC_INTERVAL = 1.0
+
+# State of a worker process, set up by `_initWorker`
+_worker = {}
+
+
+def _initWorker(messages, control: JobControl, backend: str, threads: int):
+    # Set before torch is imported, for the OpenMP pool it creates
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    setModelBackend(backend)
+    _worker.update(messages=messages, control=control)
+
+
+def _detectShard(shard: int, shard_dir: str, source: ImageSource,
+                 model: str, detection_kwargs: dict,
+                 track_budget: bool = False,
+                 budget_mb: typing.Optional[float] = None):
+    '''
+    Run detection on one shard in a worker process, streaming progress
+    and results back to the parent. With `track_budget`, the shard runs
+    with its own memory budget of `budget_mb`, whose report is sent back
+    when the shard is done, along with the lookups of the detection cache
+    '''
+    messages = _worker["messages"]
+    budget = MemoryBudget(budget_mb) if track_budget else None
+
+    def onProgress(_):
+        messages.put((_PROGRESS, shard, None))
+
+    def onResult(filename, prediction, pred):
+        messages.put((_RESULT, shard, (filename, prediction, pred)))
+
+    cache = detection_kwargs.get("cache")
+    try:
+        runDetection(shard_dir, model=model, source=source,
+                     progress_callback=onProgress, result_callback=onResult,
+                     control=_worker["control"], budget=budget,
+                     **detection_kwargs)
+    except BaseException:
+        if cache is not None:
+            cache.close()
+        raise
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    cache_lookups = None
+    if cache is not None:
+        # Counted by the parent's cache, which persists them
+        cache_lookups = dict(hits=cache.hits, misses=cache.misses)
+        cache.close(flush_stats=False)
+    # Queued after every result of the shard, see `runShardedDetection`
+    messages.put((_DONE, shard, dict(
+        budget=budget.report() if budget is not None else None,
+        cache=cache_lookups)))
+
+
+def runShardedDetection(prediction_dir,
+                        model: str = DEFAULT_MODEL,
+                        progress_callback: typing.Optional[
+                            Callable[[int], None]] = None,
+                        result_callback: typing.Optional[
+                            Callable[[str, str, np.ndarray], None]] = None,
+                        processes: typing.Optional[int] = None,
+                        threads_per_process: typing.Optional[int] = None,
+                        source: typing.Optional[ImageSource] = None,
+                        save_labels: bool = False,
+                        metrics: typing.Optional[Metrics] = None,
+                        journal: typing.Optional[RunJournal] = None,
+                        control: typing.Optional[JobControl] = None,
+                        budget: typing.Optional[MemoryBudget] = None,
+                        **detection_kwargs):
+    '''
+    Run detection like `runDetection`, with the images dealt round robin
+    across `processes` worker processes (one per CPU by default). Each
+    worker loads the model by name, using the current backend (see
+    `setModelBackend`), and runs `threads_per_process` torch threads (its
+    share of the CPUs by default).
+
+    Results are merged in the order of the source: `result_callback` is
+    called for each image with detections in that order, and the results
+    store, prediction_counts.txt and the returned count lines are the
+    same as `runDetection` writes and returns. `progress_callback` is
+    called with the number of images done across all workers.
+    With a `journal`, images a previous run finished are skipped and
+    finished images are recorded as they are merged. With a `control`,
+    pausing and cancelling applies to all workers.
+    Each worker is timed as a "detect_shard" span in `metrics` if given.
+    With a `budget`, each worker gets an equal share of its limit, and
+    the stages of each worker are added to its report when it is done.
+    Cache hits and misses of the workers are added to the `cache` given.
+    Raw detections aren't kept (`raw_conf`), and those of an earlier run
+    in prediction_dir are removed.
+    Remaining keyword arguments are passed on to `runDetection` in the
+    workers; `model` must be a model name, since every worker loads its
+    own model
+    '''
+    if not isinstance(model, str):
+        raise TypeError("Sharded detection loads the model in each worker, "
+                        "pass the model name")
+    if detection_kwargs.get("raw_conf") is not None:
+        raise ValueError("Sharded detection doesn't keep raw detections, "
+                         "run it in a single process")
+    os.makedirs(prediction_dir, exist_ok=True)
+    removeRawResults(prediction_dir)
+    if metrics is None:
+        metrics = NULL_METRICS
+    if source is None:
+        source = DirectoryImageSource(prediction_dir)
+    filenames = source.names()
+    names = [os.path.splitext(filename)[0] for filename in filenames]
+    detection_kwargs.setdefault("in_memory", True)
+    if detection_kwargs.get("server_url"):
+        model_label = RemoteModel(detection_kwargs["server_url"],
+                                  model).resultLabel()
+    else:
+        model_label = model_registry.resultLabel(model)
+
+    # Images are merged in order once every image before them is done:
+    # a worker works through its shard in order, so once it reports an
+    # image, the ones before it in its shard are done too
+    resumed = set()
+    if journal is not None:
+        journal.start(dict(model=model_label,
+                           **detectionSettings(**detection_kwargs)))
+        resumed = {i for i, name in enumerate(names)
+                   if name in journal.detections}
+    remaining = [i for i in range(len(filenames)) if i not in resumed]
+    processes = max(1, min(processes or os.cpu_count() or 1,
+                           len(remaining)))
+    threads = threads_per_process or max(
+        1, (os.cpu_count() or 1) // processes)
+    shards = [remaining[shard::processes] for shard in range(processes)]
+    shard_of = {}
+    for shard, indices in enumerate(shards):
+        for position, i in enumerate(indices):
+            shard_of[i] = (shard, position)
+    shard_position = {filenames[i]: position
+                      for i, (_, position) in shard_of.items()}
+    # Progress calls and known finished images per shard
+    progressed = [0] * processes
+    finished = [0] * processes
+    found = {}
+    predictions = []
+    results_writer = ResultsWriter(resultsPath(prediction_dir))
+    next_index = 0
+    done_count = len(resumed)
+    last_sync = time.monotonic()
+
+    def isDone(i):
+        if i in resumed:
+            return True
+        shard, position = shard_of[i]
+        return position < finished[shard]
+
+    def merge():
+        nonlocal next_index, last_sync
+        while next_index < len(filenames) and isDone(next_index):
+            i = next_index
+            next_index += 1
+            name = names[i]
+            if i in resumed:
+                pred, num_unfertilized, num_fertilized = \
+                    journal.detections[name]
+            else:
+                pred, num_unfertilized, num_fertilized = found.pop(
+                    name, (None, 0, 0))
+                if journal is not None:
+                    journal.recordDetection(name, pred, num_unfertilized,
+                                            num_fertilized)
+            results_writer.add(name, pred, num_unfertilized, num_fertilized)
+            if pred is None or len(pred) == 0:
+                continue
+            prediction = f"{name} {num_unfertilized} {num_fertilized}"
+            predictions.append(prediction)
+            if result_callback is not None:
+                result_callback(filenames[i], prediction, pred)
+        if (journal is not None and
+                time.monotonic() - last_sync > _JOURNAL_SYNC_INTERVAL):
+            journal.sync()
+            last_sync = time.monotonic()
+
+    if progress_callback is not None and resumed:
+        progress_callback(done_count)
+    merge()
+
+    if (remaining and not detection_kwargs.get("server_url")
+            and model_registry.backend != DEFAULT_BACKEND):
+        # Exported here once, before the workers all load the model
+        with metrics.stage("export_model"):
+            exportModel(normalizeModelLabel(model), model_registry.backend)
+    context = multiprocessing.get_context("spawn")
+    messages = context.Queue()
+    shared_control = JobControl(event=context.Event)
+    executor = ProcessPoolExecutor(
+        max_workers=processes, mp_context=context,
+        initializer=_initWorker,
+        initargs=(messages, shared_control, model_registry.backend, threads))
+    shards_dir = os.path.join(prediction_dir, 'predict', 'shards')
+    budget_mb = None
+    if budget is not None and budget.limit:
+        budget_mb = budget.limit / processes / 1024 ** 2
+    futures = []
+    started = {}
+    running = set()
+    try:
+        for shard, indices in enumerate(shards):
+            if not indices:
+                continue
+            futures.append(executor.submit(
+                _detectShard, shard, os.path.join(shards_dir, str(shard)),
+                SubsetImageSource(source, [filenames[i] for i in indices]),
+                model, detection_kwargs, budget is not None, budget_mb))
+            started[shard] = metrics.now() if metrics.enabled else None
+            running.add(shard)
+        while running or next_index < len(filenames):
+            if control is not None:
+                # Mirror the caller's control into the workers
+                if control.cancelled:
+                    shared_control.cancel()
+                elif control.paused != shared_control.paused:
+                    if control.paused:
+                        shared_control.pause()
+                    else:
+                        shared_control.resume()
+            try:
+                kind, shard, payload = messages.get(timeout=0.1)
+            except queue.Empty:
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            if kind == _PROGRESS:
+                # Sent as a worker gets to an image, so the images before
+                # it in the shard are finished
+                progressed[shard] += 1
+                finished[shard] = max(finished[shard], progressed[shard] - 1)
+                done_count += 1
+                if progress_callback is not None:
+                    progress_callback(done_count)
+            elif kind == _RESULT:
+                filename, prediction, pred = payload
+                _, num_unfertilized, num_fertilized = prediction.split(' ')
+                found[os.path.splitext(filename)[0]] = (
+                    pred, int(num_unfertilized), int(num_fertilized))
+                finished[shard] = max(finished[shard],
+                                      shard_position[filename] + 1)
+            else:
+                finished[shard] = len(shards[shard])
+                running.discard(shard)
+                if payload['budget'] is not None:
+                    budget.include(payload['budget'], f"shard {shard} ")
+                cache = detection_kwargs.get("cache")
+                if payload['cache'] is not None and cache is not None:
+                    cache.addLookups(**payload['cache'])
+                if started.get(shard) is not None:
+                    metrics.record(dict(
+                        stage="detect_shard", image=f"shard {shard}",
+                        start=started[shard],
+                        wall=metrics.now() - started[shard]))
+            merge()
+    except BaseException:
+        shared_control.cancel()
+        results_writer.abort()
+        if journal is not None:
+            journal.sync()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(shards_dir, ignore_errors=True)
+
+    if journal is not None:
+        journal.sync()
+    with metrics.stage("results_close"):
+        results_writer.close()
+    if save_labels:
+        with metrics.stage("label_write"), \
+                ResultsStore(results_writer.path) as store:
+            store.exportYOLOLabels(
+                os.path.join(prediction_dir, 'predict', 'labels'))
+    with metrics.stage("counts_write"), open(
+            os.path.join(prediction_dir, 'predict', 'prediction_counts.txt'),
+            'w+') as f:
+        f.write('\n'.join(predictions))
+    return predictions
@@ -0,0 +1,69 @@
+import time
+import typing
+
+import numpy as np
+from PIL import Image
+
+from imagesource import toModelArray
+
+
+class StubModel():
+    '''
+    Local stand-in for the YOLO models, used to test the server and
+    benchmark the pipeline without the real weights. Returns a fixed number
+    of pseudo random boxes per image, seeded by the image content so
+    repeated runs give the same detections. `predict` accepts the same
+    arguments as the ultralytics models and returns YOLO formatted
+    predictions ([class, x_center, y_center, width, height, confidence]
+    rows, normalized) instead of `Results` objects.
+
+    :param boxes_per_image: Number of raw boxes generated per image
+    :param latency_ms: Simulated inference time per predict call
+    :param latency_per_image_ms: Simulated inference time per image
+    '''
+
+    # The stub can't write YOLO label files, see `runDetection`
+    in_memory_only = True
+
+    def __init__(self, boxes_per_image: int = 60,
+                 latency_ms: float = 0.0,
+                 latency_per_image_ms: float = 0.0):
+        self.boxes_per_image = boxes_per_image
+        self.latency_ms = latency_ms
+        self.latency_per_image_ms = latency_per_image_ms
+
+    def _predictImage(self, pixels: np.ndarray, conf: float,
+                      max_det: int) -> np.ndarray:
+        rng = np.random.default_rng(
+            int(pixels[::max(1, pixels.shape[0] // 16),
+                       ::max(1, pixels.shape[1] // 16)].sum()))
+        num_boxes = self.boxes_per_image
+        size = rng.uniform(0.01, 0.04, size=(num_boxes, 1))
+        pred = np.column_stack([
+            rng.integers(0, 2, size=num_boxes),
+            rng.uniform(0.05, 0.95, size=(num_boxes, 2)),
+            size * rng.uniform(0.8, 1.2, size=(num_boxes, 2)),
+            rng.uniform(0.05, 1.0, size=num_boxes)]).astype(float)
+        pred = pred[pred[:, 5] >= conf]
+        return pred[np.argsort(pred[:, 5])[::-1][:max_det]]
+
+    def predict(self, source, conf: float = 0.25, max_det: int = 300,
+                **kwargs) -> list[np.ndarray]:
+        images = source if isinstance(source, list) else [source]
+        if self.latency_ms or self.latency_per_image_ms:
+            time.sleep((self.latency_ms +
+                        self.latency_per_image_ms * len(images)) / 1000)
+        preds = []
+        for image in images:
+            if not isinstance(image, np.ndarray):
+                with Image.open(image) as opened:
+                    image = toModelArray(opened)
+            preds.append(self._predictImage(image, conf, max_det))
+        return preds
+
+
+def stubLoader(**kwargs) -> typing.Callable[[str], StubModel]:
+    '''
+    Returns a `ModelRegistry` loader creating stubs with the given settings
+    '''
+    return lambda label: StubModel(**kwargs)
@@ -0,0 +1,36 @@
+import numpy as np
+
+from detectioncache import DetectionCache
+
+
+def test_evicts_least_recently_used(tmp_path):
+    pred = np.zeros((100, 6))
+    entry_size = pred.nbytes + len("image0")
+    cache = DetectionCache(tmp_path, max_mb=3.5 * entry_size / 1024 ** 2)
+    for i in range(3):
+        cache.put(f"image{i}", pred)
+    cache.get("image0")
+    cache.put("image3", pred)
+    assert cache.get("image1") is None
+    assert all(cache.get(f"image{i}") is not None for i in (0, 2, 3))
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (3, 1)
+    assert stats["size_bytes"] == cache._size == 3 * entry_size
+    cache.close()
+
+
+def test_sums_sizes_only_when_over_limit(tmp_path):
+    cache = DetectionCache(tmp_path, max_mb=1)
+    cache.put("image0", np.zeros((10, 6)))
+    queries = []
+    cache._db.set_trace_callback(queries.append)
+    for i in range(20):
+        cache.put(f"image{i}", np.zeros((10, 6)))
+    assert not any("SUM" in query for query in queries)
+    cache._db.set_trace_callback(None)
+    assert cache._size == cache.stats()["size_bytes"]
+    cache.close()
+    # Picked up again when reopened
+    cache = DetectionCache(tmp_path, max_mb=1)
+    assert cache._size == cache.stats()["size_bytes"] > 0
+    cache.close()
@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+import time
+import types
+
+import predict
+
+EXPORT_CONTENT = b"exported model" * 1000
+
+
+class FakeYOLO():
+    '''
+    Stands in for ultralytics.YOLO, exporting next to the weights slowly
+    enough for other processes to see a partly written file
+    '''
+    exports = 0
+
+    def __init__(self, path, task=None):
+        self.path = path
+
+    def export(self, format, **kwargs):
+        FakeYOLO.exports += 1
+        exported = os.path.splitext(self.path)[0] + f".{format}"
+        with open(exported, 'wb') as f:
+            f.write(EXPORT_CONTENT[:10])
+            f.flush()
+            time.sleep(0.2)
+            f.write(EXPORT_CONTENT[10:])
+        return exported
+
+
+def test_concurrent_exports_export_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(predict, "MODEL_DIR", str(tmp_path))
+    monkeypatch.setitem(sys.modules, "ultralytics",
+                        types.SimpleNamespace(YOLO=FakeYOLO))
+    (tmp_path / "sgd.pt").write_bytes(b"weights")
+    FakeYOLO.exports = 0
+    seen = []
+
+    def export():
+        path = predict.exportModel("sgd", "onnx")
+        with open(path, 'rb') as f:
+            seen.append(f.read())
+
+    threads = [threading.Thread(target=export) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakeYOLO.exports == 1
+    assert seen == [EXPORT_CONTENT] * 4
+    assert sorted(os.listdir(tmp_path)) == ["sgd.onnx", "sgd.pt"]
+
+
+def test_stale_lock_is_taken_over(tmp_path, monkeypatch):
+    monkeypatch.setattr(predict, "MODEL_DIR", str(tmp_path))
+    monkeypatch.setitem(sys.modules, "ultralytics",
+                        types.SimpleNamespace(YOLO=FakeYOLO))
+    (tmp_path / "sgd.pt").write_bytes(b"weights")
+    lock_path = tmp_path / "sgd.onnx.lock"
+    lock_path.write_bytes(b"")
+    stale = time.time() - predict.EXPORT_LOCK_STALE_SECONDS - 1
+    os.utime(lock_path, (stale, stale))
+    path = predict.exportModel("sgd", "onnx")
+    assert open(path, 'rb').read() == EXPORT_CONTENT
+    assert not lock_path.exists()
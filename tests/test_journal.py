@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from journal import RunJournal
+
+SETTINGS = dict(model="sgd", conf=0.25, iou_threshold=0.5, max_det=500)
+
+
+def writeJournal(path):
+    '''
+    Returns the file size after each record of a journal with three
+    detected images, the first of them annotated
+    '''
+    journal = RunJournal(path)
+    journal.start(SETTINGS)
+    sizes = []
+    for i in range(3):
+        pred = np.array([[i % 2, 0.5, 0.5, 0.125, 0.125, 0.75]])
+        journal.recordDetection(f"plate{i}", pred, 1 - i % 2, i % 2)
+        sizes.append(path.stat().st_size)
+    journal.recordAnnotation("plate0")
+    sizes.append(path.stat().st_size)
+    journal.close()
+    return sizes
+
+
+def test_replays_complete_journal(tmp_path):
+    path = tmp_path / "journal.bin"
+    writeJournal(path)
+    journal = RunJournal(path)
+    assert journal.start(SETTINGS)
+    assert list(journal.detections) == ["plate0", "plate1", "plate2"]
+    pred, num_unfertilized, num_fertilized = journal.detections["plate1"]
+    np.testing.assert_array_equal(pred, [[1, 0.5, 0.5, 0.125, 0.125, 0.75]])
+    assert (num_unfertilized, num_fertilized) == (0, 1)
+    assert journal.annotated == {"plate0"}
+    journal.close()
+
+
+def test_truncated_record_is_dropped(tmp_path):
+    path = tmp_path / "journal.bin"
+    sizes = writeJournal(path)
+    # Crash halfway through writing the third image
+    with open(path, 'r+b') as f:
+        f.truncate((sizes[1] + sizes[2]) // 2)
+    journal = RunJournal(path)
+    assert journal.settings == SETTINGS
+    assert list(journal.detections) == ["plate0", "plate1"]
+    assert journal.annotated == set()
+    # The partial record is cut off, so new records follow the good ones
+    assert path.stat().st_size == sizes[1]
+    journal.recordDetection("plate2", None)
+    journal.close()
+    journal = RunJournal(path)
+    assert list(journal.detections) == ["plate0", "plate1", "plate2"]
+    journal.close()
+
+
+def test_replay_stops_at_corrupt_record(tmp_path):
+    path = tmp_path / "journal.bin"
+    sizes = writeJournal(path)
+    # Flip a byte in the payload of the second image
+    data = bytearray(path.read_bytes())
+    data[sizes[1] - 1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    journal = RunJournal(path)
+    assert list(journal.detections) == ["plate0"]
+    assert journal.annotated == set()
+    assert path.stat().st_size == sizes[0]
+    journal.close()
+
+
+@pytest.mark.parametrize("changed", [dict(model="adam_w"), dict(conf=0.4)])
+def test_other_settings_discard_journal(tmp_path, changed):
+    path = tmp_path / "journal.bin"
+    writeJournal(path)
+    journal = RunJournal(path)
+    assert not journal.start(dict(SETTINGS, **changed))
+    assert not journal.detections and not journal.annotated
+    journal.close()
+    journal = RunJournal(path)
+    assert journal.settings == dict(SETTINGS, **changed)
+    assert not journal.detections and not journal.annotated
+    journal.close()
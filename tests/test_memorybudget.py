@@ -0,0 +1,66 @@
+import threading
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from imagesource import ZipImageSource
+from memorybudget import MemoryBudget
+from predict import runDetection
+from stubmodel import StubModel
+
+
+def writeZip(path, count=12, size=(400, 300)):
+    rng = np.random.default_rng(0)
+    with zipfile.ZipFile(path, 'w') as archive:
+        for i in range(count):
+            image_path = path.parent / f"plate{i:02d}.png"
+            pixels = rng.integers(0, 255, (size[1], size[0], 3), np.uint8)
+            Image.fromarray(pixels).save(image_path)
+            archive.write(image_path, image_path.name)
+    return ZipImageSource(str(path))
+
+
+def runWithTimeout(fn, timeout=30):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn()
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "detection deadlocked"
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def test_small_budget_with_large_batch(tmp_path):
+    # A batch (10 MB) much larger than the budget (0.5 MB) used to wait
+    # forever for images the budget wouldn't let be decoded
+    source = writeZip(tmp_path / "plates.zip")
+    budget = MemoryBudget(0.5)
+    predictions = runWithTimeout(lambda: runDetection(
+        str(tmp_path / "out"), model=StubModel(), source=source,
+        batch_size=8, batch_memory_mb=10, budget=budget))
+    assert len(predictions) == 12
+    report = budget.report()
+    assert report['stages']['inference']['items'] == 12
+    assert budget._used == 0
+
+
+def test_budget_without_image_sizes(tmp_path, monkeypatch):
+    # Images whose size can't be read from the header are reserved once
+    # decoded, so a batch can't be bounded up front
+    source = writeZip(tmp_path / "plates.zip")
+    monkeypatch.setattr(source, "imageSize", lambda filename: None)
+    budget = MemoryBudget(0.5)
+    predictions = runWithTimeout(lambda: runDetection(
+        str(tmp_path / "out"), model=StubModel(), source=source,
+        batch_size=8, budget=budget))
+    assert len(predictions) == 12
+    assert budget._used == 0
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from predict import greedy_non_max_suppression, non_max_suppression
+
+
+def randomBoxes(count, seed=0):
+    rng = np.random.default_rng(seed)
+    corners = rng.uniform(0, 400, (count, 2))
+    sizes = rng.uniform(5, 40, (count, 2))
+    boxes = np.hstack([corners, corners + sizes])
+    # Repeated boxes and scores, so ties are covered too
+    boxes[::7] = boxes[1::7][:len(boxes[::7])]
+    scores = rng.choice(np.linspace(0.05, 1, 20), count)
+    classes = rng.integers(0, 2, count)
+    return boxes, scores, classes
+
+
+# Below and above block_size, which switches to the grid
+@pytest.mark.parametrize("count", [40, 600])
+@pytest.mark.parametrize("iou_threshold", [0, 0.3, 0.5, 1])
+@pytest.mark.parametrize("class_agnostic", [True, False])
+def test_matches_greedy_nms(count, iou_threshold, class_agnostic):
+    boxes, scores, classes = randomBoxes(count)
+    kwargs = dict(iou_threshold=iou_threshold,
+                  class_agnostic=class_agnostic, class_labels=classes)
+    expected_boxes, expected = greedy_non_max_suppression(
+        boxes, scores, **kwargs)
+    kept_boxes, kept = non_max_suppression(
+        boxes, scores, block_size=256, **kwargs)
+    assert kept == expected
+    np.testing.assert_array_equal(kept_boxes, expected_boxes)
+
+
+@pytest.mark.parametrize("class_agnostic", [True, False])
+def test_empty_input(class_agnostic):
+    boxes = np.zeros((0, 4))
+    scores = np.zeros(0)
+    classes = np.zeros(0, dtype=int)
+    for nms in (non_max_suppression, greedy_non_max_suppression):
+        kept_boxes, kept = nms(boxes, scores, class_agnostic=class_agnostic,
+                               class_labels=classes)
+        assert kept == [] and len(kept_boxes) == 0
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from predict import (batched_non_max_suppression, convert_to_corners,
+                     filterRawPredictions, greedy_non_max_suppression,
+                     non_max_suppression)
+from recount import Recounter
+from resultstore import ResultsStore, ResultsWriter
+
+
+def rawPredictions(rng, num_boxes):
+    '''
+    Clustered boxes with confidences on a coarse grid, so many are tied
+    '''
+    centers = rng.random((num_boxes // 4 + 1, 2))
+    xy = centers[rng.integers(0, len(centers), num_boxes)] + rng.normal(
+        0, 0.01, (num_boxes, 2))
+    wh = 0.03 + rng.random((num_boxes, 2)) * 0.03
+    conf = rng.integers(1, 20, num_boxes) / 20
+    return np.column_stack([rng.integers(0, 2, num_boxes), xy, wh, conf])
+
+
+@pytest.mark.parametrize("num_boxes", [50, 600])
+def test_tied_scores_match_reference(num_boxes):
+    rng = np.random.default_rng(num_boxes)
+    for _ in range(20):
+        pred = rawPredictions(rng, num_boxes)
+        boxes = convert_to_corners(pred)
+        _, selected = non_max_suppression(
+            boxes, pred[:, 5], iou_threshold=0.4, class_agnostic=True)
+        _, reference = greedy_non_max_suppression(
+            boxes, pred[:, 5], iou_threshold=0.4, class_agnostic=True)
+        assert list(selected) == list(reference)
+        keep = batched_non_max_suppression(
+            boxes, pred[:, 5], np.zeros(num_boxes, dtype=int), 0.4)
+        assert sorted(np.flatnonzero(keep)) == sorted(selected)
+
+
+def test_recount_matches_per_image_filtering_with_tied_scores(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / "raw_detections.bin"
+    preds = [rawPredictions(rng, int(rng.integers(0, 300)))
+             for _ in range(200)]
+    with ResultsWriter(path) as writer:
+        for i, pred in enumerate(preds):
+            writer.add(f"plate{i}", pred)
+    with Recounter(path) as recounter, ResultsStore(path) as store:
+        for conf, iou_threshold in [(0.25, 0.5), (0.05, 0.3), (0.5, 0.7)]:
+            num_unfertilized, num_fertilized = recounter.counts(
+                conf, iou_threshold)
+            for i in range(len(preds)):
+                # Filter the boxes as stored, in the order the model gave
+                filtered = filterRawPredictions(
+                    store.pred(i), conf, iou_threshold)
+                fertilized = int(np.sum(filtered[:, 0] == 0))
+                assert num_fertilized[i] == fertilized
+                assert num_unfertilized[i] == len(filtered) - fertilized
+                recounted = recounter.pred(i, conf, iou_threshold)
+                np.testing.assert_array_equal(
+                    np.unique(recounted, axis=0),
+                    np.unique(filtered, axis=0))
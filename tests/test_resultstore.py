@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from boundingbox import addPredictionAnnotations
+from resultstore import ResultsStore, ResultsWriter, resultsPath
+
+PREDS = dict(
+    plate0=np.array([[0, 0.5, 0.5, 0.2, 0.1, 0.9],
+                     [1, 0.1234, 0.25, 0.05, 0.0625, 0.3141]]),
+    plate1=np.zeros((0, 6)),
+    plate2=None,
+    plate3=np.array([[1, 0.75, 0.125, 0.3, 0.3, 0.5]]),
+)
+
+
+def writeStore(path):
+    with ResultsWriter(path) as writer:
+        for name, pred in PREDS.items():
+            num_fertilized = 0 if pred is None else int(np.sum(pred[:, 0] == 0))
+            num_unfertilized = 0 if pred is None else len(pred) - num_fertilized
+            writer.add(name, pred, num_unfertilized, num_fertilized)
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "predict" / "detections.bin")
+    writeStore(path)
+    with ResultsStore(path) as store:
+        assert store.names == list(PREDS)
+        assert len(store) == 4
+        for name, pred in PREDS.items():
+            expected = np.zeros((0, 6)) if pred is None else pred
+            np.testing.assert_allclose(store.pred(name), expected, rtol=1e-6)
+        # Images without detections still have ids, but no count line
+        assert store.index("plate2") == 2
+        assert store.index("plate9") is None
+        assert store.countLines() == ["plate0 1 1", "plate3 1 0"]
+    assert sorted(os.listdir(tmp_path / "predict")) == ["detections.bin"]
+
+
+def test_abort_leaves_no_file(tmp_path):
+    path = str(tmp_path / "detections.bin")
+    with pytest.raises(RuntimeError):
+        with ResultsWriter(path) as writer:
+            writer.add("plate0", PREDS["plate0"], 1, 1)
+            raise RuntimeError
+    assert os.listdir(tmp_path) == []
+
+
+def test_abort_keeps_previous_store(tmp_path):
+    path = str(tmp_path / "detections.bin")
+    writeStore(path)
+    writer = ResultsWriter(path)
+    writer.add("other", PREDS["plate3"], 1, 0)
+    writer.abort()
+    assert os.listdir(tmp_path) == ["detections.bin"]
+    with ResultsStore(path) as store:
+        assert store.names == list(PREDS)
+
+
+def test_yolo_labels_match_label_files(tmp_path):
+    path = str(tmp_path / "detections.bin")
+    writeStore(path)
+    labels_dir = tmp_path / "labels"
+    with ResultsStore(path) as store:
+        store.exportYOLOLabels(labels_dir)
+    assert sorted(os.listdir(labels_dir)) == ["plate0.txt", "plate3.txt"]
+    for name in ("plate0", "plate3"):
+        # As runDetection wrote the filtered label files before the store
+        expected = tmp_path / f"{name}.expected"
+        np.savetxt(expected, PREDS[name], fmt='%f')
+        assert (labels_dir / f"{name}.txt").read_text() == expected.read_text()
+
+
+def test_annotation_falls_back_to_label_files(tmp_path):
+    # Results written before the store only have label files
+    pixels = np.random.default_rng(0).integers(0, 255, (80, 120, 3), np.uint8)
+    legacy_dir = tmp_path / "legacy"
+    store_dir = tmp_path / "store"
+    for directory in (legacy_dir, store_dir):
+        directory.mkdir()
+        for name in PREDS:
+            Image.fromarray(pixels).save(directory / f"{name}.png")
+    writeStore(resultsPath(store_dir))
+    with ResultsStore(resultsPath(store_dir)) as store:
+        store.exportYOLOLabels(legacy_dir / "predict" / "labels")
+
+    for directory in (legacy_dir, store_dir):
+        addPredictionAnnotations(str(directory))
+    annotated = legacy_dir / "predict" / "annotated_images"
+    assert sorted(os.listdir(annotated)) == ["plate0.png", "plate3.png"]
+    for name in ("plate0", "plate3"):
+        with Image.open(annotated / f"{name}.png") as legacy, Image.open(
+                store_dir / "predict" / "annotated_images" / f"{name}.png"
+        ) as stored:
+            assert np.array_equal(np.asarray(legacy), np.asarray(stored))
+        with Image.open(annotated / f"{name}.png") as legacy:
+            assert not np.array_equal(np.asarray(legacy), pixels)
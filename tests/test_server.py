@@ -0,0 +1,78 @@
+import threading
+import zipfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imagesource import DirectoryImageSource, ZipImageSource
+from inferenceclient import RemoteModel
+from journal import RunJournal, journalPath
+from predict import ModelRegistry, runDetection
+from server import createServer
+from stubmodel import stubLoader
+
+
+@pytest.fixture
+def serverRegistry():
+    registry = ModelRegistry(max_models=1, loader=stubLoader())
+    server = createServer(port=0, registry=registry)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://{}:{}".format(*server.server_address[:2]), registry
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_reports_result_label(serverRegistry):
+    url, registry = serverRegistry
+    assert RemoteModel(url, "SGD").resultLabel() == "sgd"
+    # As if started with --backend onnx-int8
+    registry.backend = "onnx-int8"
+    assert RemoteModel(url, "sgd").resultLabel() == "sgd@onnx-int8"
+
+
+def test_remote_run_journals_under_server_label(tmp_path, serverRegistry):
+    url, registry = serverRegistry
+    registry.backend = "openvino"
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    pixels = np.random.default_rng(0).integers(0, 255, (64, 64, 3), np.uint8)
+    Image.fromarray(pixels).save(image_dir / "plate.png")
+    journal = RunJournal(journalPath(str(tmp_path)))
+    runDetection(str(tmp_path), model="sgd", server_url=url,
+                 source=DirectoryImageSource(str(image_dir)),
+                 journal=journal)
+    assert journal.settings["model"] == "sgd@openvino"
+    journal.close()
+
+
+def test_zip_images_are_sent_encoded(tmp_path, monkeypatch, serverRegistry):
+    url, _ = serverRegistry
+    rng = np.random.default_rng(0)
+    image_dir = tmp_path / "plates"
+    image_dir.mkdir()
+    with zipfile.ZipFile(tmp_path / "plates.zip", "w") as archive:
+        for i in range(3):
+            pixels = rng.integers(0, 255, (64, 64, 3), np.uint8)
+            Image.fromarray(pixels).save(image_dir / f"plate{i}.png")
+            archive.write(image_dir / f"plate{i}.png", f"plates/plate{i}.png")
+    content_types = []
+    encode = RemoteModel._encode
+
+    def recordingEncode(self, image):
+        body, content_type = encode(self, image)
+        content_types.append(content_type)
+        return body, content_type
+
+    monkeypatch.setattr(RemoteModel, "_encode", recordingEncode)
+    source = ZipImageSource(tmp_path / "plates.zip")
+    zipped = runDetection(str(tmp_path / "zipped"), model="sgd",
+                          server_url=url, source=source, batch_size=2)
+    source.close()
+    assert content_types == ["application/octet-stream"] * 3
+    # Decoded on the server as they would have been here
+    on_disk = runDetection(str(tmp_path / "on_disk"), model="sgd",
+                           server_url=url,
+                           source=DirectoryImageSource(str(image_dir)))
+    assert sorted(zipped) == sorted(on_disk)
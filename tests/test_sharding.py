@@ -0,0 +1,94 @@
+import os
+import queue
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import sharding
+from detectioncache import DetectionCache
+from imagesource import DirectoryImageSource
+from jobcontrol import JobControl
+from predict import runDetection
+from resultstore import rawResultsPath
+from stubmodel import StubModel
+
+
+def writeImages(directory, count=4):
+    rng = np.random.default_rng(0)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        pixels = rng.integers(0, 255, (64, 64, 3), np.uint8)
+        Image.fromarray(pixels).save(os.path.join(directory, f"plate{i}.png"))
+    return DirectoryImageSource(str(directory))
+
+
+def test_shard_reports_cache_lookups(tmp_path, monkeypatch):
+    source = writeImages(tmp_path / "images")
+    messages = queue.Queue()
+    monkeypatch.setattr(sharding, "_worker", dict(
+        messages=messages, control=JobControl()))
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(2):
+        sharding._detectShard(
+            0, str(tmp_path / "shard"), source, StubModel(),
+            dict(cache=DetectionCache(cache_dir), in_memory=True,
+                 model_label="stub"))
+    done = []
+    while not messages.empty():
+        kind, _, payload = messages.get_nowait()
+        if kind == sharding._DONE:
+            done.append(payload)
+    assert [payload['cache'] for payload in done] == [
+        dict(hits=0, misses=4), dict(hits=4, misses=0)]
+    # Left for the parent to persist
+    cache = DetectionCache(cache_dir)
+    assert cache.stats()['total_misses'] == 0
+    cache.close()
+
+
+def test_run_without_raw_detections_removes_stale_ones(tmp_path):
+    source = writeImages(tmp_path / "images")
+    output_dir = str(tmp_path / "out")
+    runDetection(output_dir, model=StubModel(), source=source,
+                 raw_conf=0.05)
+    assert os.path.exists(rawResultsPath(output_dir))
+    runDetection(output_dir, model=StubModel(), source=source)
+    assert not os.path.exists(rawResultsPath(output_dir))
+
+
+def test_loaded_models_need_a_label_to_cache(tmp_path):
+    source = writeImages(tmp_path / "images")
+    output_dir = str(tmp_path / "out")
+    cache = DetectionCache(str(tmp_path / "cache"))
+    with pytest.raises(ValueError):
+        runDetection(output_dir, model=StubModel(), source=source,
+                     cache=cache)
+    runDetection(output_dir, model=StubModel(), source=source, cache=cache,
+                 model_label="stub-a")
+    runDetection(output_dir, model=StubModel(), source=source, cache=cache,
+                 model_label="stub-b")
+    # Models with other labels don't share cached detections
+    assert (cache.hits, cache.misses) == (0, 8)
+    cache.close()
+
+
+class Exported(Exception):
+    pass
+
+
+def test_exports_model_before_starting_workers(tmp_path, monkeypatch):
+    source = writeImages(tmp_path / "images")
+    exports = []
+
+    def exportModel(label, backend):
+        exports.append((label, backend))
+        # Stop before any worker is spawned
+        raise Exported()
+
+    monkeypatch.setattr(sharding, "exportModel", exportModel)
+    monkeypatch.setattr(sharding.model_registry, "backend", "onnx-int8")
+    with pytest.raises(Exported):
+        sharding.runShardedDetection(str(tmp_path / "out"), model="Adam-W",
+                                     source=source, processes=2)
+    assert exports == [("adam_w", "onnx-int8")]
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from resultstore import ResultsStore, resultsPath
+from stubmodel import StubModel
+from watch import FolderWatcher, watchFolder
+
+
+def writeImage(directory, name):
+    with open(os.path.join(directory, name), 'wb') as f:
+        f.write(b"not really a png")
+
+
+def test_reports_settled_images_once(tmp_path):
+    writeImage(tmp_path, "old.png")
+    watcher = FolderWatcher(tmp_path, settle_seconds=0)
+    assert watcher.poll() == ["old.png"]
+    writeImage(tmp_path, "new.png")
+    writeImage(tmp_path, "notes.txt")
+    os.mkdir(tmp_path / "folder.png")
+    assert watcher.poll() == ["new.png"]
+    assert watcher.poll() == []
+    watcher.close()
+
+
+def test_new_images_dont_list_the_folder(tmp_path, monkeypatch):
+    watcher = FolderWatcher(tmp_path, settle_seconds=0, rescan_seconds=3600)
+    if watcher._events is None:
+        pytest.skip("no inotify")
+    assert watcher.poll() == []
+    listings = []
+    listNew = watcher._listNew
+    monkeypatch.setattr(watcher, "_listNew",
+                        lambda: listings.append(1) or listNew())
+    for i in range(5):
+        writeImage(tmp_path, f"plate{i}.png")
+        assert watcher.poll() == [f"plate{i}.png"]
+    assert listings == []
+    watcher.close()
+
+
+def test_bad_image_doesnt_end_the_watch(tmp_path, capsys):
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        pixels = rng.integers(0, 255, (64, 64, 3), np.uint8)
+        Image.fromarray(pixels).save(tmp_path / f"plate{i}.png")
+    writeImage(tmp_path, "plate1b.png")
+    output_dir = tmp_path / "out"
+    processed = watchFolder(tmp_path, str(output_dir), model=StubModel(),
+                            poll_seconds=0.01, settle_seconds=0,
+                            idle_seconds=0.2)
+    assert processed == 4
+    assert "Skipping plate1b.png" in capsys.readouterr().err
+    with ResultsStore(resultsPath(str(output_dir))) as store:
+        assert sorted(store.names) == ["plate0", "plate1", "plate2"]
+    with open(output_dir / "predict" / "watched.txt") as f:
+        assert "plate1b.png\n" in f.readlines()
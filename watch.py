@@ -0,0 +1,393 @@
+'''
+Watch-folder mode: a folder that images keep arriving in (e.g. the share a
+microscope saves to) is polled, and every new image is detected once it
+has been completely written. Counts are appended to the counts files as
+images are done, so they can be followed while the watch runs.
+'''
+import csv
+import ctypes
+import os
+import stat
+import struct
+import sys
+import time
+import typing
+from typing import Callable
+
+import numpy as np
+
+from imagesource import (VALID_EXTENSIONS, DirectoryImageSource,
+                         SubsetImageSource, isValidImageMember)
+from jobcontrol import JobCancelled, JobControl
+from predict import DEFAULT_MODEL, runDetection
+from resultstore import ResultsStore, ResultsWriter, resultsPath
+
+WATCHED_FILE_NAME = "watched.txt"
+CSV_HEADERS = ["Image", "Unfertilized", "Fertilized"]
+# Images per detection run, i.e. how often processed images are recorded
+# while working through a backlog
+WATCH_CHUNK_SIZE = 256
+
+# inotify flags, see inotify(7)
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class _DirectoryEvents():
+    '''
+    Names of the files created in or moved into a folder, from inotify on
+    Linux. `open` returns None where inotify isn't available
+    '''
+
+    def __init__(self, fd: int):
+        self._fd = fd
+
+    @classmethod
+    def open(cls, directory: str) -> typing.Optional["_DirectoryEvents"]:
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory),
+                                  _IN_CREATE | _IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def read(self) -> typing.Optional[list[str]]:
+        '''
+        Returns the names that appeared since the last call, or None if
+        some may have been missed (the event queue overflowed, or the
+        folder went away) and the folder has to be listed
+        '''
+        names = []
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            position = 0
+            while position < len(data):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(data, position)
+                position += _EVENT_HEADER.size
+                name = data[position:position + length].rstrip(b"\0")
+                position += length
+                if mask & (_IN_Q_OVERFLOW | _IN_IGNORED):
+                    return None
+                names.append(os.fsdecode(name))
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FolderWatcher():
+    '''
+    Finds the images that appear in a folder. An image is only reported
+    once its size and modification time haven't changed for
+    `settle_seconds`, so images that are still being copied in are left
+    alone.
+
+    On Linux, new images are picked up from inotify events, and the
+    folder is only listed every `rescan_seconds` (for network shares,
+    which don't send events for files written by other machines), so a
+    poll costs the same however many images the folder holds. Elsewhere
+    the folder is listed again whenever its modification time changes,
+    i.e. a poll after images arrived costs O(images in the folder).
+    Between listings only the images waiting to settle are looked at
+
+    :param directory: Folder to watch
+    :param valid_extensions: Extensions of the images to report
+    :param settle_seconds: How long an image must stay unchanged
+    :param rescan_seconds: Longest time between two listings
+    :param seen: File names not to report, e.g. images already processed
+    '''
+
+    def __init__(self, directory: typing.Union[str, os.PathLike],
+                 valid_extensions: list[str] = VALID_EXTENSIONS,
+                 settle_seconds: float = 2.0,
+                 rescan_seconds: float = 30.0,
+                 seen: typing.Iterable[str] = ()):
+        self.directory = os.fspath(directory)
+        self.valid_extensions = valid_extensions
+        self.settle_seconds = settle_seconds
+        self.rescan_seconds = rescan_seconds
+        self.seen = set(seen)
+        # File name -> ((size, mtime), time it was first seen that way)
+        self._settling = {}
+        self._listed_mtime = None
+        self._listed_at = None
+        self._events = _DirectoryEvents.open(self.directory)
+
+    @property
+    def pending(self) -> int:
+        '''
+        Number of images found that haven't settled yet
+        '''
+        return len(self._settling)
+
+    def _listNew(self) -> list[str]:
+        with os.scandir(self.directory) as entries:
+            return [entry.name for entry in entries
+                    if entry.name not in self.seen
+                    and entry.name not in self._settling
+                    and isValidImageMember(entry.name, self.valid_extensions)
+                    and entry.is_file()]
+
+    def poll(self) -> list[str]:
+        '''
+        Returns the images that have settled since the last poll, oldest
+        first. They are not reported again
+        '''
+        now = time.monotonic()
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        rescan = (self._listed_at is None
+                  or now - self._listed_at >= self.rescan_seconds)
+        if self._events is None:
+            rescan = rescan or mtime != self._listed_mtime
+        else:
+            created = self._events.read()
+            if created is None:
+                rescan = True
+            else:
+                for filename in created:
+                    if (filename not in self.seen
+                            and filename not in self._settling
+                            and isValidImageMember(
+                                filename, self.valid_extensions)):
+                        self._settling[filename] = (None, now)
+        if rescan:
+            self._listed_mtime = mtime
+            self._listed_at = now
+            for filename in self._listNew():
+                self._settling[filename] = (None, now)
+
+        ready = []
+        for filename, (state, since) in list(self._settling.items()):
+            try:
+                info = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                # Moved away again, e.g. a temporary file
+                del self._settling[filename]
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                del self._settling[filename]
+                continue
+            current = (info.st_size, info.st_mtime_ns)
+            if state is None and info.st_size and \
+                    time.time() - info.st_mtime >= self.settle_seconds:
+                # Already there before it was found, e.g. on start up
+                ready.append((info.st_mtime_ns, filename))
+            elif current != state:
+                self._settling[filename] = (current, now)
+            elif info.st_size and now - since >= self.settle_seconds:
+                ready.append((info.st_mtime_ns, filename))
+        ready.sort()
+        for _, filename in ready:
+            del self._settling[filename]
+            self.seen.add(filename)
+        return [filename for _, filename in ready]
+
+    def close(self):
+        '''
+        Stop receiving change notifications
+        '''
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+
+class _CountsAppender():
+    '''
+    Appends count lines to prediction_counts.txt and .csv, keeping what
+    earlier runs wrote there
+    '''
+
+    def __init__(self, predict_dir: str, formats: typing.Iterable[str]):
+        self._files = []
+        self._csv = None
+        if "txt" in formats:
+            path = os.path.join(predict_dir, 'prediction_counts.txt')
+            f = open(path, 'a+')
+            # runDetection doesn't end the file with a newline
+            if f.tell():
+                f.seek(f.tell() - 1)
+                if f.read(1) != '\n':
+                    f.write('\n')
+            self._txt = f
+            self._files.append(f)
+        else:
+            self._txt = None
+        if "csv" in formats:
+            path = os.path.join(predict_dir, 'prediction_counts.csv')
+            f = open(path, 'a', newline='')
+            self._csv = csv.writer(f)
+            if not f.tell():
+                self._csv.writerow(CSV_HEADERS)
+            self._files.append(f)
+
+    def append(self, prediction: str):
+        if self._txt is not None:
+            self._txt.write(prediction + '\n')
+        if self._csv is not None:
+            self._csv.writerow(prediction.split(' '))
+
+    def flush(self):
+        for f in self._files:
+            f.flush()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+def watchFolder(directory: typing.Union[str, os.PathLike],
+                output_dir: typing.Optional[str] = None,
+                model=DEFAULT_MODEL,
+                progress_callback: typing.Optional[
+                    Callable[[int], None]] = None,
+                result_callback: typing.Optional[
+                    Callable[[str, str, np.ndarray], None]] = None,
+                formats: typing.Iterable[str] = ("txt",),
+                poll_seconds: float = 1.0,
+                settle_seconds: float = 2.0,
+                idle_seconds: typing.Optional[float] = None,
+                control: typing.Optional[JobControl] = None,
+                **detection_kwargs) -> int:
+    '''
+    Watch `directory` and run detection on every image that is added to
+    it (and on the ones already there that weren't processed yet), until
+    `control` cancels the watch, the process is interrupted, or no new
+    image arrived for `idle_seconds`.
+
+    Results go to `output_dir` (the watched folder by default):
+        predict > prediction_counts.txt / .csv   count lines, appended
+                                                 as images are done
+        predict > watched.txt                    images processed so far
+        predict > detections.bin                 written when the watch
+                                                 stops, with the images
+                                                 of earlier watches
+    A restarted watch skips the images a previous one processed. Images
+    that fail (e.g. can't be decoded) are reported on stderr and skipped,
+    so one bad file doesn't end an unattended watch.
+    `result_callback` is called like in `runDetection`, and
+    `progress_callback` with the number of images this watch processed.
+    Memory use only grows with the number of names, not with the images
+    or their detections. Remaining keyword arguments are passed on to
+    `runDetection`. Returns the number of images processed
+    '''
+    directory = os.fspath(directory)
+    if output_dir is None:
+        output_dir = directory
+    predict_dir = os.path.join(output_dir, 'predict')
+    os.makedirs(predict_dir, exist_ok=True)
+    watched_path = os.path.join(predict_dir, WATCHED_FILE_NAME)
+    seen = set()
+    if os.path.exists(watched_path):
+        with open(watched_path) as f:
+            seen.update(line.rstrip('\n') for line in f if line.strip())
+
+    # Carry the detections of earlier watches over into the new store
+    results_writer = ResultsWriter(resultsPath(output_dir))
+    if os.path.exists(results_writer.path):
+        with ResultsStore(results_writer.path) as store:
+            for i, name in enumerate(store.names):
+                results_writer.add(name, store.pred(i),
+                                   int(store.unfertilized[i]),
+                                   int(store.fertilized[i]))
+    stored = set(results_writer.names)
+    source = DirectoryImageSource(directory, VALID_EXTENSIONS)
+    # Images of a stopped watch are in the store but may not be recorded
+    # as watched yet
+    watcher = FolderWatcher(
+        directory, settle_seconds=settle_seconds, seen=seen.union(
+            filename for filename in _listImages(directory)
+            if os.path.splitext(filename)[0] in stored))
+    counts = _CountsAppender(predict_dir, formats)
+    watched = open(watched_path, 'a')
+    processed = 0
+    last_image = time.monotonic()
+
+    def onResult(filename, prediction, pred):
+        counts.append(prediction)
+        if result_callback is not None:
+            result_callback(filename, prediction, pred)
+
+    def detect(filenames):
+        runDetection(output_dir, model=model,
+                     source=SubsetImageSource(source, filenames),
+                     result_callback=onResult,
+                     results_writer=results_writer,
+                     control=control, **detection_kwargs)
+
+    def detectChunk(chunk):
+        stored_count = len(results_writer.names)
+        try:
+            detect(chunk)
+            return
+        except JobCancelled:
+            raise
+        except Exception:
+            pass
+        # Every image that was done is in the results, go through the
+        # rest one by one to find the ones that fail
+        done = set(results_writer.names[stored_count:])
+        for filename in chunk:
+            if control is not None:
+                control.checkpoint()
+            if os.path.splitext(filename)[0] in done:
+                continue
+            try:
+                detect([filename])
+            except JobCancelled:
+                raise
+            except Exception as e:
+                print(f"Skipping {filename}: {e}", file=sys.stderr)
+
+    try:
+        while True:
+            if control is not None:
+                control.checkpoint()
+            ready = watcher.poll()
+            if not ready:
+                if idle_seconds is not None and \
+                        time.monotonic() - last_image >= idle_seconds:
+                    break
+                time.sleep(poll_seconds)
+                continue
+            for start in range(0, len(ready), WATCH_CHUNK_SIZE):
+                chunk = ready[start:start + WATCH_CHUNK_SIZE]
+                detectChunk(chunk)
+                counts.flush()
+                watched.writelines(filename + '\n' for filename in chunk)
+                watched.flush()
+                processed += len(chunk)
+                if progress_callback is not None:
+                    progress_callback(processed)
+            last_image = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        watched.close()
+        counts.close()
+        results_writer.close()
+    return processed
+
+
+def _listImages(directory: str) -> list[str]:
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries
+                if isValidImageMember(entry.name) and entry.is_file()]